@@ -19,7 +19,6 @@ import copy
 import random
 import re
 import time
-import bisect
 import pickle
 import numpy as np
 import argparse
@@ -28,7 +27,13 @@ import pathlib
 
 from source.input_checking import check_file_open, is_in_range
 from source.ref_func import index_ref, read_ref
+from source.packed_ref import open_packed_ref, read_packed_ref
+from source.ref_cache import open_ref_cache
+from source.stream_ref import read_streaming_ref
 from source.vcf_func import parse_vcf
+from source.variant_store import VariantStore, VariantIndex
+from source.ref_regions import on_target_mask
+from source.mut_rate_track import MutRateTrack
 from source.output_file_writer import OutputFileWriter, reverse_complement, sam_flag
 from source.probability import DiscreteDistribution, mean_ind_of_weighted_list
 from source.SequenceContainer import SequenceContainer, ReadContainer, parse_input_mutation_model
@@ -79,6 +84,10 @@ def main(raw_args=None):
                         help="below this quality score, replace base-calls with N's")
     parser.add_argument('-v', type=str, required=False, metavar='vcf.file', default=None,
                         help="Input VCF file of variants to include")
+    parser.add_argument('--vcf-engine', type=str, required=False, choices=['auto', 'python', 'pysam'],
+                        default='auto',
+                        help='python: parse the input VCF in python, pysam: decode it with htslib through pysam '
+                             '(VCF, VCF.gz or BCF), auto: pysam for BCF input, python otherwise')
     parser.add_argument('--pe', nargs=2, type=int, required=False, metavar=('<int>', '<int>'), default=(None, None),
                         help='Paired-end fragment length mean and std')
     parser.add_argument('--pe-model', type=str, required=False, metavar='<str>', default=None,
@@ -101,6 +110,17 @@ def main(raw_args=None):
                         help='[debug] ignore fancy models, force coverage to be constant')
     parser.add_argument('--rescale-qual', required=False, action='store_true', default=False,
                         help='Rescale quality scores to match -E input')
+    parser.add_argument('--ref-store', type=str, required=False, choices=['packed', 'memory', 'stream'],
+                        default='packed',
+                        help='packed: slice windows from a memory-mapped .2bit copy of the reference (built next to '
+                             'the reference on first use), memory: read each chromosome fully into memory, '
+                             'stream: read each window from the reference as it is needed')
+    parser.add_argument('--ref-cache', required=False, action='store_true', default=False,
+                        help='store precomputed reference data (N regions, trinucleotide contexts) in '
+                             '[reference].neatcache and reuse it on later runs')
+    parser.add_argument('--threads', type=int, required=False, metavar='<int>', default=None,
+                        help='number of worker processes for reading large VCFs and building the reference cache, '
+                             'default is the number of cpus (does not change the output)')
     # TODO implement a broader debugging scheme for subclasses.
     parser.add_argument('-d', required=False, action='store_true', default=False, help='Activate Debug Mode')
     args = parser.parse_args(raw_args)
@@ -129,6 +149,9 @@ def main(raw_args=None):
     # important flags
     (save_bam, save_vcf, fasta_instead, no_fastq) = \
         (args.bam, args.vcf, args.fa, args.no_fastq)
+    (ref_store, use_ref_cache) = (args.ref_store, args.ref_cache)
+    vcf_engine = args.vcf_engine
+    threads = args.threads
 
     # sequencing model parameters
     (fragment_size, fragment_std) = args.pe
@@ -179,6 +202,8 @@ def main(raw_args=None):
     is_in_range(coverage, 0, 1000000, 'Error: -c must be between 0 and 1,000,000')
     is_in_range(ploids, 1, 100, 'Error: -p must be between 1 and 100')
     is_in_range(off_target_scalar, 0, 1, 'Error: -to must be between 0 and 1')
+    if threads is not None:
+        is_in_range(threads, 1, 1000000, 'Error: --threads must be between 1 and 1,000,000')
 
     if se_rate != -1:
         is_in_range(se_rate, 0, 0.3, 'Error: -E must be between 0 and 0.3')
@@ -274,11 +299,17 @@ def main(raw_args=None):
     """
 
     # index reference: [(0: chromosome name, 1: byte index where the contig seq begins,
-    #                    2: byte index where the next contig begins, 3: contig seq length),
+    #                    2: byte index where the next contig begins, 3: contig seq length,
+    #                    4: bases per line, 5: bytes per line),
     #                    (repeat for every chrom)]
     # TODO check to see if this might work better as a dataframe or biopython object
     ref_index = index_ref(reference)
 
+    # packed reference: windows are sliced out of a memory map, so chromosomes are never fully loaded
+    packed_ref = None
+    if ref_store == 'packed':
+        packed_ref = open_packed_ref(reference, ref_index)
+
     # TODO check if this index can work, maybe it's faster
     # ref_index2 = SeqIO.index(reference, 'fasta')
 
@@ -287,6 +318,11 @@ def main(raw_args=None):
     else:
         n_handling = ('ignore', read_len)
 
+    # reference cache: N atlas and trinucleotide context codes per contig
+    ref_cache = None
+    if use_ref_cache:
+        ref_cache = open_ref_cache(reference, ref_index, threads)
+
     indices_by_ref_name = {ref_index[n][0]: n for n in range(len(ref_index))}
     ref_list = [n[0] for n in ref_index]
 
@@ -295,14 +331,14 @@ def main(raw_args=None):
     input_variants = []
     if input_vcf is not None:
         if cancer:
-            (sample_names, input_variants) = parse_vcf(input_vcf, tumor_normal=True, ploidy=ploids)
+            (sample_names, input_variants) = parse_vcf(input_vcf, tumor_normal=True, ploidy=ploids, threads=threads,
+                                                        engine=vcf_engine, rng_seed=rng_seed)
             # TODO figure out what these were going to be used for
             tumor_ind = sample_names.index('TUMOR')
             normal_ind = sample_names.index('NORMAL')
         else:
-            (sample_names, input_variants) = parse_vcf(input_vcf, ploidy=ploids)
-        for k in sorted(input_variants.keys()):
-            input_variants[k].sort()
+            (sample_names, input_variants) = parse_vcf(input_vcf, ploidy=ploids, threads=threads, engine=vcf_engine,
+                                                        rng_seed=rng_seed)
 
     # parse input targeted regions, if present
     # TODO convert bed to pandas dataframe
@@ -351,9 +387,8 @@ def main(raw_args=None):
             sys.exit(1)
 
     # parse input mutation rate rescaling regions, if present
-    # TODO convert to pandas dataframe
+    # --- mut_rate_regions[chr] = [(start, end, rate), ...]
     mut_rate_regions = {}
-    mut_rate_values = {}
     if mut_bed is not None:
         try:
             with open(mut_bed, 'r') as f:
@@ -363,13 +398,10 @@ def main(raw_args=None):
                     (pos1, pos2) = (int(pos1), int(pos2))
                     if len(mut_str) and (pos2 - pos1) > 1:
                         # mut_rate = #_mutations / length_of_region, let's bound it by a reasonable amount
-                        mut_rate = max([0.0, min([float(mut_str[0][9:]), 0.3])])
+                        region_rate = max([0.0, min([float(mut_str[0][9:]), 0.3])])
                         if my_chr not in mut_rate_regions:
-                            mut_rate_regions[my_chr] = [-1]
-                            mut_rate_values[my_chr] = [0.0]
-                        mut_rate_regions[my_chr].extend([pos1, pos2])
-                        # TODO figure out what the next line is supposed to do and fix
-                        mut_rate_values.extend([mut_rate * (pos2 - pos1)] * 2)
+                            mut_rate_regions[my_chr] = []
+                        mut_rate_regions[my_chr].append((pos1, pos2, region_rate))
         except IOError:
             print("\nProblem reading mutational BED file.\n")
             sys.exit(1)
@@ -409,8 +441,22 @@ def main(raw_args=None):
 
     for chrom in range(len(ref_index)):
 
+        contig_cache = None
+        if ref_cache is not None:
+            contig_cache = ref_cache.contig(ref_index[chrom][0])
+
         # read in reference sequence and notate blocks of Ns
-        (ref_sequence, n_regions) = read_ref(reference, ref_index[chrom], n_handling)
+        if packed_ref is not None:
+            (ref_sequence, n_regions) = read_packed_ref(packed_ref, ref_index[chrom], n_handling)
+        elif ref_store == 'stream':
+            (ref_sequence, n_regions) = read_streaming_ref(reference, ref_index[chrom], n_handling,
+                                                           n_atlas=contig_cache.n_atlas_list() if contig_cache
+                                                           else None)
+        elif contig_cache is not None:
+            (ref_sequence, n_regions) = read_ref(reference, ref_index[chrom], n_handling,
+                                                 n_atlas=contig_cache.n_atlas_list())
+        else:
+            (ref_sequence, n_regions) = read_ref(reference, ref_index[chrom], n_handling)
 
         # count total bp we'll be spanning so we can get an idea of how far along we are
         # (for printing progress indicators)
@@ -423,28 +469,11 @@ def main(raw_args=None):
                 - try to delete or alter any N characters
                 - don't match the reference base at their specified position
                 - any alt allele contains anything other than allowed characters"""
-        valid_variants_from_vcf = []
+        valid_variants_from_vcf = VariantStore()
         n_skipped = [0, 0, 0]
         if ref_index[chrom][0] in input_variants:
-            for n in input_variants[ref_index[chrom][0]]:
-                span = (n[0], n[0] + len(n[1]))
-                r_seq = str(ref_sequence[span[0] - 1:span[1] - 1])  # -1 because going from VCF coords to array coords
-                # Checks if there are any invalid nucleotides in the vcf items
-                any_bad_nucl = any((nn not in ALLOWED_NUCL) for nn in [item for sublist in n[2] for item in sublist])
-                # Ensure reference sequence matches the nucleotide in the vcf
-                if r_seq != n[1]:
-                    n_skipped[0] += 1
-                    continue
-                # Ensure that we aren't trying to insert into an N region
-                elif 'N' in r_seq:
-                    n_skipped[1] += 1
-                    continue
-                # Ensure that we don't insert any disallowed characters
-                elif any_bad_nucl:
-                    n_skipped[2] += 1
-                    continue
-                # If it passes the above tests, append to valid variants list
-                valid_variants_from_vcf.append(n)
+            (valid_variants_from_vcf, n_skipped) = \
+                input_variants[ref_index[chrom][0]].check_against_reference(ref_sequence)
 
             print('found', len(valid_variants_from_vcf), 'valid variants for ' +
                   ref_index[chrom][0] + ' in input VCF...')
@@ -485,6 +514,18 @@ def main(raw_args=None):
         print("[", end='', flush=True)
 
         buffer_added = 0
+        variant_index = VariantIndex(valid_variants_from_vcf.positions, valid_variants_from_vcf.indel_spans())
+        target_bounds = None
+        if input_bed is not None and ref_index[chrom][0] in input_regions:
+            target_bounds = np.array(input_regions[ref_index[chrom][0]], dtype=np.int64)
+        discard_bounds = None
+        if discard_bed is not None:
+            discard_bounds = np.array(discard_regions.get(ref_index[chrom][0], [-1]), dtype=np.int64)
+        # positional mutation rates, with the (possibly rescaled) model rate outside of the -Mb regions
+        mut_rate_track = None
+        if ref_index[chrom][0] in mut_rate_regions:
+            mut_rate_track = MutRateTrack(mut_rate_regions[ref_index[chrom][0]],
+                                          mut_model[0] if mut_rate is None else mut_rate, len(ref_sequence))
         # Applying variants to non-N regions
         for i in range(len(n_regions['non_N'])):
             (initial_position, final_position) = n_regions['non_N'][i]
@@ -499,46 +540,26 @@ def main(raw_args=None):
             end = min([start + base_pair_distance, final_position])
             vars_from_prev_overlap = []
             vars_cancer_from_prev_overlap = []
-            v_index_from_prev = 0
             is_last_time = False
 
             while True:
                 # which inserted variants are in this window?
-                vars_in_window = []
-                updated = False
-                for j in range(v_index_from_prev, len(valid_variants_from_vcf)):
-                    variants_position = valid_variants_from_vcf[j][0]
-                    # update: changed <= to <, so variant cannot be inserted in first position
-                    if start < variants_position < end:
-                        # vcf --> array coords
-                        vars_in_window.append(tuple([variants_position - 1] + list(valid_variants_from_vcf[j][1:])))
-                    if variants_position >= end - overlap - 1 and updated is False:
-                        updated = True
-                        v_index_from_prev = j
-                    if variants_position >= end:
-                        break
-
-                # determine which structural variants will affect our sampling window positions
-                structural_vars = []
-                for n in vars_in_window:
-                    # change: added abs() so that insertions are also buffered.
-                    buffer_needed = max([max([abs(len(n[1]) - len(alt_allele)), 1]) for alt_allele in n[2]])
-                    # -1 because going from VCF coords to array coords
-                    structural_vars.append((n[0] - 1, buffer_needed))
+                # update: changed <= to <, so variant cannot be inserted in first position
+                (v_first, v_last) = variant_index.window(start, end)
+                # vcf --> array coords
+                vars_in_window = [valid_variants_from_vcf.variant(j, -1) for j in range(v_first, v_last)]
 
                 # adjust end-position of window based on inserted structural mutations
-                keep_going = True
-                while keep_going:
-                    keep_going = False
-                    for n in structural_vars:
-                        # adding "overlap" here to prevent SVs from being introduced in overlap regions
-                        # (which can cause problems if random mutations from the previous window land on top of them)
-                        delta = (end - 1) - (n[0] + n[1]) - 2 - overlap
-                        if delta < 0:
-                            buffer_added = -delta
-                            end += buffer_added
-                            keep_going = True
-                            break
+                # change: indel spans use abs() so that insertions are also buffered.
+                if v_last > v_first:
+                    # the indel buffer starts 2 bases before the VCF position (VCF --> array coords, then one more)
+                    # adding "overlap" here to prevent SVs from being introduced in overlap regions
+                    # (which can cause problems if random mutations from the previous window land on top of them)
+                    end_needed = (variant_index.max_reach(v_first, v_last) - 2) + 3 + overlap
+                    if end_needed > end:
+                        buffer_added = end_needed - end
+                        end = end_needed
+
                 next_start = end - overlap
                 next_end = min([next_start + base_pair_distance, final_position])
                 if next_end - next_start < base_pair_distance:
@@ -563,28 +584,34 @@ def main(raw_args=None):
 
                 # compute coverage modifiers
                 coverage_avg = None
-                coverage_dat = [gc_window_size, gc_scale_val, []]
+                coverage_dat = [gc_window_size, gc_scale_val, None]
                 target_hits = 0
                 if input_bed is None:
-                    coverage_dat[2] = [1.0] * (end - start)
+                    coverage_dat[2] = np.ones(max(end - start, 0))
                 else:
-                    if ref_index[chrom][0] not in input_regions:
-                        coverage_dat[2] = [off_target_scalar] * (end - start)
+                    if target_bounds is None:
+                        coverage_dat[2] = np.full(max(end - start, 0), off_target_scalar, dtype=np.float64)
                     else:
-                        for j in range(start, end):
-                            if not (bisect.bisect(input_regions[ref_index[chrom][0]], j) % 2):
-                                coverage_dat[2].append(1.0)
-                                target_hits += 1
-                            else:
-                                coverage_dat[2].append(off_target_scalar)
+                        on_target = on_target_mask(target_bounds, start, end)
+                        coverage_dat[2] = np.where(on_target, 1.0, off_target_scalar)
+                        target_hits = int(np.count_nonzero(on_target))
+                coverage_sum = float(np.sum(coverage_dat[2]))
+
+                # where reads may start and end, if we are throwing some away (--discard-offtarget / -dr): a read
+                # is kept if its first base and the base after its last both pass, the same as the old per-read check
+                read_pos_ok = None
+                if off_target_discard and target_bounds is not None:
+                    read_pos_ok = on_target_mask(target_bounds, start, end + read_len + 1)
+                if discard_bounds is not None:
+                    discard_ok = on_target_mask(discard_bounds, start, end + read_len + 1)
+                    read_pos_ok = discard_ok if read_pos_ok is None else read_pos_ok & discard_ok
 
                 # off-target and we're not interested?
                 if off_target_discard and target_hits <= read_len:
                     coverage_avg = 0.0
                     skip_this_window = True
 
-                # print len(coverage_dat[2]), sum(coverage_dat[2])
-                if sum(coverage_dat[2]) < low_cov_thresh:
+                if coverage_sum < low_cov_thresh:
                     coverage_avg = 0.0
                     skip_this_window = True
 
@@ -603,13 +630,19 @@ def main(raw_args=None):
                     vars_from_prev_overlap = []
                     continue
 
+                # precomputed reference data for this window
+                trinuc_codes = None
+                if contig_cache is not None:
+                    trinuc_codes = contig_cache.trinuc[start:end]
+
                 # construct sequence data that we will sample reads from
                 if sequences is None:
                     sequences = SequenceContainer(start, ref_sequence[start:end], ploids, overlap, read_len,
-                                                  [mut_model] * ploids, mut_rate, only_vcf=only_vcf)
+                                                  [mut_model] * ploids, mut_rate, only_vcf=only_vcf,
+                                                  trinuc_codes=trinuc_codes, mut_rate_track=mut_rate_track)
                 else:
                     sequences.update(start, ref_sequence[start:end], ploids, overlap, read_len, [mut_model] * ploids,
-                                     mut_rate)
+                                     mut_rate, trinuc_codes=trinuc_codes, mut_rate_track=mut_rate_track)
 
                 # insert variants
                 sequences.insert_mutations(vars_from_prev_overlap + vars_in_window)
@@ -617,11 +650,12 @@ def main(raw_args=None):
                 # print all_inserted_variants
 
                 # init coverage
-                if sum(coverage_dat[2]) >= low_cov_thresh:
+                if coverage_sum >= low_cov_thresh:
                     if paired_end:
-                        coverage_avg = sequences.init_coverage(tuple(coverage_dat), frag_dist=fraglen_distribution)
+                        coverage_avg = sequences.init_coverage(tuple(coverage_dat), frag_dist=fraglen_distribution,
+                                                               read_pos_ok=read_pos_ok)
                     else:
-                        coverage_avg = sequences.init_coverage(tuple(coverage_dat))
+                        coverage_avg = sequences.init_coverage(tuple(coverage_dat), read_pos_ok=read_pos_ok)
 
                 # unused cancer stuff
                 if cancer:
@@ -660,9 +694,14 @@ def main(raw_args=None):
 
                     # if coverage is so low such that no reads are to be sampled, skip region
                     #      (i.e., remove buffer of +1 reads we add to every window)
-                    if reads_to_sample == 1 and sum(coverage_dat[2]) < low_cov_thresh:
+                    if reads_to_sample == 1 and coverage_sum < low_cov_thresh:
                         reads_to_sample = 0
 
+                    # reads that would be thrown away are already out of the coverage distribution, so only sample
+                    # as many as we would have kept
+                    if read_pos_ok is not None:
+                        reads_to_sample = int(reads_to_sample * sequences.read_keep_frac + random.random())
+
                     # sample reads
                     for k in range(reads_to_sample):
 
@@ -697,23 +736,6 @@ def main(raw_args=None):
                                 # adjust mapping position based on window start
                                 my_read_data[0][0] += start
 
-                        # are we discarding offtargets?
-                        outside_boundaries = []
-                        if off_target_discard and input_bed is not None:
-                            outside_boundaries += [bisect.bisect(input_regions[ref_index[chrom][0]], n[0]) % 2 for n
-                                                   in my_read_data]
-                            outside_boundaries += [
-                                bisect.bisect(input_regions[ref_index[chrom][0]], n[0] + len(n[2])) % 2 for n in
-                                my_read_data]
-                        if discard_bed is not None:
-                            outside_boundaries += [bisect.bisect(discard_regions[ref_index[chrom][0]], n[0]) % 2 for
-                                                   n in my_read_data]
-                            outside_boundaries += [
-                                bisect.bisect(discard_regions[ref_index[chrom][0]], n[0] + len(n[2])) % 2 for n in
-                                my_read_data]
-                        if len(outside_boundaries) and any(outside_boundaries):
-                            continue
-
                         my_read_name = out_prefix_name + '-' + ref_index[chrom][0] + '-' + str(read_name_count)
                         read_name_count += len(my_read_data)
 
@@ -859,6 +881,9 @@ def main(raw_args=None):
             print('Read sampling completed in ', end='')
         print(int(time.time() - tt), '(sec)')
 
+        if ref_store == 'stream':
+            ref_sequence.close()
+
         # write all output variants for this reference
         if save_vcf:
             print('Writing output VCF...')
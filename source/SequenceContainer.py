@@ -1,5 +1,6 @@
 import random
 import copy
+import functools
 import pathlib
 import bisect
 import pickle
@@ -8,15 +9,15 @@ import sys
 import numpy as np
 from Bio.Seq import Seq
 
-from source.neat_cigar import CigarString
-from source.probability import DiscreteDistribution, poisson_list
+from source.neat_cigar import ExpandedCigar, ReadCigars
+from source.probability import DiscreteDistribution, ArrayDistribution, FenwickSampler, poisson_sampler
+from source.ref_cache import NO_TRINUC, IS_GC, trinuc_codes
 
 # TODO This whole file is in desperate need of refactoring
 
 """
 Constants needed for analysis
 """
-MAX_ATTEMPTS = 100  # max attempts to insert a mutation into a valid position
 MAX_MUTFRAC = 0.3  # the maximum percentage of a window that can contain mutations
 
 NUCL = ['A', 'C', 'G', 'T']
@@ -95,14 +96,16 @@ class SequenceContainer:
     """
 
     def __init__(self, x_offset, sequence, ploidy, window_overlap, read_len, mut_models=None, mut_rate=None,
-                 only_vcf=False):
+                 only_vcf=False, trinuc_codes=None, mut_rate_track=None):
 
         # initialize basic variables
         self.only_vcf = only_vcf
         self.x = x_offset
         self.ploidy = ploidy
         self.read_len = read_len
-        self.sequences = [Seq(str(sequence)) for _ in range(self.ploidy)]
+        # one mutable buffer of upper case ascii bases per ploid, so mutations can be applied without copying Seqs
+        ref_bytes = str(sequence).encode()
+        self.sequences = [bytearray(ref_bytes) for _ in range(self.ploidy)]
         self.seq_len = len(sequence)
         self.indel_list = [[] for _ in range(self.ploidy)]
         self.snp_list = [[] for _ in range(self.ploidy)]
@@ -110,12 +113,19 @@ class SequenceContainer:
         self.fm_pos = [[] for _ in range(self.ploidy)]
         self.fm_span = [[] for _ in range(self.ploidy)]
 
+        # reference data for this window, kept so that the next (overlapping) window can reuse what it shares
+        # --- self.trinuc_codes[pos]: trinucleotide context code of the reference at pos (NO_TRINUC if unknown)
+        (self.ref_x, self.ref_bytes) = (None, b'')
+        self.trinuc_codes = self.window_trinuc_codes(x_offset, ref_bytes, trinuc_codes)
+
         # Blacklist explanation:
         # black_list[ploid][pos] = 0		safe to insert variant here
         # black_list[ploid][pos] = 1		indel inserted here
         # black_list[ploid][pos] = 2		snp inserted here
         # black_list[ploid][pos] = 3		invalid position for various processing reasons
-        self.black_list = [np.zeros(self.seq_len, dtype='<i4') for _ in range(self.ploidy)]
+        self.black_list = [np.zeros(self.seq_len, dtype=np.uint8) for _ in range(self.ploidy)]
+        # samplers of the positions that are still free, see free_position()
+        self.free_samplers = {}
 
         # disallow mutations to occur on window overlap points
         self.win_buffer = window_overlap
@@ -124,6 +134,7 @@ class SequenceContainer:
             self.black_list[p][-self.win_buffer - 1] = 3
 
         # initialize mutation models
+        self.mut_models_in = mut_models
         if not mut_models:
             default_model = [copy.deepcopy(DEFAULT_MODEL_1) for _ in range(self.ploidy)]
             self.model_data = default_model[:self.ploidy]
@@ -139,7 +150,7 @@ class SequenceContainer:
         if self.mut_rescale is None:
             self.mut_scalar = 1.0
         else:
-            self.mut_scalar = float(self.mut_rescale) // (mut_rate_sum / float(len(self.model_data)))
+            self.mut_scalar = float(self.mut_rescale) / (mut_rate_sum / float(len(self.model_data)))
 
         # how are mutations spread to each ploid, based on their specified mut rates?
         self.ploid_mut_frac = [float(n[0]) / mut_rate_sum for n in self.model_data]
@@ -165,6 +176,10 @@ class SequenceContainer:
                                            DiscreteDistribution(m[2], NUCL), DiscreteDistribution(m[3], NUCL)])
             self.models[-1].append([m for m in n[9]])
 
+        # positional mutation rates (-Mb) for the contig this window is on, if any
+        self.mut_rate_track = mut_rate_track
+        self.update_window_rates()
+
         # initialize poisson attributes
         self.indel_poisson, self.snp_poisson = self.init_poisson()
 
@@ -177,31 +192,31 @@ class SequenceContainer:
         #
         # note: since indels are added before snps, it's possible these positional biases aren't correctly utilized
         #       at positions affected by indels. At the moment I'm going to consider this negligible.
-        trinuc_snp_bias = [[0. for _ in range(self.seq_len)] for _ in range(self.ploidy)]
-        self.trinuc_bias = [None for _ in range(self.ploidy)]
-        for p in range(self.ploidy):
-            for i in range(self.win_buffer + 1, self.seq_len - 1):
-                trinuc_snp_bias[p][i] = self.models[p][7][ALL_IND[str(self.sequences[p][i - 1:i + 2])]]
-            self.trinuc_bias[p] = DiscreteDistribution(trinuc_snp_bias[p][self.win_buffer + 1:self.seq_len - 1],
-                                                       range(self.win_buffer + 1, self.seq_len - 1))
+        self.update_trinuc_bias()
 
         # initialize coverage attributes
         self.window_size = None
         self.coverage_distribution = None
         self.fraglen_ind_map = None
+        self.read_start_ok = None
+        self.read_keep_frac = 1.0
 
-    def update_basic_vars(self, x_offset, sequence, ploidy, window_overlap, read_len):
+    def update_basic_vars(self, x_offset, sequence, ploidy, window_overlap, read_len, trinuc_codes=None):
         self.x = x_offset
         self.ploidy = ploidy
         self.read_len = read_len
-        self.sequences = [Seq(str(sequence)) for _ in range(self.ploidy)]
+        ref_bytes = str(sequence).encode()
+        self.sequences = [bytearray(ref_bytes) for _ in range(self.ploidy)]
         self.seq_len = len(sequence)
         self.indel_list = [[] for _ in range(self.ploidy)]
         self.snp_list = [[] for _ in range(self.ploidy)]
         self.all_cigar = [[] for _ in range(self.ploidy)]
         self.fm_pos = [[] for _ in range(self.ploidy)]
         self.fm_span = [[] for _ in range(self.ploidy)]
-        self.black_list = [np.zeros(self.seq_len, dtype='<i4') for _ in range(self.ploidy)]
+        self.trinuc_codes = self.window_trinuc_codes(x_offset, ref_bytes, trinuc_codes)
+        self.black_list = [np.zeros(self.seq_len, dtype=np.uint8) for _ in range(self.ploidy)]
+        # samplers of the positions that are still free, see free_position()
+        self.free_samplers = {}
 
         # disallow mutations to occur on window overlap points
         self.win_buffer = window_overlap
@@ -209,7 +224,37 @@ class SequenceContainer:
             self.black_list[p][-self.win_buffer] = 3
             self.black_list[p][-self.win_buffer - 1] = 3
 
+    def window_trinuc_codes(self, x_offset, ref_bytes, known_codes=None) -> np.ndarray:
+        """
+        Trinucleotide context codes of the reference over a new window. Precomputed codes are used as they are,
+        unless some are unknown (e.g. next to N regions that have since been filled in). Otherwise the codes of the
+        stretch this window shares with the previous one are carried over, and only the newly exposed bases are
+        looked up.
+
+        :param x_offset: start of the new window on the contig
+        :param ref_bytes: reference sequence of the new window, as upper case ascii bytes
+        :param known_codes: precomputed codes for the new window, if any
+        :return: uint8 array with the code of every position of the window (NO_TRINUC at the two ends)
+        """
+        if known_codes is not None and not np.any(known_codes[1:-1] == NO_TRINUC):
+            codes = known_codes
+        else:
+            # the previous window's last code had no right neighbor, so only the ones before it carry over
+            offset = x_offset - self.ref_x if self.ref_x is not None else -1
+            n_shared = len(self.ref_bytes) - offset
+            if offset >= 0 and 3 <= n_shared <= len(ref_bytes) and \
+                    memoryview(self.ref_bytes)[offset:] == memoryview(ref_bytes)[:n_shared]:
+                codes = np.empty(len(ref_bytes), dtype=np.uint8)
+                codes[:n_shared - 1] = self.trinuc_codes[offset:offset + n_shared - 1]
+                codes[n_shared - 1:] = trinuc_codes(ref_bytes[n_shared - 2:])[1:]
+                codes[0] = NO_TRINUC
+            else:
+                codes = trinuc_codes(ref_bytes)
+        (self.ref_x, self.ref_bytes) = (x_offset, ref_bytes)
+        return codes
+
     def update_mut_models(self, mut_models, mut_rate):
+        self.mut_models_in = mut_models
         if not mut_models:
             default_model = [copy.deepcopy(DEFAULT_MODEL_1) for _ in range(self.ploidy)]
             self.model_data = default_model[:self.ploidy]
@@ -225,7 +270,7 @@ class SequenceContainer:
         if self.mut_rescale is None:
             self.mut_scalar = 1.0
         else:
-            self.mut_scalar = float(self.mut_rescale) // (mut_rate_sum / float(len(self.model_data)))
+            self.mut_scalar = float(self.mut_rescale) / (mut_rate_sum / float(len(self.model_data)))
 
         # how are mutations spread to each ploid, based on their specified mut rates?
         self.ploid_mut_frac = [float(n[0]) / mut_rate_sum for n in self.model_data]
@@ -240,81 +285,131 @@ class SequenceContainer:
                                            DiscreteDistribution(m[2], NUCL), DiscreteDistribution(m[3], NUCL)])
             self.models[-1].append([m for m in n[9]])
 
+    def update_window_rates(self):
+        """
+        Look up the positional mutation rates over this window. The expected number of mutations comes from the
+        track's prefix sums; the per-base rates are only kept (to bias where random mutations go) if they vary.
+        """
+        self.window_mut_total = None
+        self.window_rates = None
+        if self.mut_rate_track is None:
+            return
+        self.window_mut_total = self.mut_rate_track.total(self.x, self.x + self.seq_len)
+        window_rates = self.mut_rate_track.window_rates(self.x, self.x + self.seq_len)
+        if np.any(window_rates != window_rates[0]):
+            self.window_rates = window_rates
+
     def update_trinuc_bias(self):
-        trinuc_snp_bias = [[0. for _ in range(self.seq_len)] for _ in range(self.ploidy)]
+        """
+        Positional SNP bias from the trinucleotide context of every base, looked up in one go per ploid. This runs
+        before any mutations go in, so all ploids still share the reference sequence and its context codes.
+        trinuc_bias[ploid] holds a weight for every position of the window, zero where SNPs can't go.
+        """
+        (first, last) = (self.win_buffer + 1, self.seq_len - 1)
+        if IGNORE_TRINUC:
+            snp_weights = np.zeros(self.seq_len, dtype=np.float64)
+            snp_weights[first:last] = 1.
+            self.trinuc_bias = [snp_weights for _ in range(self.ploidy)]
+            return
+        codes = self.trinuc_codes[first:last]
         self.trinuc_bias = [None for _ in range(self.ploidy)]
         for p in range(self.ploidy):
-            for i in range(self.win_buffer + 1, self.seq_len - 1):
-                trinuc_snp_bias[p][i] = self.models[p][7][ALL_IND[str(self.sequences[p][i - 1:i + 2])]]
-            self.trinuc_bias[p] = DiscreteDistribution(trinuc_snp_bias[p][self.win_buffer + 1:self.seq_len - 1],
-                                                       range(self.win_buffer + 1, self.seq_len - 1))
-
-    def init_coverage(self, coverage_data, frag_dist=None):
+            # anything that isn't a known ACGT context (NO_TRINUC) gets no weight
+            bias_table = np.zeros(NO_TRINUC + 1, dtype=np.float64)
+            bias_table[:len(self.models[p][7])] = self.models[p][7]
+            snp_weights = np.zeros(self.seq_len, dtype=np.float64)
+            snp_weights[first:last] = bias_table[codes]
+            if self.window_rates is not None:
+                snp_weights[first:last] *= self.window_rates[first:last]
+            self.trinuc_bias[p] = snp_weights
+
+    def init_coverage(self, coverage_data, frag_dist=None, read_pos_ok=None):
         """
         Initializes coverage for the sequence container. Only makes changes if we are not in vcf-only mode.
 
-        :param coverage_data: A tuple containing the window size, gc scalars and target coverage values.
+        :param coverage_data: A tuple containing the window size, gc scalars and target coverage values (a numpy
+                              array with one value per base of the window).
         :param frag_dist: A probability distribution of the fragment size.
+        :param read_pos_ok: Optional bool array over the window's reference coordinates (plus read length + 1),
+                            True where a read may start or end. Read positions that fail it get zero weight, and
+                            self.read_keep_frac is set to the fraction of the coverage weight that is left.
         :return: Mean coverage value
         """
 
-        # TODO this section is also quite slow and will need further investigation
         # If we're only creating a vcf, skip some expensive initialization related to coverage depth
         if not self.only_vcf:
             (self.window_size, gc_scalars, target_cov_vals) = coverage_data
-            gc_cov_vals = [[] for _ in self.sequences]
-            tr_cov_vals = [[] for _ in self.sequences]
+            gc_scalars = np.asarray(gc_scalars, dtype=np.float64)
+            # the average target coverage over any reference span is a difference of two cumulative sums
+            target_cov_vals = np.asarray(target_cov_vals, dtype=np.float64)
+            target_cumulative = np.concatenate(([0.], np.cumsum(target_cov_vals)))
             avg_out = []
             self.coverage_distribution = []
+            # paired-end only, per ploid: the cumulative read coverage, and the longest fragment / fraction of the
+            # coverage weight kept for each quantized fragment length
+            self.coverage_vectors = []
+            self.fraglen_max = [{} for _ in self.sequences]
+            self.fraglen_keep_frac = [{} for _ in self.sequences]
+            self.read_start_ok = None
+            keep_fracs = []
+            if read_pos_ok is not None:
+                self.read_start_ok = []
+                # does a read starting at each haplotype position land in bounds, in reference coordinates?
+                for i in range(len(self.sequences)):
+                    fm_pos = np.minimum(np.asarray(self.fm_pos[i], dtype=np.int64), len(read_pos_ok) - 1)
+                    end_pos = np.minimum(fm_pos + self.read_len, len(read_pos_ok) - 1)
+                    self.read_start_ok.append(read_pos_ok[fm_pos] & read_pos_ok[end_pos])
             for i in range(len(self.sequences)):
+                seq_len = len(self.sequences[i])
                 # Zach implemented a change here but I can't remember if I changed it back for some reason.
                 # If second line below doesn't work, reactivate the first line.
                 # max_coord = min([len(self.sequences[i]) - self.read_len, len(self.all_cigar[i]) - self.read_len])
-                max_coord = min([len(self.sequences[i]) - self.read_len, len(self.all_cigar[i]) - 1])
+                max_coord = min([seq_len - self.read_len, len(self.all_cigar[i]) - 1])
 
                 # Trying to fix a problem wherein the above line gives a negative answer
                 if max_coord <= 0:
-                    max_coord = min([len(self.sequences[i]), len(self.all_cigar[i])])
-
-                # compute gc-bias
-                j = 0
-                while j + self.window_size < len(self.sequences[i]):
-                    gc_c = self.sequences[i][j:j + self.window_size].count('G') + \
-                           self.sequences[i][j:j + self.window_size].count('C')
-                    gc_cov_vals[i].extend([gc_scalars[gc_c]] * self.window_size)
-                    j += self.window_size
-                gc_c = self.sequences[i][-self.window_size:].count('G') + \
-                       self.sequences[i][-self.window_size:].count('C')
-                gc_cov_vals[i].extend([gc_scalars[gc_c]] * (len(self.sequences[i]) - len(gc_cov_vals[i])))
-
-                # Targeted values
-                tr_cov_vals[i].append(target_cov_vals[0])
-                prev_val = self.fm_pos[i][0]
-                for j in range(1, max_coord):
-                    if self.fm_pos[i][j] is None:
-                        tr_cov_vals[i].append(target_cov_vals[prev_val])
-                    elif self.fm_span[i][j] - self.fm_pos[i][j] <= 1:
-                        tr_cov_vals[i].append(target_cov_vals[prev_val])
-                    else:
-                        tr_cov_vals[i].append(sum(target_cov_vals[self.fm_pos[i][j]:self.fm_span[i][j]]) / float(
-                            self.fm_span[i][j] - self.fm_pos[i][j]))
-                        prev_val = self.fm_pos[i][j]
-                    # Debug statement
-                    # print(f'({i, j}), {self.all_cigar[i][j]}, {self.fm_pos[i][j]}, {self.fm_span[i][j]}')
-
-                # shift by half of read length
-                if len(tr_cov_vals[i]) > int(self.read_len / 2.):
-                    tr_cov_vals[i] = [0.0] * int(self.read_len // 2) + tr_cov_vals[i][:-int(self.read_len / 2.)]
-                # fill in missing indices
-                tr_cov_vals[i].extend([0.0] * (len(self.sequences[i]) - len(tr_cov_vals[i])))
-
-                #
-                coverage_vector = np.cumsum([tr_cov_vals[i][nnn] *
-                                             gc_cov_vals[i][nnn] for nnn in range(len(tr_cov_vals[i]))])
-                coverage_vals = []
+                    max_coord = min([seq_len, len(self.all_cigar[i])])
+
+                # compute gc-bias: the haplotype is cut into gc windows from the left (the last one lined up with the
+                # end instead), and every base gets the gc scalar of its window's G/C count
+                gc_starts = np.arange(0, seq_len - self.window_size, self.window_size)
+                last_start = seq_len - self.window_size
+                # (a window bigger than the haplotype is counted from where bytearray.count() would start it)
+                last_start = last_start if last_start >= 0 else max(last_start + seq_len, 0)
+                (window_starts, window_ends) = (np.append(gc_starts, last_start),
+                                                np.append(gc_starts + self.window_size, seq_len))
+                gc_cumulative = np.concatenate(([0], np.cumsum(IS_GC[np.frombuffer(self.sequences[i],
+                                                                                   dtype=np.uint8)])))
+                gc_c = gc_cumulative[window_ends] - gc_cumulative[window_starts]
+                gc_cov_vals = np.repeat(gc_scalars[gc_c], np.append(np.full(len(gc_starts), self.window_size),
+                                                                    seq_len - len(gc_starts) * self.window_size))
+
+                # Targeted values: the average over the reference span of a read starting at each position. Reads
+                # that span less than two reference bases take the value at the start of the last read that doesn't.
+                n_tr = max(max_coord, 1)
+                (fm_pos, fm_span) = (self.fm_pos[i][:n_tr], self.fm_span[i][:n_tr])
+                has_span = fm_span - fm_pos > 1
+                has_span[0] = False
+                prev_val = fm_pos[np.maximum.accumulate(np.where(has_span, np.arange(n_tr), 0))]
+                tr_vals = target_cov_vals[prev_val]
+                span_ends = np.minimum(fm_span[has_span], len(target_cov_vals))
+                span_starts = np.minimum(fm_pos[has_span], len(target_cov_vals))
+                tr_vals[has_span] = (target_cumulative[span_ends] - target_cumulative[span_starts]) / \
+                    (fm_span[has_span] - fm_pos[has_span])
+                tr_vals[0] = target_cov_vals[0]
+
+                # shift by half of read length, and fill in missing indices
+                tr_cov_vals = np.zeros(seq_len, dtype=np.float64)
+                half_read = int(self.read_len // 2)
+                if n_tr > half_read:
+                    tr_cov_vals[half_read:n_tr] = tr_vals[:n_tr - half_read]
+                else:
+                    tr_cov_vals[:n_tr] = tr_vals
+
+                # coverage of a read starting at each position is a difference of two cumulative sums
+                coverage_vector = np.cumsum(tr_cov_vals * gc_cov_vals)
                 # TODO if max_coord is <=0, this is a problem
-                for j in range(0, max_coord):
-                    coverage_vals.append(coverage_vector[j + self.read_len] - coverage_vector[j])
+                coverage_vals = coverage_vector[self.read_len:self.read_len + max_coord] - coverage_vector[:max_coord]
                 # Below is Zach's attempt to fix this. The commented out line is the original
                 # avg_out.append(np.mean(coverage_vals) / float(self.read_len))
                 avg_out.append(np.mean(coverage_vals)/float(min([self.read_len, max_coord])))
@@ -325,96 +420,96 @@ class SequenceContainer:
                     # Debug statement
                     # print(f'++++, {max_coord}, {len(self.sequences[i])}, '
                     #       f'{len(self.all_cigar[i])}, {len(coverage_vals)}')
-                    self.coverage_distribution.append(DiscreteDistribution(coverage_vals, range(len(coverage_vals))))
-
-                # fragment length nightmare
+                    if self.read_start_ok is not None:
+                        (coverage_vals, keep_frac) = mask_weights(coverage_vals,
+                                                                  self.read_start_ok[i][:len(coverage_vals)])
+                        keep_fracs.append(keep_frac)
+                    self.coverage_distribution.append(ArrayDistribution(coverage_vals, range(len(coverage_vals))))
+
+                # fragment length nightmare: one table of read-pair start positions per quantized fragment length,
+                # each built the first time a fragment of that length is drawn (see fraglen_coverage)
                 else:
-                    current_thresh = 0.
-                    index_list = [0]
-                    for j in range(len(frag_dist.cum_prob)):
-                        if frag_dist.cum_prob[j] >= current_thresh + COV_FRAGLEN_PERCENTILE / 100.0:
-                            current_thresh = frag_dist.cum_prob[j]
-                            index_list.append(j)
-                    flq = [frag_dist.values[nnn] for nnn in index_list]
-                    if frag_dist.values[-1] not in flq:
-                        flq.append(frag_dist.values[-1])
-                    flq.append(LARGE_NUMBER)
-
-                    self.fraglen_ind_map = {}
-                    for j in frag_dist.values:
-                        b_ind = bisect.bisect(flq, j)
-                        if abs(flq[b_ind - 1] - j) <= abs(flq[b_ind] - j):
-                            self.fraglen_ind_map[j] = flq[b_ind - 1]
-                        else:
-                            self.fraglen_ind_map[j] = flq[b_ind]
-
+                    (self.fraglen_ind_map, fraglen_bins) = quantize_fraglens(frag_dist)
+                    self.coverage_vectors.append(coverage_vector)
                     self.coverage_distribution.append({})
-                    for flv in sorted(list(set(self.fraglen_ind_map.values()))):
-                        buffer_val = self.read_len
-                        for j in frag_dist.values:
-                            if self.fraglen_ind_map[j] == flv and j > buffer_val:
-                                buffer_val = j
-                        max_coord = min([len(self.sequences[i]) - buffer_val - 1,
-                                         len(self.all_cigar[i]) - buffer_val + self.read_len - 2])
-                        # print 'BEFORE:', len(self.sequences[i])-buffer_val
-                        # print 'AFTER: ', len(self.all_cigar[i])-buffer_val+self.read_len-2
-                        # print 'AFTER2:', max_coord
-                        coverage_vals = []
-                        for j in range(0, max_coord):
-                            coverage_vals.append(
-                                coverage_vector[j + self.read_len] - coverage_vector[j] + coverage_vector[j + flv] -
-                                coverage_vector[
-                                    j + flv - self.read_len])
-
-                        # EXPERIMENTAL
-                        # quantized_cov_vals = quantize_list(coverage_vals)
-                        # self.coverage_distribution[i][flv] = \
-                        #     DiscreteDistribution([n[2] for n in quantized_cov_vals],
-                        #                          [(n[0], n[1]) for n in quantized_cov_vals])
-
-                        # TESTING
-                        # import matplotlib.pyplot as mpl
-                        # print len(coverage_vals),'-->',len(quantized_cov_vals)
-                        # mpl.figure(0)
-                        # mpl.plot(range(len(coverage_vals)), coverage_vals)
-                        # for qcv in quantized_cov_vals:
-                        # mpl.plot([qcv[0], qcv[1]+1], [qcv[2],qcv[2]], 'r')
-                        # mpl.show()
-                        # sys.exit(1)
-
-                        self.coverage_distribution[i][flv] = DiscreteDistribution(coverage_vals,
-                                                                                  range(len(coverage_vals)))
-
+                    self.fraglen_max[i] = {flv: max_fraglen for (flv, max_fraglen, _) in fraglen_bins}
+                    # reads we'd throw away are masked out of every table, so we need them all up front to know
+                    # how many reads are left
+                    if self.read_start_ok is not None:
+                        keep_frac = 0.
+                        for (flv, _, flv_weight) in fraglen_bins:
+                            self.fraglen_coverage(i, flv)
+                            # weighted by how likely fragments of this (quantized) length are
+                            keep_frac += self.fraglen_keep_frac[i][flv] * flv_weight
+                        keep_fracs.append(keep_frac)
+
+            self.read_keep_frac = np.mean(keep_fracs) if self.read_start_ok is not None else 1.0
             return np.mean(avg_out)
 
+    def fraglen_coverage(self, ploid, flv) -> ArrayDistribution:
+        """
+        Distribution of start positions for read pairs from fragments of a quantized length, built the first time
+        it's needed. A pair's coverage is that of its two reads, taken from the cumulative coverage vector.
+
+        :param ploid: which ploid
+        :param flv: quantized fragment length
+        :return: ArrayDistribution over the start position of the first read
+        """
+        if flv not in self.coverage_distribution[ploid]:
+            buffer_val = max(self.read_len, self.fraglen_max[ploid][flv])
+            max_coord = max(min([len(self.sequences[ploid]) - buffer_val - 1,
+                                 len(self.all_cigar[ploid]) - buffer_val + self.read_len - 2]), 0)
+            (coverage_vector, mate_start) = (self.coverage_vectors[ploid], flv - self.read_len)
+            coverage_vals = coverage_vector[self.read_len:self.read_len + max_coord] - coverage_vector[:max_coord] + \
+                coverage_vector[flv:flv + max_coord] - coverage_vector[mate_start:mate_start + max_coord]
+            if self.read_start_ok is not None:
+                pair_ok = self.read_start_ok[ploid][:len(coverage_vals)] & \
+                    self.read_start_ok[ploid][flv - self.read_len:flv - self.read_len + len(coverage_vals)]
+                (coverage_vals, self.fraglen_keep_frac[ploid][flv]) = mask_weights(coverage_vals, pair_ok)
+            self.coverage_distribution[ploid][flv] = ArrayDistribution(coverage_vals, range(len(coverage_vals)))
+        return self.coverage_distribution[ploid][flv]
+
     def init_poisson(self):
-        ind_l_list = [self.seq_len * self.models[i][0] * self.models[i][2] * self.ploid_mut_frac[i] for i in
-                      range(len(self.models))]
-        snp_l_list = [self.seq_len * self.models[i][0] * (1. - self.models[i][2]) * self.ploid_mut_frac[i] for i in
+        # expected number of mutations in the window for each ploid's model, from the positional rates if we have them
+        if self.window_mut_total is None:
+            window_muts = [self.seq_len * n[0] for n in self.models]
+        else:
+            mean_rate = sum([n[0] for n in self.model_data]) / float(len(self.model_data))
+            window_muts = [self.window_mut_total * n[0] / mean_rate for n in self.model_data]
+        ind_l_list = [window_muts[i] * self.models[i][2] * self.ploid_mut_frac[i] for i in range(len(self.models))]
+        snp_l_list = [window_muts[i] * (1. - self.models[i][2]) * self.ploid_mut_frac[i] for i in
                       range(len(self.models))]
-        k_range = range(int(self.seq_len * MAX_MUTFRAC))
+        max_k = int(self.seq_len * MAX_MUTFRAC)
         # return (indel_poisson, snp_poisson)
-        # TODO These next two lines are really slow. Maybe there's a better way
-        return [poisson_list(k_range, ind_l_list[n]) for n in range(len(self.models))], \
-               [poisson_list(k_range, snp_l_list[n]) for n in range(len(self.models))]
-
-    def update(self, x_offset, sequence, ploidy, window_overlap, read_len, mut_models=None, mut_rate=None):
-        # if mutation model is changed, we have to reinitialize it...
-        if ploidy != self.ploidy or mut_rate != self.mut_rescale or mut_models is not None:
+        return [poisson_sampler(max_k, ind_l_list[n]) for n in range(len(self.models))], \
+               [poisson_sampler(max_k, snp_l_list[n]) for n in range(len(self.models))]
+
+    def update(self, x_offset, sequence, ploidy, window_overlap, read_len, mut_models=None, mut_rate=None,
+               trinuc_codes=None, mut_rate_track=None):
+        # if mutation model is changed, we have to reinitialize it... (the same model objects as last time can be kept)
+        models_changed = mut_models is not None and \
+            (self.mut_models_in is None or len(mut_models) != len(self.mut_models_in) or
+             any([m is not n for (m, n) in zip(mut_models, self.mut_models_in)]))
+        if ploidy != self.ploidy or mut_rate != self.mut_rescale or models_changed:
             self.ploidy = ploidy
             self.mut_rescale = mut_rate
             self.update_mut_models(mut_models, mut_rate)
         # if sequence length is different than previous window, we have to redo snp/indel poissons
-        if len(sequence) != self.seq_len:
-            self.seq_len = len(sequence)
-            self.indel_poisson, self.snp_poisson = self.init_poisson()
+        redo_poisson = len(sequence) != self.seq_len
         # basic vars
-        self.update_basic_vars(x_offset, sequence, ploidy, window_overlap, read_len)
+        self.update_basic_vars(x_offset, sequence, ploidy, window_overlap, read_len, trinuc_codes)
+        # ...and likewise if the positional mutation rates give this window a different expected number of mutations
+        if mut_rate_track is not None or self.mut_rate_track is not None:
+            prev_mut_total = self.window_mut_total
+            self.mut_rate_track = mut_rate_track
+            self.update_window_rates()
+            redo_poisson = redo_poisson or self.window_mut_total != prev_mut_total
+        if redo_poisson:
+            self.indel_poisson, self.snp_poisson = self.init_poisson()
         self.indels_to_add = [n.sample() for n in self.indel_poisson]
         self.snps_to_add = [n.sample() for n in self.snp_poisson]
         # initialize trinuc snp bias
-        if not IGNORE_TRINUC:
-            self.update_trinuc_bias()
+        self.update_trinuc_bias()
 
     def insert_mutations(self, input_list):
         for input_variable in input_list:
@@ -465,22 +560,46 @@ class SequenceContainer:
                     self.snp_list[p].append(my_var)
                     self.black_list[p][my_var[0]] = 2
                 else:
-                    indel_failed = False
-                    for k in range(my_var[0], my_var[0] + in_len):
-                        if k >= len(self.black_list[p]):
-                            indel_failed = True
-                            continue
-                        if self.black_list[p][k]:
-                            indel_failed = True
-                            continue
-                    if indel_failed:
+                    # indels that run off the end of the window or hit anything already placed are skipped
+                    if my_var[0] + in_len > self.seq_len or self.black_list[p][my_var[0]:my_var[0] + in_len].any():
                         continue
-                    for k in range(my_var[0], my_var[0] + in_len):
-                        self.black_list[p][k] = 1
+                    self.black_list[p][my_var[0]:my_var[0] + in_len] = 1
                     self.indel_list[p].append(my_var)
 
+    def free_position(self, key, weights, which_ploid) -> int:
+        """
+        Pick a position that is still free on all of the given ploids, with probability proportional to its weight.
+        The sampler built for each (key, ploids) pair is kept for the rest of the window, and positions that have
+        been taken since it was built are dropped from it the first time they come up, so a taken position costs at
+        most one wasted draw and there's no cap on attempts.
+
+        :param key: which set of weights this is, e.g. ('snp', ploid)
+        :param weights: numpy array with a weight for every position of the window (only read the first time a
+                        key is used with these ploids)
+        :param which_ploid: ploids the position has to be free on
+        :return: position in the window, or -1 if there's nothing left
+        """
+        ploids = tuple(which_ploid)
+        sampler = self.free_samplers.get((key, ploids))
+        if sampler is None:
+            free = np.logical_and.reduce([self.black_list[p] == 0 for p in ploids])
+            sampler = FenwickSampler(np.where(free, weights, 0.))
+            self.free_samplers[(key, ploids)] = sampler
+        while True:
+            event_pos = sampler.sample()
+            if event_pos == -1 or not any([self.black_list[p][event_pos] for p in ploids]):
+                return event_pos
+            sampler.remove(event_pos)
+
     def random_mutations(self):
 
+        # indels can go anywhere past the start of the window, following the positional mutation rates (if any)
+        indel_weights = np.zeros(self.seq_len, dtype=np.float64)
+        if self.window_rates is None:
+            indel_weights[self.win_buffer:] = 1.
+        else:
+            indel_weights[self.win_buffer:] = self.window_rates[self.win_buffer:]
+
         # add random indels
         all_indels = [[] for _ in self.sequences]
         for i in range(self.ploidy):
@@ -492,15 +611,8 @@ class SequenceContainer:
                 else:
                     which_ploid = [self.ploid_mut_prior.sample()]
 
-                # try to find suitable places to insert indels
-                event_pos = -1
-                for attempt in range(MAX_ATTEMPTS):
-                    event_pos = random.randint(self.win_buffer, self.seq_len - 1)
-                    for p in which_ploid:
-                        if self.black_list[p][event_pos]:
-                            event_pos = -1
-                    if event_pos != -1:
-                        break
+                # find a suitable place to insert the indel
+                event_pos = self.free_position('indel', indel_weights, which_ploid)
                 if event_pos == -1:
                     continue
 
@@ -509,7 +621,7 @@ class SequenceContainer:
                     in_len = self.models[i][4].sample()
                     # sequence content of random insertions is uniformly random (change this later, maybe)
                     in_seq = ''.join([random.choice(NUCL) for _ in range(in_len)])
-                    ref_nucl = self.sequences[i][event_pos]
+                    ref_nucl = chr(self.sequences[i][event_pos])
                     my_indel = (event_pos, ref_nucl, ref_nucl + in_seq)
                 # deletion
                 else:
@@ -517,11 +629,8 @@ class SequenceContainer:
                     # skip if deletion too close to boundary
                     if event_pos + in_len + 1 >= len(self.sequences[i]):
                         continue
-                    if in_len == 1:
-                        in_seq = self.sequences[i][event_pos + 1]
-                    else:
-                        in_seq = str(self.sequences[i][event_pos + 1:event_pos + in_len + 1])
-                    ref_nucl = self.sequences[i][event_pos]
+                    in_seq = self.sequences[i][event_pos + 1:event_pos + in_len + 1].decode()
+                    ref_nucl = chr(self.sequences[i][event_pos])
                     my_indel = (event_pos, ref_nucl + in_seq, ref_nucl)
 
                 # if event too close to boundary, skip. if event conflicts with other indel, skip.
@@ -530,16 +639,11 @@ class SequenceContainer:
                     skip_event = True
                 if skip_event:
                     continue
-                for p in which_ploid:
-                    for k in range(event_pos, event_pos + in_len + 1):
-                        if self.black_list[p][k]:
-                            skip_event = True
-                if skip_event:
+                if any([self.black_list[p][event_pos:event_pos + in_len + 1].any() for p in which_ploid]):
                     continue
 
                 for p in which_ploid:
-                    for k in range(event_pos, event_pos + in_len + 1):
-                        self.black_list[p][k] = 1
+                    self.black_list[p][event_pos:event_pos + in_len + 1] = 1
                     all_indels[p].append(my_indel)
 
         # add random snps
@@ -553,26 +657,15 @@ class SequenceContainer:
                 else:
                     which_ploid = [self.ploid_mut_prior.sample()]
 
-                # try to find suitable places to insert snps
-                event_pos = -1
-                for attempt in range(MAX_ATTEMPTS):
-                    # based on the mutation model for the specified ploid, choose a SNP location based on trinuc bias
-                    # (if there are multiple ploids, choose one at random)
-                    if IGNORE_TRINUC:
-                        event_pos = random.randint(self.win_buffer + 1, self.seq_len - 2)
-                    else:
-                        ploid_to_use = which_ploid[random.randint(0, len(which_ploid) - 1)]
-                        event_pos = self.trinuc_bias[ploid_to_use].sample()
-                    for p in which_ploid:
-                        if self.black_list[p][event_pos]:
-                            event_pos = -1
-                    if event_pos != -1:
-                        break
+                # based on the mutation model for the specified ploid, choose a SNP location based on trinuc bias
+                # (if there are multiple ploids, choose one at random)
+                ploid_to_use = which_ploid[random.randint(0, len(which_ploid) - 1)]
+                event_pos = self.free_position(('snp', ploid_to_use), self.trinuc_bias[ploid_to_use], which_ploid)
                 if event_pos == -1:
                     continue
 
-                ref_nucl = self.sequences[i][event_pos]
-                context = str(self.sequences[i][event_pos - 1]) + str(self.sequences[i][event_pos + 1])
+                ref_nucl = chr(self.sequences[i][event_pos])
+                context = chr(self.sequences[i][event_pos - 1]) + chr(self.sequences[i][event_pos + 1])
                 # sample from tri-nucleotide substitution matrices to get SNP alt allele
                 new_nucl = self.models[i][6][TRI_IND[context]][NUC_IND[ref_nucl]].sample()
                 my_snp = (event_pos, ref_nucl, new_nucl)
@@ -586,20 +679,17 @@ class SequenceContainer:
             all_snps[p].extend(self.snp_list[p])
             all_snps[p] = [n for n in all_snps[p] if self.black_list[p][n[0]] != 1]
 
-        # MODIFY REFERENCE STRING: SNPS
+        # MODIFY REFERENCE STRING: SNPS (in place)
         for i in range(len(all_snps)):
-            temp = self.sequences[i].tomutable()
             for j in range(len(all_snps[i])):
                 v_pos = all_snps[i][j][0]
 
-                if all_snps[i][j][1] != temp[v_pos]:
-                    print('\nError: Something went wrong!\n', all_snps[i][j], temp[v_pos], '\n')
+                if all_snps[i][j][1] != chr(self.sequences[i][v_pos]):
+                    print('\nError: Something went wrong!\n', all_snps[i][j], chr(self.sequences[i][v_pos]), '\n')
                     print(all_snps[i][j])
-                    print(self.sequences[i][v_pos])
                     sys.exit(1)
                 else:
-                    temp[v_pos] = all_snps[i][j][2]
-            self.sequences[i] = temp.toseq()
+                    self.sequences[i][v_pos] = ord(all_snps[i][j][2])
 
         # organize the indels we want to insert
         for i in range(len(all_indels)):
@@ -607,51 +697,52 @@ class SequenceContainer:
         all_indels_ins = [sorted([list(m) for m in n]) for n in all_indels]
 
         # MODIFY REFERENCE STRING: INDELS
+        # (the indels are sorted and don't overlap, so the new sequence is spliced together in a single pass)
         for i in range(len(all_indels_ins)):
             rolling_adj = 0
-            temp_symbol_list = CigarString.string_to_list(str(len(self.sequences[i])) + "M")
+            temp_symbol_list = ExpandedCigar(len(self.sequences[i]))
+            ref_view = memoryview(self.sequences[i])
+            new_sequence = bytearray()
+            prev_end = 0
 
             for j in range(len(all_indels_ins[i])):
-                v_pos = all_indels_ins[i][j][0] + rolling_adj
+                ref_pos = all_indels_ins[i][j][0]
+                ref_end = ref_pos + len(all_indels_ins[i][j][1])
+                v_pos = ref_pos + rolling_adj
                 v_pos2 = v_pos + len(all_indels_ins[i][j][1])
                 indel_length = len(all_indels_ins[i][j][2]) - len(all_indels_ins[i][j][1])
                 rolling_adj += indel_length
 
-                if all_indels_ins[i][j][1] != str(self.sequences[i][v_pos:v_pos2]):
+                if ref_pos < prev_end or all_indels_ins[i][j][1].encode() != ref_view[ref_pos:ref_end]:
                     print('\nError: Something went wrong!\n', all_indels_ins[i][j], [v_pos, v_pos2],
-                          str(self.sequences[i][v_pos:v_pos2]), '\n')
+                          self.sequences[i][ref_pos:ref_end].decode(), '\n')
                     sys.exit(1)
                 else:
                     # alter reference sequence
-                    self.sequences[i] = self.sequences[i][:v_pos] + Seq(all_indels_ins[i][j][2]) + \
-                                        self.sequences[i][v_pos2:]
+                    new_sequence += ref_view[prev_end:ref_pos]
+                    new_sequence += all_indels_ins[i][j][2].encode()
+                    prev_end = ref_end
                     # notate indel positions for cigar computation
                     if indel_length > 0:
-                        temp_symbol_list = temp_symbol_list[:v_pos + 1] + ['I'] * indel_length \
-                                              + temp_symbol_list[v_pos2 + 1:]
+                        temp_symbol_list.replace(v_pos + 1, v_pos2 + 1, ['I'] * indel_length)
                     elif indel_length < 0:
-                        temp_symbol_list[v_pos + 1] = "D" * abs(indel_length) + "M"
+                        temp_symbol_list.set_symbol(v_pos + 1, "D" * abs(indel_length) + "M")
+
+            new_sequence += ref_view[prev_end:]
+            ref_view.release()
+            self.sequences[i] = new_sequence
 
-            # pre-compute cigar strings
-            for j in range(len(temp_symbol_list) - self.read_len):
-                self.all_cigar[i].append(temp_symbol_list[j:j + self.read_len])
+            # cigar strings of reads starting at each position, built when a read is actually sampled there
+            self.all_cigar[i] = ReadCigars(temp_symbol_list, self.read_len)
 
             # create some data structures we will need later:
             # --- self.fm_pos[ploid][pos]: position of the left-most matching base (IN REFERENCE COORDINATES, i.e.
             #       corresponding to the unmodified reference genome)
             # --- self.fm_span[ploid][pos]: number of reference positions spanned by a read originating from
             #       this coordinate
-            md_so_far = 0
-            for j in range(len(temp_symbol_list)):
-                self.fm_pos[i].append(md_so_far)
-                # fix an edge case with deletions
-                if 'D' in temp_symbol_list[j]:
-                    self.fm_pos[i][-1] += temp_symbol_list[j].count('D')
-                # compute number of ref matches for each read
-                # This line gets hit a lot and is relatively slow. Might look for an improvement
-                span_dif = len([n for n in temp_symbol_list[j: j + self.read_len] if 'M' in n])
-                self.fm_span[i].append(self.fm_pos[i][-1] + span_dif)
-                md_so_far += temp_symbol_list[j].count('M') + temp_symbol_list[j].count('D')
+            (fm_pos, fm_span) = temp_symbol_list.ref_positions(self.read_len)
+            self.fm_pos[i] = fm_pos
+            self.fm_span[i] = fm_span
 
         # tally up all the variants we handled...
         count_dict = {}
@@ -688,22 +779,29 @@ class SequenceContainer:
         reads_to_sample = []
         if frag_len is None:
             r_pos = self.coverage_distribution[my_ploid].sample()
+            # nowhere in bounds to put a read on this ploid
+            if self.read_start_ok is not None and not self.read_start_ok[my_ploid][r_pos]:
+                return None
 
             # sample read position and call function to compute quality scores / sequencing errors
-            r_dat = self.sequences[my_ploid][r_pos:r_pos + self.read_len]
+            r_dat = Seq(self.sequences[my_ploid][r_pos:r_pos + self.read_len].decode())
             (my_qual, my_errors) = sequencing_model.get_sequencing_errors(r_dat)
             reads_to_sample.append([r_pos, my_qual, my_errors, r_dat])
 
         else:
-            r_pos1 = self.coverage_distribution[my_ploid][self.fraglen_ind_map[frag_len]].sample()
+            r_pos1 = self.fraglen_coverage(my_ploid, self.fraglen_ind_map[frag_len]).sample()
 
             # EXPERIMENTAL
             # coords_to_select_from = self.coverage_distribution[my_ploid][self.fraglens_ind_map[frag_len]].sample()
             # r_pos1 = random.randint(coords_to_select_from[0],coords_to_select_from[1])
 
             r_pos2 = r_pos1 + frag_len - self.read_len
-            r_dat1 = self.sequences[my_ploid][r_pos1:r_pos1 + self.read_len]
-            r_dat2 = self.sequences[my_ploid][r_pos2:r_pos2 + self.read_len]
+            # the distribution was built for the quantized fragment length, so the mate may still be out of bounds
+            if self.read_start_ok is not None and not (self.read_start_ok[my_ploid][r_pos1] and
+                                                       self.read_start_ok[my_ploid][r_pos2]):
+                return None
+            r_dat1 = Seq(self.sequences[my_ploid][r_pos1:r_pos1 + self.read_len].decode())
+            r_dat2 = Seq(self.sequences[my_ploid][r_pos2:r_pos2 + self.read_len].decode())
             (my_qual1, my_errors1) = sequencing_model.get_sequencing_errors(r_dat1)
             (my_qual2, my_errors2) = sequencing_model.get_sequencing_errors(r_dat2, is_reverse_strand=True)
             reads_to_sample.append([r_pos1, my_qual1, my_errors1, r_dat1])
@@ -733,7 +831,7 @@ class SequenceContainer:
             avail_b = len(self.sequences[my_ploid]) - read[0] - self.read_len - 1
 
             # add buffer sequence to fill in positions that get deleted
-            read[3] += self.sequences[my_ploid][read[0] + self.read_len:read[0] + self.read_len + total_d]
+            read[3] += self.sequences[my_ploid][read[0] + self.read_len:read[0] + self.read_len + total_d].decode()
             # this is leftover code and a patch for a method that isn't used. There is probably a better
             # way to structure this than with a boolean
             first_time = True
@@ -829,9 +927,7 @@ class SequenceContainer:
 
                 else:  # substitution errors, much easier by comparison...
                     if str(read[3][e_pos + sse_adj[e_pos]]) == error[3]:
-                        temp = read[3].tomutable()
-                        temp[e_pos + sse_adj[e_pos]] = error[4]
-                        read[3] = temp.toseq()
+                        read[3] = read[3][:e_pos + sse_adj[e_pos]] + error[4] + read[3][e_pos + sse_adj[e_pos] + 1:]
                     else:
                         print('\nError, ref does not match alt while attempting to insert substitution error!\n')
                         sys.exit(1)
@@ -842,7 +938,7 @@ class SequenceContainer:
 
                 read[3] = read[3][:self.read_len]
 
-            read_out.append([self.fm_pos[my_ploid][read[0]], my_cigar, read[3], str(read[1])])
+            read_out.append([int(self.fm_pos[my_ploid][read[0]]), my_cigar, read[3], str(read[1])])
 
         # read_out[i] = (pos, cigar, read_string, qual_string)
         return read_out
@@ -1061,6 +1157,57 @@ class ReadContainer:
         return q_out, s_out
 
 
+def mask_weights(weights, keep) -> tuple:
+    """
+    Zero out the weights that fail a mask
+
+    :param weights: list or array of weights
+    :param keep: bool array, same length as weights
+    :return: masked weights (as an array), fraction of the total weight that was kept
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    total = float(np.sum(weights))
+    weights = np.where(keep, weights, 0.)
+    return weights, float(np.sum(weights)) / total if total > 0 else 0.
+
+
+@functools.lru_cache(maxsize=None)
+def quantize_fraglens(frag_dist) -> tuple:
+    """
+    Quantize fragment lengths to every COV_FRAGLEN_PERCENTILE percentile of the distribution, so that coverage
+    tables only have to be built for a handful of lengths. Only depends on the distribution, so it's done once.
+
+    :param frag_dist: DiscreteDistribution of fragment lengths
+    :return: dict of fragment length --> quantized length, and a list of (quantized length, longest fragment length
+             that maps to it, summed probability of the fragment lengths that map to it), sorted by quantized length
+    """
+    current_thresh = 0.
+    index_list = [0]
+    for j in range(len(frag_dist.cum_prob)):
+        if frag_dist.cum_prob[j] >= current_thresh + COV_FRAGLEN_PERCENTILE / 100.0:
+            current_thresh = frag_dist.cum_prob[j]
+            index_list.append(j)
+    flq = [frag_dist.values[nnn] for nnn in index_list]
+    if frag_dist.values[-1] not in flq:
+        flq.append(frag_dist.values[-1])
+    flq.append(LARGE_NUMBER)
+
+    fraglen_ind_map = {}
+    for j in frag_dist.values:
+        b_ind = bisect.bisect(flq, j)
+        if abs(flq[b_ind - 1] - j) <= abs(flq[b_ind] - j):
+            fraglen_ind_map[j] = flq[b_ind - 1]
+        else:
+            fraglen_ind_map[j] = flq[b_ind]
+
+    fraglen_bins = []
+    for flv in sorted(set(fraglen_ind_map.values())):
+        in_bin = [j for j in range(len(frag_dist.values)) if fraglen_ind_map[frag_dist.values[j]] == flv]
+        fraglen_bins.append((flv, max([frag_dist.values[j] for j in in_bin]),
+                             sum([frag_dist.weights[j] for j in in_bin])))
+    return fraglen_ind_map, fraglen_bins
+
+
 # parse mutation model pickle file
 def parse_input_mutation_model(model=None, which_default=1):
     if which_default == 1:
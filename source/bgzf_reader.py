@@ -0,0 +1,161 @@
+"""
+Random access into bgzip-compressed files (e.g. a bgzipped reference) through a .gzi block index, as written by
+bgzip -i / samtools faidx. Only the blocks overlapping a requested range are read, and they are inflated on a
+thread pool (zlib releases the GIL while it decompresses).
+
+BGZF is a series of gzip members ("blocks") of at most 64 KiB each. Each block header carries its own compressed
+size in a 'BC' extra field, and each block ends with its uncompressed size, so the block layout can be recovered
+without decompressing anything. The .gzi file is: number of entries (uint64), then (compressed offset,
+uncompressed offset) pairs (uint64) for every block after the first.
+"""
+
+import os
+import bisect
+import struct
+import pathlib
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+BGZF_HEADER_SIZE = 18
+GZI_SUFFIX = '.gzi'
+# no point in spinning up more threads than this for the amount of data we read at once
+MAX_BGZF_THREADS = 8
+
+
+def is_bgzf(file_path) -> bool:
+    """
+    Check whether a file is bgzip-compressed (rather than plain gzip)
+
+    :param file_path: path to the file
+    :return: True if the first block carries a BGZF 'BC' extra field
+    """
+    with open(file_path, 'rb') as f:
+        header = f.read(BGZF_HEADER_SIZE)
+    return len(header) == BGZF_HEADER_SIZE and header[:4] == BGZF_MAGIC and header[12:14] == b'BC'
+
+
+def scan_bgzf_blocks(file_path) -> list:
+    """
+    Walk the block headers of a BGZF file
+
+    :param file_path: path to the file
+    :return: list of (compressed offset, uncompressed offset) for every block, starting with (0, 0)
+    """
+    blocks = []
+    compressed_offset = 0
+    uncompressed_offset = 0
+    with open(file_path, 'rb') as f:
+        while True:
+            header = f.read(BGZF_HEADER_SIZE)
+            if len(header) < BGZF_HEADER_SIZE:
+                break
+            if header[:4] != BGZF_MAGIC or header[12:14] != b'BC':
+                raise ValueError('not a valid BGZF block at offset ' + str(compressed_offset))
+            block_size = struct.unpack('<H', header[16:18])[0] + 1
+            f.seek(compressed_offset + block_size - 4)
+            (block_uncompressed_size,) = struct.unpack('<I', f.read(4))
+            # empty blocks (e.g. the end-of-file marker) hold no data, so leave them out like htslib does
+            if block_uncompressed_size or not blocks:
+                blocks.append((compressed_offset, uncompressed_offset))
+            compressed_offset += block_size
+            uncompressed_offset += block_uncompressed_size
+    return blocks
+
+
+def read_gzi(gzi_path) -> list:
+    """
+    :param gzi_path: path to a .gzi index
+    :return: list of (compressed offset, uncompressed offset) for every block, starting with (0, 0)
+    """
+    with open(gzi_path, 'rb') as f:
+        (n_entries,) = struct.unpack('<Q', f.read(8))
+        offsets = struct.unpack('<' + 'Q' * 2 * n_entries, f.read(16 * n_entries))
+    return [(0, 0)] + list(zip(offsets[0::2], offsets[1::2]))
+
+
+def write_gzi(gzi_path, blocks):
+    """
+    :param gzi_path: where to write the .gzi index
+    :param blocks: list of (compressed offset, uncompressed offset) for every block, starting with (0, 0)
+    """
+    entries = blocks[1:]
+    with open(gzi_path, 'wb') as f:
+        f.write(struct.pack('<Q', len(entries)))
+        f.write(struct.pack('<' + 'Q' * 2 * len(entries), *[n for block in entries for n in block]))
+
+
+def inflate_block(block_data: bytes) -> bytes:
+    """
+    :param block_data: one complete BGZF block
+    :return: its uncompressed contents
+    """
+    header_size = BGZF_HEADER_SIZE + struct.unpack('<H', block_data[10:12])[0] - 6
+    return zlib.decompress(block_data[header_size:-8], -15)
+
+
+class BgzfReader:
+    """
+    Reads arbitrary uncompressed byte ranges out of a BGZF file
+    """
+
+    def __init__(self, file_path, threads=None):
+        self.file_path = pathlib.Path(file_path)
+        self.file_size = self.file_path.stat().st_size
+
+        gzi_path = self.file_path.with_suffix(self.file_path.suffix + GZI_SUFFIX)
+        if gzi_path.is_file() and gzi_path.stat().st_mtime >= self.file_path.stat().st_mtime:
+            blocks = read_gzi(gzi_path)
+        else:
+            print('Block index not found, creating one... ')
+            blocks = scan_bgzf_blocks(self.file_path)
+            try:
+                write_gzi(gzi_path, blocks)
+            except OSError:
+                print('Warning: could not write block index to ' + str(gzi_path))
+        self.compressed_offsets = [n[0] for n in blocks]
+        self.uncompressed_offsets = [n[1] for n in blocks]
+
+        if threads is None:
+            threads = min(MAX_BGZF_THREADS, os.cpu_count() or 1)
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self.file = open(self.file_path, 'rb')
+
+    def read(self, offset, length) -> bytes:
+        """
+        Read uncompressed data, touching only the blocks that overlap it
+
+        :param offset: uncompressed byte offset to start reading from
+        :param length: number of uncompressed bytes to read
+        :return: the data (shorter than length if we hit the end of the file)
+        """
+        if length <= 0:
+            return b''
+        first_block = max(0, bisect.bisect(self.uncompressed_offsets, offset) - 1)
+        last_block = max(0, bisect.bisect(self.uncompressed_offsets, offset + length - 1) - 1)
+        compressed_start = self.compressed_offsets[first_block]
+        if last_block + 1 < len(self.compressed_offsets):
+            compressed_end = self.compressed_offsets[last_block + 1]
+        else:
+            compressed_end = self.file_size
+
+        self.file.seek(compressed_start)
+        compressed = self.file.read(compressed_end - compressed_start)
+        block_data = []
+        for i in range(first_block, last_block + 1):
+            block_end = self.compressed_offsets[i + 1] if i + 1 < len(self.compressed_offsets) else self.file_size
+            block_data.append(compressed[self.compressed_offsets[i] - compressed_start:block_end - compressed_start])
+
+        if self.executor is not None and len(block_data) > 1:
+            uncompressed = b''.join(self.executor.map(inflate_block, block_data))
+        else:
+            uncompressed = b''.join([inflate_block(n) for n in block_data])
+
+        skip = offset - self.uncompressed_offsets[first_block]
+        return uncompressed[skip:skip + length]
+
+    def close(self):
+        self.file.close()
+        if self.executor is not None:
+            self.executor.shutdown()
@@ -0,0 +1,73 @@
+"""
+Positional mutation rates (-Mb). Along a contig the rate is piecewise constant: the rate given for each BED region
+inside it, and the base rate everywhere else. A MutRateTrack stores just the breakpoints between those pieces and the
+cumulative rate at each breakpoint, so the expected number of mutations in any stretch of the contig is a difference
+of two prefix sums, and per-base rates are only ever expanded for the window being simulated.
+"""
+
+import numpy as np
+
+
+class MutRateTrack:
+    """
+    Cumulative mutation rate track for a single contig
+    """
+
+    def __init__(self, regions, base_rate, seq_len):
+        """
+        :param regions: list of (start, end, rate) tuples, 0-based half-open. Where regions overlap, the one that
+                        starts first keeps the overlap.
+        :param base_rate: mutation rate outside of the regions
+        :param seq_len: length of the contig
+        """
+        starts = []
+        rates = []
+        pos = 0
+        for (start, end, rate) in sorted(regions):
+            start = max(start, pos)
+            end = min(end, seq_len)
+            if end <= start:
+                continue
+            if start > pos:
+                starts.append(pos)
+                rates.append(base_rate)
+            starts.append(start)
+            rates.append(rate)
+            pos = end
+        if pos < seq_len or not starts:
+            starts.append(pos)
+            rates.append(base_rate)
+
+        # piece i covers [bounds[i], bounds[i+1]) at rates[i], cumulative[i] is the summed rate before bounds[i]
+        self.bounds = np.array(starts + [max(seq_len, pos)], dtype=np.int64)
+        self.rates = np.array(rates, dtype=np.float64)
+        self.cumulative = np.concatenate(([0.], np.cumsum(self.rates * np.diff(self.bounds))))
+
+    def prefix(self, pos) -> float:
+        """
+        :param pos: 0-based contig coordinate
+        :return: summed mutation rate of [0, pos)
+        """
+        i = min(max(int(np.searchsorted(self.bounds, pos, side='right')) - 1, 0), len(self.rates) - 1)
+        return float(self.cumulative[i] + self.rates[i] * (pos - self.bounds[i]))
+
+    def total(self, start, end) -> float:
+        """
+        :param start: 0-based start coordinate
+        :param end: 0-based end coordinate (exclusive)
+        :return: expected number of mutations in [start, end)
+        """
+        return self.prefix(end) - self.prefix(start)
+
+    def window_rates(self, start, end) -> np.ndarray:
+        """
+        Expand the track into per-base rates for a single window, one piece at a time
+
+        :param start: 0-based start coordinate
+        :param end: 0-based end coordinate (exclusive)
+        :return: array of end - start mutation rates
+        """
+        first = max(int(np.searchsorted(self.bounds, start, side='right')) - 1, 0)
+        last = min(int(np.searchsorted(self.bounds, end, side='left')), len(self.rates))
+        lengths = np.minimum(self.bounds[first + 1:last + 1], end) - np.maximum(self.bounds[first:last], start)
+        return np.repeat(self.rates[first:last], lengths)
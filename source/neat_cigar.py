@@ -1,5 +1,8 @@
+import bisect
 from itertools import groupby
 
+import numpy as np
+
 
 class CigarString:
     """"
@@ -70,6 +73,146 @@ class CigarString:
         return symbols
 
 
+class ExpandedCigar:
+    """
+    The expanded CIGAR symbol list of a mutated sequence, as CigarString.string_to_list gives it: one symbol per base,
+    'M', 'I' or 'D...M' for the first base after a deletion. Instead of one list entry per base it is stored as the
+    pieces in between the indels, either a run of plain 'M's (an int) or a short list of symbols. starts[i] is where
+    piece i begins (and starts[-1] the total length), so pieces are found by bisection. Indels go in left to right,
+    so keeping starts up to date only touches the few pieces after each edit.
+    """
+
+    def __init__(self, length):
+        """
+        :param length: number of bases, all 'M' to begin with
+        """
+        self.pieces = [length] if length > 0 else []
+        self.starts = [0, length] if length > 0 else [0]
+        self.length = max(length, 0)
+
+    def __len__(self):
+        return self.length
+
+    def split(self, pos) -> int:
+        """
+        Make sure a piece starts at pos
+
+        :param pos: position between 0 and len(self)
+        :return: index of the piece that starts at pos (len(self.pieces) if pos is the end)
+        """
+        i = bisect.bisect(self.starts, pos) - 1
+        if i >= len(self.pieces) or self.starts[i] == pos:
+            return min(i, len(self.pieces))
+        offset = pos - self.starts[i]
+        if isinstance(self.pieces[i], int):
+            self.pieces[i:i + 1] = [offset, self.pieces[i] - offset]
+        else:
+            self.pieces[i:i + 1] = [self.pieces[i][:offset], self.pieces[i][offset:]]
+        self.starts.insert(i + 1, pos)
+        return i + 1
+
+    def replace(self, start, end, symbols):
+        """
+        Same as symbol_list[start:end] = symbols
+
+        :param start: start of the slice
+        :param end: end of the slice
+        :param symbols: list of symbols to put in its place
+        """
+        (start, end, _) = slice(start, end).indices(self.length)
+        end = max(start, end)
+        first = self.split(start)
+        last = self.split(end)
+        self.pieces[first:last] = [list(symbols)] if symbols else []
+        # everything after the slice moves by the change in length
+        length_change = len(symbols) - (end - start)
+        self.starts[first + 1:] = ([start + len(symbols)] if symbols else []) + \
+            [n + length_change for n in self.starts[last + 1:]]
+        self.length += length_change
+
+    def set_symbol(self, pos, symbol):
+        """
+        Same as symbol_list[pos] = symbol
+
+        :param pos: position of the symbol
+        :param symbol: new symbol
+        """
+        if not -self.length <= pos < self.length:
+            raise IndexError('list assignment index out of range')
+        pos += self.length if pos < 0 else 0
+        self.replace(pos, pos + 1, [symbol])
+
+    def symbols(self, start, end) -> list:
+        """
+        Same as symbol_list[start:end], for 0 <= start <= end
+
+        :param start: start of the slice
+        :param end: end of the slice
+        :return: list of symbols
+        """
+        end = min(end, self.length)
+        out = []
+        i = max(bisect.bisect(self.starts, start) - 1, 0)
+        while start < end:
+            offset = start - self.starts[i]
+            piece_end = min(self.starts[i + 1], end)
+            if isinstance(self.pieces[i], int):
+                out.extend(['M'] * (piece_end - start))
+            else:
+                out.extend(self.pieces[i][offset:offset + piece_end - start])
+            start = piece_end
+            i += 1
+        return out
+
+    def ref_positions(self, read_len) -> tuple:
+        """
+        For a read starting at every position: the reference position of its left-most matching base, and that
+        position plus the number of ref-matching symbols ('M' or 'D...M') among the read_len symbols it covers.
+        Only the symbols of the pieces that aren't plain runs are looked at one by one; the rest is prefix sums.
+
+        :param read_len: read length
+        :return: (fm_pos, fm_span), int64 arrays of length len(self)
+        """
+        ref_steps = []
+        del_counts = []
+        has_match = []
+        for piece in self.pieces:
+            if isinstance(piece, int):
+                ref_steps.append(np.ones(piece, dtype=np.int64))
+                del_counts.append(np.zeros(piece, dtype=np.int64))
+                has_match.append(np.ones(piece, dtype=np.int64))
+            else:
+                ref_steps.append(np.array([n.count('M') + n.count('D') for n in piece], dtype=np.int64))
+                del_counts.append(np.array([n.count('D') for n in piece], dtype=np.int64))
+                has_match.append(np.array(['M' in n for n in piece], dtype=np.int64))
+        ref_steps = np.concatenate(ref_steps + [np.zeros(0, dtype=np.int64)])
+        fm_pos = np.cumsum(ref_steps) - ref_steps + np.concatenate(del_counts + [np.zeros(0, dtype=np.int64)])
+        matches_before = np.concatenate(([0], np.cumsum(np.concatenate(has_match + [np.zeros(0, dtype=np.int64)]))))
+        positions = np.arange(self.length)
+        fm_span = fm_pos + matches_before[np.minimum(positions + read_len, self.length)] - matches_before[positions]
+        return fm_pos, fm_span
+
+
+class ReadCigars:
+    """
+    The expanded CIGAR of a read starting at each position of a mutated sequence, indexed like the list
+    [symbol_list[j:j + read_len] for j in range(len(symbol_list) - read_len)], but only built for the reads asked for
+    """
+
+    def __init__(self, expanded_cigar, read_len):
+        self.expanded_cigar = expanded_cigar
+        self.read_len = read_len
+
+    def __len__(self):
+        return max(len(self.expanded_cigar) - self.read_len, 0)
+
+    def __getitem__(self, pos):
+        if not -len(self) <= pos < len(self):
+            raise IndexError('list index out of range')
+        pos += len(self) if pos < 0 else 0
+        return self.expanded_cigar.symbols(pos, pos + self.read_len)
+
+
 if __name__ == '__main__':
     cigar = "10M1I3D1M"
     lst = CigarString.string_to_list(cigar)
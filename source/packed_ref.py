@@ -0,0 +1,284 @@
+"""
+Packed reference store. Contigs are written once to a UCSC-style .2bit file that sits next to the reference
+(and its .fai), and are afterwards read through a memory map, so windows can be sliced out of a contig without
+ever holding the full chromosome in memory.
+
+.2bit layout (see https://genome.ucsc.edu/FAQ/FAQformat.html#format7):
+    header:     signature, version, sequence count, reserved (4 x uint32)
+    index:      per contig: name length (uint8), name, offset of the contig record (uint32, or uint64 for version 1)
+    record:     dna size, N block count, N block starts, N block sizes, mask block count, mask block starts,
+                mask block sizes, reserved (all uint32), then the packed dna at 4 bases per byte
+"""
+
+import sys
+import os
+import mmap
+import time
+import pathlib
+import struct
+
+import numpy as np
+from Bio.Seq import Seq
+
+from source.ref_func import read_ref_bytes, handle_n_regions, n_fill_bases, find_runs, apply_fills
+
+TWOBIT_SIGNATURE = 0x1A412743
+TWOBIT_SUFFIX = '.2bit'
+# version 0 files use 32-bit record offsets, so anything bigger than this needs version 1
+MAX_V0_SIZE = 2 ** 32 - 1
+
+# 2bit order is T, C, A, G. Anything that isn't one of these is stored as an N block.
+PACKED_NUCL = b'TCAG'
+ENCODE_TABLE = np.full(256, 255, dtype=np.uint8)
+for _code, _nucl in enumerate(PACKED_NUCL):
+    ENCODE_TABLE[_nucl] = _code
+    ENCODE_TABLE[ord(chr(_nucl).lower())] = _code
+# treat U (RNA references) as T
+ENCODE_TABLE[ord('U')] = 0
+ENCODE_TABLE[ord('u')] = 0
+# DECODE_TABLE[packed byte] = the 4 ascii bases it holds, most significant bits first
+DECODE_TABLE = np.array([[PACKED_NUCL[(byte >> shift) & 3] for shift in (6, 4, 2, 0)] for byte in range(256)],
+                        dtype=np.uint8)
+N_CHAR = ord('N')
+
+
+def packed_ref_path(reference_path) -> pathlib.Path:
+    """
+    Location of the packed version of a reference: [reference filename].2bit
+
+    :param reference_path: string path to the reference
+    :return: path to the .2bit file
+    """
+    reference_path = pathlib.Path(reference_path)
+    return reference_path.with_suffix(reference_path.suffix + TWOBIT_SUFFIX)
+
+
+def build_packed_ref(reference_path, ref_index, packed_path=None) -> pathlib.Path:
+    """
+    Write a .2bit copy of the reference. Lower case bases are stored upper case (no mask blocks), and all
+    non-ACGT characters are stored as N blocks.
+
+    :param reference_path: string path to the reference
+    :param ref_index: reference index, as returned by index_ref
+    :param packed_path: where to write the packed reference, defaults to [reference filename].2bit
+    :return: path to the .2bit file
+    """
+    tt = time.time()
+    if packed_path is None:
+        packed_path = packed_ref_path(reference_path)
+    print('packing reference into ' + str(packed_path) + '... ')
+
+    records = []
+    for ref_inds_i in ref_index:
+        codes = ENCODE_TABLE[np.frombuffer(read_ref_bytes(reference_path, ref_inds_i), dtype=np.uint8)]
+        dna_size = len(codes)
+        n_blocks = find_runs(codes == 255)
+        codes[codes == 255] = 0
+        # pad to a multiple of 4 and pack 4 bases per byte
+        codes = np.concatenate((codes, np.zeros(-dna_size % 4, dtype=np.uint8))).reshape(-1, 4)
+        packed_dna = (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3]
+        record_header = struct.pack('<II', dna_size, len(n_blocks))
+        record_header += struct.pack('<' + 'I' * len(n_blocks), *[n[0] for n in n_blocks])
+        record_header += struct.pack('<' + 'I' * len(n_blocks), *[n[1] - n[0] for n in n_blocks])
+        record_header += struct.pack('<II', 0, 0)
+        records.append((ref_inds_i[0].encode(), record_header, packed_dna.astype(np.uint8).tobytes()))
+
+    index_size = sum([1 + len(n[0]) + 4 for n in records])
+    version = 0
+    if 16 + index_size + sum([len(n[1]) + len(n[2]) for n in records]) > MAX_V0_SIZE:
+        version = 1
+        index_size += 4 * len(records)
+
+    # write to a temporary file first so an interrupted build never leaves a truncated store behind
+    temp_path = packed_path.with_suffix(packed_path.suffix + '.tmp')
+    with open(temp_path, 'wb') as f:
+        f.write(struct.pack('<IIII', TWOBIT_SIGNATURE, version, len(records), 0))
+        offset = 16 + index_size
+        for (name, record_header, packed_dna) in records:
+            f.write(struct.pack('<B', len(name)) + name)
+            f.write(struct.pack('<Q' if version else '<I', offset))
+            offset += len(record_header) + len(packed_dna)
+        for (name, record_header, packed_dna) in records:
+            f.write(record_header)
+            f.write(packed_dna)
+    os.replace(temp_path, packed_path)
+
+    print('{0:.3f} (sec)'.format(time.time() - tt))
+    return packed_path
+
+
+class PackedContig:
+    """
+    A single contig of a PackedReference. Slicing it returns a Bio.Seq of just the requested region.
+    """
+
+    def __init__(self, name, buffer, record_offset, byte_order):
+        self.name = name
+        self.buffer = buffer
+        (self.seq_len, n_block_count) = struct.unpack_from(byte_order + 'II', buffer, record_offset)
+        offset = record_offset + 8
+        n_block_starts = np.frombuffer(buffer, dtype=byte_order + 'u4', count=n_block_count, offset=offset)
+        n_block_sizes = np.frombuffer(buffer, dtype=byte_order + 'u4', count=n_block_count,
+                                      offset=offset + 4 * n_block_count)
+        offset += 8 * n_block_count
+        (mask_block_count,) = struct.unpack_from(byte_order + 'I', buffer, offset)
+        # skip mask blocks and the reserved field, we work in upper case only
+        self.dna_offset = offset + 4 + 8 * mask_block_count + 4
+
+        self.n_starts = n_block_starts.astype(np.int64)
+        self.n_ends = self.n_starts + n_block_sizes
+        # (start, replacement string) for N regions that are filled in with real bases, sorted by start
+        self.fill_starts = []
+        self.fill_seqs = []
+
+    def __len__(self):
+        return self.seq_len
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError('PackedContig only supports contiguous slices')
+        (start, end, _) = key.indices(self.seq_len)
+        return Seq(self.fetch(start, max(start, end)).decode())
+
+    def n_regions(self) -> list:
+        """
+        :return: list of (start, end) tuples giving solid blocks of Ns
+        """
+        return list(zip(self.n_starts.tolist(), self.n_ends.tolist()))
+
+    def set_fills(self, fills):
+        """
+        :param fills: list of (start, replacement string) tuples for N regions that should read as real bases
+        """
+        fills = sorted(fills)
+        self.fill_starts = [n[0] for n in fills]
+        self.fill_seqs = [n[1].encode() for n in fills]
+
+    def fetch(self, start, end) -> bytes:
+        """
+        Decode the region [start, end) of the contig
+
+        :param start: 0-based start coordinate
+        :param end: 0-based end coordinate (exclusive)
+        :return: sequence as upper case ascii bytes
+        """
+        first_byte = start // 4
+        packed = np.frombuffer(self.buffer, dtype=np.uint8, count=(end + 3) // 4 - first_byte,
+                               offset=self.dna_offset + first_byte)
+        shift = start - 4 * first_byte
+        bases = DECODE_TABLE[packed].ravel()[shift:shift + end - start]
+
+        # N blocks overlapping the region
+        i = np.searchsorted(self.n_ends, start, side='right')
+        while i < len(self.n_starts) and self.n_starts[i] < end:
+            bases[max(self.n_starts[i], start) - start:min(self.n_ends[i], end) - start] = N_CHAR
+            i += 1
+
+        # filled in N regions overlapping the region
+        apply_fills(bases, start, self.fill_starts, self.fill_seqs)
+
+        return bases.tobytes()
+
+
+class PackedReference:
+    """
+    Memory-mapped reader for a .2bit reference
+    """
+
+    def __init__(self, packed_path):
+        self.packed_path = pathlib.Path(packed_path)
+        with open(self.packed_path, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # the signature tells us the byte order the file was written in
+        byte_order = '<'
+        if struct.unpack_from('<I', self.buffer, 0)[0] != TWOBIT_SIGNATURE:
+            byte_order = '>'
+            if struct.unpack_from('>I', self.buffer, 0)[0] != TWOBIT_SIGNATURE:
+                print('\nProblem reading the packed reference, ' + str(self.packed_path) + '\n')
+                sys.exit(1)
+        self.byte_order = byte_order
+        (version, seq_count) = struct.unpack_from(byte_order + 'II', self.buffer, 4)
+
+        self.record_offsets = {}
+        self.names = []
+        offset = 16
+        for _ in range(seq_count):
+            name_len = self.buffer[offset]
+            name = self.buffer[offset + 1:offset + 1 + name_len].decode()
+            offset += 1 + name_len
+            (record_offset,) = struct.unpack_from(byte_order + ('Q' if version else 'I'), self.buffer, offset)
+            offset += 8 if version else 4
+            self.record_offsets[name] = record_offset
+            self.names.append(name)
+
+    def __contains__(self, name):
+        return name in self.record_offsets
+
+    def contig(self, name) -> PackedContig:
+        """
+        :param name: contig name
+        :return: PackedContig for this contig
+        """
+        return PackedContig(name, self.buffer, self.record_offsets[name], self.byte_order)
+
+    def matches_index(self, ref_index) -> bool:
+        """
+        Check that the packed reference holds the same contigs as the reference index
+
+        :param ref_index: reference index, as returned by index_ref
+        :return: True if every contig is present with the right length
+        """
+        for ref_inds_i in ref_index:
+            if ref_inds_i[0] not in self or len(self.contig(ref_inds_i[0])) != ref_inds_i[3]:
+                return False
+        return True
+
+
+def open_packed_ref(reference_path, ref_index):
+    """
+    Open the packed version of the reference, building it first if it is missing or out of date
+
+    :param reference_path: string path to the reference
+    :param ref_index: reference index, as returned by index_ref
+    :return: PackedReference, or None if the packed reference could not be written
+    """
+    packed_path = packed_ref_path(reference_path)
+    if packed_path.is_file() and packed_path.stat().st_mtime >= pathlib.Path(reference_path).stat().st_mtime:
+        print('found packed reference ' + str(packed_path))
+        packed_ref = PackedReference(packed_path)
+        if packed_ref.matches_index(ref_index):
+            return packed_ref
+        print('packed reference does not match the reference index, rebuilding...')
+
+    try:
+        build_packed_ref(reference_path, ref_index, packed_path)
+    except OSError:
+        print('Warning: could not write packed reference to ' + str(packed_path) + ', reading contigs directly.')
+        return None
+    return PackedReference(packed_path)
+
+
+def read_packed_ref(packed_ref, ref_inds_i, n_handling, quiet=False):
+    """
+    Packed-reference counterpart of read_ref. Nothing is decoded here: N regions come straight from the N blocks,
+    and any N regions we fill in are recorded on the contig and applied whenever it is sliced.
+
+    :param packed_ref: PackedReference
+    :param ref_inds_i: reference index entry for the contig, as returned by index_ref
+    :param n_handling: tuple of (mode, max length of N region to fill, fill character)
+    :param quiet: suppress progress output
+    :return: PackedContig and n_info dict, as read_ref
+    """
+    tt = time.time()
+    if not quiet:
+        print('reading ' + ref_inds_i[0] + '... ')
+
+    my_dat = packed_ref.contig(ref_inds_i[0])
+    (n_info, fill_regions) = handle_n_regions(my_dat.n_regions(), len(my_dat), n_handling)
+    my_dat.set_fills(n_fill_bases(fill_regions, n_handling))
+
+    if not quiet:
+        print('{0:.3f} (sec)'.format(time.time() - tt))
+
+    return my_dat, n_info
@@ -2,11 +2,14 @@ import random
 import bisect
 import copy
 import sys
+import functools
 from typing import Union
 
 import numpy as np
 
 LOW_PROB_THRESH = 1e-12
+# how many poisson samplers to keep around (two per ploid for every distinct window length and mutation rate)
+POISSON_CACHE_SIZE = 256
 
 
 def mean_ind_of_weighted_list(candidate_list: list) -> int:
@@ -111,6 +114,112 @@ class DiscreteDistribution:
                 return self.values[bisect.bisect(self.cum_prob, r) - 1]
 
 
+class ArrayDistribution:
+    """
+    Bisect DiscreteDistribution for long weight vectors built with numpy: the cumulative sums stay in an array and
+    are searched there, so no Python lists are built. Samples are the same as DiscreteDistribution(weights, values)
+    would give for the same random numbers.
+    """
+
+    def __init__(self, weights, values):
+        weights = np.asarray(weights, dtype=np.float64)
+        if not len(weights) or not len(values):
+            print('\nError: weight or value vector given to ArrayDistribution() are 0-length.\n')
+            sys.exit(1)
+        if len(weights) != len(values):
+            print('\nError: length and weights and values vectors must be the same.\n')
+            sys.exit(1)
+
+        self.values = values
+        self.degenerate = None
+        # a running sum adds up in the same order as sum() over a list, so we normalize exactly as DiscreteDistribution
+        sum_weight = float(np.cumsum(weights)[-1])
+        if sum_weight < LOW_PROB_THRESH:
+            self.degenerate = values[0]
+        else:
+            # cum_prob[i] = probability of sampling one of values[0:i+1]
+            self.cum_prob = np.cumsum(weights / sum_weight)[:-1]
+
+    def sample(self) -> Union[int, float]:
+        if self.degenerate is not None:
+            return self.degenerate
+        return self.values[int(np.searchsorted(self.cum_prob, random.random(), side='right'))]
+
+
+class FenwickSampler:
+    """
+    Samples positions 0..n-1 with probability proportional to their weights, where positions can be taken out as
+    they get used up. The weights are kept in a Fenwick (binary indexed) tree, so both sampling and taking a
+    position out are O(log n), no matter how many positions are already gone.
+    """
+
+    def __init__(self, weights):
+        self.build(np.array(weights, dtype=np.float64))
+
+    def build(self, weights):
+        """
+        :param weights: numpy array of (non-negative) weights, owned by the sampler from here on
+        """
+        self.weights = weights
+        # pad the tree out to a power of two, so searching never has to check if it ran off the end
+        self.size = 1 << max(len(weights) - 1, 0).bit_length()
+        cum_weights = np.zeros(self.size + 1, dtype=np.float64)
+        np.cumsum(weights, out=cum_weights[1:len(weights) + 1])
+        cum_weights[len(weights) + 1:] = cum_weights[len(weights)]
+        ind = np.arange(1, self.size + 1)
+        # tree[i] (1-based) holds the summed weight of positions [i - lowbit(i), i)
+        self.tree = [0.] + (cum_weights[ind] - cum_weights[ind - (ind & -ind)]).tolist()
+        self.total = float(cum_weights[-1])
+        self.n_left = int(np.count_nonzero(weights > 0.))
+
+    def remove(self, pos):
+        """
+        Give a position zero weight from now on
+
+        :param pos: position to take out
+        """
+        weight = float(self.weights[pos])
+        if weight <= 0.:
+            return
+        self.weights[pos] = 0.
+        self.total -= weight
+        self.n_left -= 1
+        i = pos + 1
+        while i <= self.size:
+            self.tree[i] -= weight
+            i += i & -i
+
+    def search(self, r) -> int:
+        """
+        :param r: number between 0 and the total weight
+        :return: the position whose share of the cumulative weight contains r
+        """
+        tree = self.tree
+        pos = 0
+        step = self.size
+        while step:
+            if tree[pos + step] <= r:
+                pos += step
+                r -= tree[pos]
+            step >>= 1
+        return min(pos, len(self.weights) - 1)
+
+    def sample(self) -> int:
+        """
+        :return: a position with non-zero weight, or -1 if there are none left
+        """
+        if self.n_left <= 0:
+            return -1
+        pos = self.search(random.random() * self.total)
+        if self.weights[pos] <= 0.:
+            # rounding left behind by removed weights; start over from clean sums
+            self.build(self.weights)
+            pos = self.search(random.random() * self.total)
+            if self.weights[pos] <= 0.:
+                pos = int(np.flatnonzero(self.weights)[-1])
+        return pos
+
+
 # takes k_range, lambda, [0,1,2,..], returns a DiscreteDistribution object
 # with the corresponding to a poisson distribution
 
@@ -118,14 +227,27 @@ def poisson_list(k_range, input_lambda):
     min_weight = 1e-12
     if input_lambda < min_weight:
         return DiscreteDistribution([1], [0], degenerate_val=0)
-    log_factorial_list = [0.0]
-    for k in k_range[1:]:
-        log_factorial_list.append(np.log(float(k)) + log_factorial_list[k - 1])
-    w_range = [np.exp(k * np.log(input_lambda) - input_lambda - log_factorial_list[k]) for k in k_range]
-    w_range = [n for n in w_range if n >= min_weight]
-    if len(w_range) <= 1:
+    k_values = np.arange(len(k_range))
+    log_factorial = np.concatenate(([0.], np.cumsum(np.log(k_values[1:].astype(np.float64)))))
+    w_range = np.exp(k_values * np.log(input_lambda) - input_lambda - log_factorial)
+    # drop the negligible tails on both sides (for big lambdas that includes k=0), keeping k lined up with its weight
+    kept = w_range >= min_weight
+    if np.count_nonzero(kept) <= 1:
         return DiscreteDistribution([1], [0], degenerate_val=0)
-    return DiscreteDistribution(w_range, k_range[:len(w_range)])
+    return ArrayDistribution(w_range[kept], k_values[kept].tolist())
+
+
+@functools.lru_cache(maxsize=POISSON_CACHE_SIZE)
+def poisson_sampler(max_k, input_lambda):
+    """
+    poisson_list over range(max_k), remembered for the next window that asks for the same lambda. Samplers keep no
+    state of their own, so the same one can be handed out any number of times.
+
+    :param max_k: number of k values to consider
+    :param input_lambda: expected value
+    :return: DiscreteDistribution or ArrayDistribution of the number of events
+    """
+    return poisson_list(range(max_k), input_lambda)
 
 
 # quantize a list of values into blocks
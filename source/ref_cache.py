@@ -0,0 +1,340 @@
+"""
+Persistent cache of reference-derived data, stored next to the reference as [reference filename].neatcache.
+For every contig it holds:
+    n_atlas:    (start, end) solid blocks of Ns, int64 array of shape (k, 2)
+    trinuc:     trinucleotide context code of every position (16 * 5' base + 4 * base + 3' base, A=0 C=1 G=2 T=3),
+                uint8, or NO_TRINUC where the context runs off the contig or contains a non-ACGT base
+
+Nothing in it depends on the run's parameters: the non-N regions for a read length / fragment size are derived from
+n_atlas when a contig is loaded, and G/C counts can be read off the middle base of the trinuc codes.
+
+File layout: magic and version, the arrays back to back (8-byte aligned), then a JSON header describing where each
+array lives along with its crc32, followed by the header offset and the magic again. The header carries a key
+computed from the reference; if it doesn't match, the cache is rebuilt. Arrays are read through a memory map one
+contig at a time, the first time that contig is needed.
+
+The N regions used to split work across jobs are kept in a second, much smaller file in the same layout,
+[reference filename].nnr, holding only n_atlas.
+"""
+
+import os
+import mmap
+import json
+import time
+import zlib
+import struct
+import pathlib
+import hashlib
+
+import numpy as np
+
+from source.ref_func import read_ref_bytes, find_n_regions, handle_n_regions, map_contigs
+
+NEATCACHE_MAGIC = b'NEATCACH'
+NEATCACHE_VERSION = 2
+NEATCACHE_SUFFIX = '.neatcache'
+REGIONS_CACHE_SUFFIX = '.nnr'
+CACHE_ALIGN = 8
+# contigs are processed in blocks of this many bases to bound memory while building the cache
+CACHE_BLOCK_SIZE = 2 ** 24
+
+NO_TRINUC = 255
+# NUC_CODE[ascii code] = A:0, C:1, G:2, T:3, anything else: 4
+NUC_CODE = np.full(256, 4, dtype=np.uint8)
+for _code, _nucl in enumerate(b'ACGT'):
+    NUC_CODE[_nucl] = _code
+IS_GC = np.zeros(256, dtype=bool)
+IS_GC[[ord('G'), ord('C')]] = True
+# CODE_IS_GC[trinuc code] = True if the middle base is G or C (False for NO_TRINUC, whose middle base is unknown)
+CODE_IS_GC = np.zeros(256, dtype=bool)
+CODE_IS_GC[:64] = np.isin((np.arange(64) >> 2) & 3, [1, 2])
+
+
+def trinuc_codes(my_dat) -> np.ndarray:
+    """
+    Trinucleotide context code of every position of a sequence
+
+    :param my_dat: upper case sequence, as bytes or a uint8 numpy array
+    :return: uint8 array, NO_TRINUC at the two ends and wherever the context contains a non-ACGT base
+    """
+    my_dat = np.frombuffer(my_dat, dtype=np.uint8) if isinstance(my_dat, bytes) else my_dat
+    nuc = NUC_CODE[my_dat]
+    codes = np.full(len(nuc), NO_TRINUC, dtype=np.uint8)
+    if len(nuc) >= 3:
+        codes[1:-1] = (nuc[:-2] << 4) | (nuc[1:-1] << 2) | nuc[2:]
+        codes[1:-1][(nuc[:-2] > 3) | (nuc[1:-1] > 3) | (nuc[2:] > 3)] = NO_TRINUC
+    return codes
+
+
+def cache_key(reference_path, ref_index) -> str:
+    """
+    Checksum identifying the reference the cache was built from. The reference is fingerprinted by its size,
+    modification time and index, rather than by rereading the whole file.
+
+    :param reference_path: string path to the reference
+    :param ref_index: reference index, as returned by index_ref
+    :return: hex digest
+    """
+    ref_stat = pathlib.Path(reference_path).stat()
+    key_dat = {'version': NEATCACHE_VERSION,
+               'reference': [ref_stat.st_size, ref_stat.st_mtime_ns, [list(n[:4]) for n in ref_index]]}
+    return hashlib.sha1(json.dumps(key_dat, sort_keys=True).encode()).hexdigest()
+
+
+def compute_contig_regions(reference_path, ref_inds_i) -> dict:
+    """
+    Compute just the N regions of one contig
+
+    :param reference_path: string path to the reference
+    :param ref_inds_i: reference index entry for the contig, as returned by index_ref
+    :return: dict of array name: numpy array
+    """
+    n_atlas = find_n_regions(read_ref_bytes(reference_path, ref_inds_i))
+    return {'n_atlas': np.array(n_atlas, dtype=np.int64).reshape(-1, 2)}
+
+
+def compute_contig_data(reference_path, ref_inds_i) -> dict:
+    """
+    Compute all of the cached arrays for one contig
+
+    :param reference_path: string path to the reference
+    :param ref_inds_i: reference index entry for the contig, as returned by index_ref
+    :return: dict of array name: numpy array
+    """
+    my_dat = np.frombuffer(read_ref_bytes(reference_path, ref_inds_i), dtype=np.uint8)
+    seq_len = len(my_dat)
+    n_atlas = find_n_regions(my_dat)
+
+    trinuc = np.empty(seq_len, dtype=np.uint8)
+    for block_start in range(0, seq_len, CACHE_BLOCK_SIZE):
+        block_end = min(block_start + CACHE_BLOCK_SIZE, seq_len)
+        # one base of context on either side
+        context_start = max(0, block_start - 1)
+        context_end = min(seq_len, block_end + 1)
+        trinuc[block_start:block_end] = trinuc_codes(my_dat[context_start:context_end])[
+            block_start - context_start:block_end - context_start]
+    # the ends of the contig have no full trinuc context
+    trinuc[:1] = NO_TRINUC
+    trinuc[-1:] = NO_TRINUC
+
+    return {'n_atlas': np.array(n_atlas, dtype=np.int64).reshape(-1, 2),
+            'trinuc': trinuc}
+
+
+def build_ref_cache(reference_path, ref_index, cache_path, threads=None):
+    """
+    Write the cache for every contig in the reference, computing the contigs in a process pool
+
+    :param reference_path: string path to the reference
+    :param ref_index: reference index, as returned by index_ref
+    :param cache_path: where to write the cache
+    :param threads: number of worker processes, defaults to the number of cpus
+    """
+    tt = time.time()
+    print('building reference cache ' + str(cache_path) + '... ')
+    contig_data = zip([n[0] for n in ref_index], map_contigs(compute_contig_data, reference_path, ref_index,
+                                                             threads=threads))
+    write_cache_file(cache_path, cache_key(reference_path, ref_index), contig_data)
+    print('{0:.3f} (sec)'.format(time.time() - tt))
+
+
+def write_cache_file(cache_path, key, contig_data):
+    """
+    Write a cache file in the layout described at the top of this module
+
+    :param cache_path: where to write the cache
+    :param key: cache key, as returned by cache_key
+    :param contig_data: iterable of (contig name, dict of array name: numpy array)
+    """
+    header = {'version': NEATCACHE_VERSION,
+              'key': key,
+              'contigs': {}}
+
+    # write to a temporary file first so concurrent runs never see a partial cache
+    temp_path = cache_path.with_suffix(cache_path.suffix + '.' + str(os.getpid()) + '.tmp')
+    with open(temp_path, 'wb') as f:
+        f.write(NEATCACHE_MAGIC + struct.pack('<I', NEATCACHE_VERSION))
+        for (contig_name, arrays) in contig_data:
+            contig_header = {}
+            for (name, arr) in arrays.items():
+                f.write(b'\0' * (-f.tell() % CACHE_ALIGN))
+                arr = np.ascontiguousarray(arr)
+                contig_header[name] = {'offset': f.tell(), 'dtype': arr.dtype.str, 'shape': list(arr.shape),
+                                       'crc32': zlib.crc32(arr.data)}
+                f.write(arr.data)
+            header['contigs'][contig_name] = contig_header
+        header_offset = f.tell()
+        f.write(json.dumps(header).encode())
+        f.write(struct.pack('<Q', header_offset) + NEATCACHE_MAGIC)
+    os.replace(temp_path, cache_path)
+
+
+class ContigCache:
+    """
+    Cached arrays for a single contig, as read-only numpy views into the cache file
+    """
+
+    def __init__(self, name, buffer, contig_header):
+        self.name = name
+        for (arr_name, arr_info) in contig_header.items():
+            arr = np.frombuffer(buffer, dtype=np.dtype(arr_info['dtype']), count=int(np.prod(arr_info['shape'])),
+                                offset=arr_info['offset']).reshape(arr_info['shape'])
+            if zlib.crc32(arr.data) != arr_info['crc32']:
+                raise ValueError('checksum mismatch for ' + arr_name + ' of ' + name)
+            setattr(self, arr_name, arr)
+
+    def n_atlas_list(self) -> list:
+        """
+        :return: n_atlas in the list of (start, end) tuples form read_ref uses
+        """
+        return [tuple(n) for n in self.n_atlas.tolist()]
+
+    def non_n_list(self, seq_len, n_handling) -> list:
+        """
+        :param seq_len: length of the contig
+        :param n_handling: tuple of (mode, max length of N region to fill, fill character)
+        :return: non-N regions in the list of (start, end) tuples form read_ref uses
+        """
+        (n_info, _) = handle_n_regions(self.n_atlas_list(), seq_len, n_handling)
+        return n_info['non_N']
+
+    def gc_window_counts(self, gc_window_size) -> np.ndarray:
+        """
+        Number of G/C bases in each gc window of the contig, the windows laid end to end from the start (the last
+        one truncated at the end). Bases without a known trinuc context (at the contig ends and next to non-ACGT
+        bases) count as A/T, which is close enough for estimating coverage.
+
+        :param gc_window_size: size of the gc window
+        :return: int64 array
+        """
+        # whole windows per block, so the contig is never expanded all at once
+        block_size = max(CACHE_BLOCK_SIZE // gc_window_size, 1) * gc_window_size
+        return np.concatenate([np.add.reduceat(CODE_IS_GC[self.trinuc[n:n + block_size]],
+                                               np.arange(0, min(block_size, len(self.trinuc) - n), gc_window_size),
+                                               dtype=np.int64)
+                               for n in range(0, len(self.trinuc), block_size)] + [np.zeros(0, dtype=np.int64)])
+
+
+class ReferenceCache:
+    """
+    Reader for a .neatcache file. Contigs are loaded (and checksummed) lazily, the first time they're requested.
+    """
+
+    def __init__(self, cache_path):
+        self.cache_path = pathlib.Path(cache_path)
+        with open(self.cache_path, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buffer[:len(NEATCACHE_MAGIC)] != NEATCACHE_MAGIC or self.buffer[-len(NEATCACHE_MAGIC):] != \
+                NEATCACHE_MAGIC:
+            raise ValueError('not a neatcache file')
+        (header_offset,) = struct.unpack_from('<Q', self.buffer, len(self.buffer) - len(NEATCACHE_MAGIC) - 8)
+        self.header = json.loads(self.buffer[header_offset:len(self.buffer) - len(NEATCACHE_MAGIC) - 8].decode())
+        self.key = self.header['key']
+        self.version = self.header['version']
+        self.contigs = {}
+
+    def __contains__(self, name):
+        return name in self.header['contigs']
+
+    def contig(self, name):
+        """
+        :param name: contig name
+        :return: ContigCache for this contig, or None if it is missing or fails its checksum
+        """
+        if name not in self.contigs:
+            if name not in self:
+                return None
+            try:
+                self.contigs[name] = ContigCache(name, self.buffer, self.header['contigs'][name])
+            except ValueError:
+                print('Warning: reference cache entry for ' + name + ' is corrupt, recomputing it.')
+                self.contigs[name] = None
+        return self.contigs[name]
+
+
+def ref_cache_path(reference_path) -> pathlib.Path:
+    """
+    :param reference_path: string path to the reference
+    :return: path to [reference filename].neatcache
+    """
+    reference_path = pathlib.Path(reference_path)
+    return reference_path.with_suffix(reference_path.suffix + NEATCACHE_SUFFIX)
+
+
+def open_ref_cache(reference_path, ref_index, threads=None):
+    """
+    Open the reference cache, (re)building it if it is missing, from an older version of NEAT, or was built for a
+    different reference
+
+    :param reference_path: string path to the reference
+    :param ref_index: reference index, as returned by index_ref
+    :param threads: number of worker processes for building the cache, defaults to the number of cpus
+    :return: ReferenceCache, or None if the cache could not be written
+    """
+    cache_path = ref_cache_path(reference_path)
+    key = cache_key(reference_path, ref_index)
+    if cache_path.is_file():
+        try:
+            ref_cache = ReferenceCache(cache_path)
+            if ref_cache.version == NEATCACHE_VERSION and ref_cache.key == key:
+                print('found reference cache ' + str(cache_path))
+                return ref_cache
+            print('reference cache is out of date, rebuilding...')
+        except (ValueError, KeyError, struct.error):
+            print('reference cache is unreadable, rebuilding...')
+
+    try:
+        build_ref_cache(reference_path, ref_index, cache_path, threads)
+    except OSError:
+        print('Warning: could not write reference cache to ' + str(cache_path) + ', continuing without it.')
+        return None
+    ref_cache = ReferenceCache(cache_path)
+    if ref_cache.key != key:
+        # another run replaced the cache with one built from a different version of the reference
+        print('Warning: reference cache was overwritten by another run, continuing without it.')
+        return None
+    return ref_cache
+
+
+def regions_cache_path(reference_path) -> pathlib.Path:
+    """
+    :param reference_path: string path to the reference
+    :return: path to [reference filename].nnr
+    """
+    reference_path = pathlib.Path(reference_path)
+    return reference_path.with_suffix(reference_path.suffix + REGIONS_CACHE_SUFFIX)
+
+
+def open_regions_cache(reference_path, ref_index):
+    """
+    Open the N region cache, if there is one that matches the reference
+
+    :param reference_path: string path to the reference
+    :param ref_index: reference index, as returned by index_ref
+    :return: ReferenceCache, or None if there is no usable cache
+    """
+    cache_path = regions_cache_path(reference_path)
+    if not cache_path.is_file():
+        return None
+    try:
+        regions_cache = ReferenceCache(cache_path)
+    except (ValueError, KeyError, struct.error):
+        print('N region cache is unreadable, recomputing...')
+        return None
+    if regions_cache.version != NEATCACHE_VERSION or regions_cache.key != cache_key(reference_path, ref_index):
+        print('N region cache is out of date, recomputing...')
+        return None
+    return regions_cache
+
+
+def save_regions_cache(reference_path, ref_index, contig_data):
+    """
+    :param reference_path: string path to the reference
+    :param ref_index: reference index, as returned by index_ref
+    :param contig_data: iterable of (contig name, dict of array name: numpy array), from compute_contig_regions
+    """
+    cache_path = regions_cache_path(reference_path)
+    try:
+        write_cache_file(cache_path, cache_key(reference_path, ref_index), contig_data)
+    except OSError:
+        print('Warning: could not write N region cache to ' + str(cache_path))
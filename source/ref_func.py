@@ -4,11 +4,27 @@ import os
 import gzip
 import pathlib
 import random
+import bisect
+import functools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 from Bio.Seq import Seq
 from Bio import SeqIO
 
+from source.bgzf_reader import BgzfReader, is_bgzf
+
 OK_CHR_ORD = {'A': True, 'C': True, 'G': True, 'T': True, 'U': True}
 ALLOWED_NUCL = ['A', 'C', 'G', 'T']
+# OK_CHR_TABLE[ascii code] = True for the characters in OK_CHR_ORD
+OK_CHR_TABLE = np.zeros(256, dtype=bool)
+OK_CHR_TABLE[[ord(n) for n in OK_CHR_ORD]] = True
+
+# how much of the reference to scan at once when building an index
+FAI_BLOCK_SIZE = 2 ** 24
+FAI_NEWLINE = ord('\n')
+FAI_CARRIAGE_RETURN = ord('\r')
+FAI_HEADER = ord('>')
 
 
 def index_ref(reference_path: str) -> list:
@@ -50,102 +66,307 @@ def index_ref(reference_path: str) -> list:
             offset = int(splt[2])
             # Defined as bases per line in the Fasta file
             line_ln = int(splt[3])
-            n_lines = seq_len // line_ln
-            if seq_len % line_ln != 0:
-                n_lines += 1
-            # Item 3 in this gives you the byte position of the next contig, I believe
-            ref_indices.append((splt[0], offset, offset + seq_len + n_lines, seq_len))
+            # Defined as bytes per line in the Fasta file, including the line break
+            line_width = int(splt[4])
+            # Item 3 is the byte index just past the last line of the contig
+            ref_indices.append((splt[0], offset, fai_entry_end(offset, seq_len, line_ln, line_width), seq_len,
+                                line_ln, line_width))
         fai.close()
         return ref_indices
 
     print('Index not found, creating one... ')
-    if absolute_reference_location.suffix == ".gz":
-        ref_file = gzip.open(absolute_reference_location, 'rt')
+    indexer = FastaIndexer()
+    # read in binary mode so that offsets are real (uncompressed) byte offsets, which is what read_ref expects
+    if absolute_reference_location.suffix == '.gz' and is_bgzf(absolute_reference_location):
+        bgzf_reader = get_bgzf_reader(str(absolute_reference_location))
+        while True:
+            data = bgzf_reader.read(indexer.pos, FAI_BLOCK_SIZE)
+            if not data:
+                break
+            indexer.feed(data)
     else:
-        ref_file = open(absolute_reference_location, 'r')
-    prev_r = None
-    prev_p = None
-    seq_len = 0
-
-    while True:
-        data = ref_file.readline()
-        if not data:
-            ref_indices.append((prev_r, prev_p, ref_file.tell() - len(data), seq_len))
-            break
-        elif data[0] == '>':
-            if prev_p is not None:
-                ref_indices.append((prev_r, prev_p, ref_file.tell() - len(data), seq_len))
-            seq_len = 0
-            prev_p = ref_file.tell()
-            prev_r = data[1:-1]
+        if absolute_reference_location.suffix == '.gz':
+            ref_file = gzip.open(absolute_reference_location, 'rb')
         else:
-            seq_len += len(data) - 1
-    ref_file.close()
+            ref_file = open(absolute_reference_location, 'rb')
+        while True:
+            data = ref_file.read(FAI_BLOCK_SIZE)
+            if not data:
+                break
+            indexer.feed(data)
+        ref_file.close()
+    indexer.finish()
+    # samtools leaves out empty contigs, so that reading the index back gives the same contigs
+    indexer.entries = [n for n in indexer.entries if n[1]]
+
+    uneven = [n[0] for n in indexer.entries if n[6]]
+    for n in indexer.entries:
+        if n[6]:
+            # line lengths are meaningless here, so only whole-contig reads can use this entry
+            ref_indices.append((n[0], n[2], n[5], n[1], 0, 0))
+        else:
+            ref_indices.append((n[0], n[2], fai_entry_end(n[2], n[1], n[3], n[4]), n[1], n[3], n[4]))
+
+    if uneven:
+        # samtools faidx refuses these files too, so don't leave an index behind that other tools would trust
+        print('Warning: lines of uneven length in ' + ', '.join(uneven[:5]) + (' ...' if len(uneven) > 5 else '') +
+              ', not writing an index file.')
+    else:
+        index_filename = absolute_reference_location.with_suffix(absolute_reference_location.suffix + '.fai')
+        try:
+            write_fai(index_filename, indexer.entries)
+        except OSError:
+            print('Warning: could not write index to ' + str(index_filename))
 
     print('{0:.3f} (sec)'.format(time.time() - tt))
     return ref_indices
 
 
-def read_ref(ref_path, ref_inds_i, n_handling, n_unknowns=True, quiet=False):
-    tt = time.time()
-    if not quiet:
-        print('reading ' + ref_inds_i[0] + '... ')
+def fai_entry_end(offset, seq_len, line_ln, line_width) -> int:
+    """
+    :param offset: byte index where the contig sequence begins
+    :param seq_len: number of bases in the contig
+    :param line_ln: bases per line
+    :param line_width: bytes per line, including the line break
+    :return: byte index just past the last line of the contig
+    """
+    if not line_ln:
+        return offset
+    (n_full_lines, remainder) = divmod(seq_len, line_ln)
+    end = offset + n_full_lines * line_width
+    if remainder:
+        end += remainder + line_width - line_ln
+    return end
+
+
+def write_fai(index_filename, entries):
+    """
+    Write a samtools-style .fai: name, length, offset, bases per line, bytes per line
+
+    :param index_filename: where to write the index
+    :param entries: FastaIndexer entries
+    """
+    # write to a temporary file first so that an interrupted run never leaves a truncated index behind
+    temp_filename = index_filename.with_suffix(index_filename.suffix + '.tmp')
+    with open(temp_filename, 'w') as fai:
+        for n in entries:
+            fai.write('\t'.join([n[0]] + [str(m) for m in n[1:5]]) + '\n')
+    os.replace(temp_filename, index_filename)
+
+
+class FastaIndexer:
+    """
+    Builds a fasta index by scanning the file in large blocks. Line breaks are located with numpy and line lengths
+    are checked a whole block at a time, so the only per-line python work is for header lines.
+
+    entries: [name, seq length, sequence offset, bases per line, bytes per line, end of last line, uneven lines]
+    """
+
+    def __init__(self):
+        self.entries = []
+        # global byte offset of the next block
+        self.pos = 0
+        # the line that runs past the end of the last block: where it starts, its first byte, and (for headers)
+        # everything we've seen of it so far
+        self.line_start = 0
+        self.first_char = None
+        self.header = b''
+        self.last_byte = None
+        # state of the current contig's sequence lines
+        self.short_line = False
+        self.blank_line = False
+
+    def feed(self, block: bytes):
+        """
+        :param block: the next chunk of the file
+        """
+        arr = np.frombuffer(block, dtype=np.uint8)
+        newlines = np.flatnonzero(arr == FAI_NEWLINE)
+        if len(newlines):
+            # local line starts and the local index of each line's line break, the first line may have started
+            # in an earlier block
+            starts = np.concatenate(([self.line_start - self.pos], newlines[:-1] + 1))
+            first = arr[np.minimum(np.maximum(starts, 0), len(arr) - 1)]
+            if starts[0] < 0:
+                first[0] = self.first_char
+            before_newline = arr[np.maximum(newlines - 1, 0)]
+            if newlines[0] == 0:
+                before_newline[0] = self.last_byte if self.last_byte is not None else 0
+            carriage_return = (before_newline == FAI_CARRIAGE_RETURN) & (newlines > starts)
+            widths = newlines - starts + 1
+            bases = widths - 1 - carriage_return
+
+            line_lo = 0
+            for h in np.flatnonzero(first == FAI_HEADER).tolist():
+                self.add_lines(bases[line_lo:h], widths[line_lo:h], newlines[line_lo:h])
+                if starts[h] < 0:
+                    header = self.header + block[:newlines[h]]
+                else:
+                    header = block[starts[h]:newlines[h]]
+                self.add_contig(header, self.pos + int(newlines[h]) + 1)
+                line_lo = h + 1
+            self.add_lines(bases[line_lo:], widths[line_lo:], newlines[line_lo:])
 
+            rest = block[newlines[-1] + 1:]
+            self.line_start = self.pos + int(newlines[-1]) + 1
+            self.first_char = rest[0] if rest else None
+            self.header = rest if self.first_char == FAI_HEADER else b''
+        elif self.line_start < self.pos:
+            if self.first_char == FAI_HEADER:
+                self.header += block
+        elif block:
+            self.first_char = block[0]
+            self.header = block if self.first_char == FAI_HEADER else b''
+
+        if block:
+            self.last_byte = block[-1]
+        self.pos += len(block)
+
+    def finish(self):
+        """
+        Deal with a last line that has no line break
+        """
+        if self.line_start < self.pos:
+            if self.first_char == FAI_HEADER:
+                self.add_contig(self.header, self.pos)
+            else:
+                # count the missing line break, as samtools does
+                width = self.pos - self.line_start + 1
+                self.add_lines(np.array([width - 1 - int(self.last_byte == FAI_CARRIAGE_RETURN)]), np.array([width]),
+                               np.array([self.pos - 1]), 0)
+        self.line_start = self.pos
+
+    def add_contig(self, header: bytes, offset: int):
+        """
+        :param header: header line, without the line break
+        :param offset: byte index where the contig sequence begins
+        """
+        # like samtools, the contig name is everything up to the first whitespace
+        name = header[1:].rstrip(b'\r').split(None, 1)
+        name = name[0].decode() if name else ''
+        self.entries.append([name, 0, offset, 0, 0, offset, False])
+        self.short_line = False
+        self.blank_line = False
+
+    def add_lines(self, bases, widths, newlines, block_offset=None):
+        """
+        Add sequence lines to the current contig
+
+        :param bases: number of bases on each line
+        :param widths: number of bytes on each line, including the line break
+        :param newlines: local index of each line's line break
+        :param block_offset: global offset of local index 0, defaults to the current block
+        """
+        if not self.entries or not len(bases):
+            return
+        if block_offset is None:
+            block_offset = self.pos
+        entry = self.entries[-1]
+
+        # blank lines are fine at the end of a contig, but not in the middle of one
+        blank = bases == 0
+        if blank.any():
+            if (~blank[np.argmax(blank):]).any() or (self.blank_line and not blank.all()):
+                entry[6] = True
+            self.blank_line = True
+            (bases, widths, newlines) = (bases[~blank], widths[~blank], newlines[~blank])
+            if not len(bases):
+                return
+        elif self.blank_line:
+            entry[6] = True
+
+        if not entry[1]:
+            entry[3] = int(bases[0])
+            entry[4] = int(widths[0])
+        full = (bases == entry[3]) & (widths == entry[4])
+        # every line but the last one of a contig has to be full length, and the last one can't be longer
+        if self.short_line or not full[:-1].all() or bases[-1] > entry[3]:
+            entry[6] = True
+        self.short_line = not full[-1]
+        entry[1] += int(bases.sum())
+        entry[5] = block_offset + int(newlines[-1]) + 1
+
+
+def read_ref_bytes(ref_path, ref_inds_i) -> bytes:
+    """
+    Read the raw sequence of one contig, with line breaks removed and converted to upper case
+
+    :param ref_path: string path to the reference
+    :param ref_inds_i: reference index entry for the contig, as returned by index_ref
+    :return: contig sequence as bytes
+    """
     absolute_reference_path = pathlib.Path(ref_path)
     if absolute_reference_path.suffix == '.gz':
-        ref_file = gzip.open(absolute_reference_path, 'rt')
+        # bgzipped references only decompress the blocks the contig lives in, plain gzip has to inflate
+        # everything up to the contig
+        if is_bgzf(absolute_reference_path):
+            my_dat = get_bgzf_reader(str(absolute_reference_path)).read(ref_inds_i[1], ref_inds_i[2] - ref_inds_i[1])
+            return my_dat.translate(None, b'\r\n').upper()
+        ref_file = gzip.open(absolute_reference_path, 'rb')
     else:
-        ref_file = open(absolute_reference_path, 'r')
+        ref_file = open(absolute_reference_path, 'rb')
 
-    # TODO convert to SeqIO containers
-    # for seq_record in SeqIO.parse(ref_file, "fasta"):
-    #     pass
+    ref_file.seek(ref_inds_i[1])
+    my_dat = ref_file.read(ref_inds_i[2] - ref_inds_i[1]).translate(None, b'\r\n').upper()
+    ref_file.close()
+    return my_dat
 
 
-    ref_file.seek(ref_inds_i[1])
-    my_dat = ''.join(ref_file.read(ref_inds_i[2] - ref_inds_i[1]).split('\n'))
-    my_dat = Seq(my_dat.upper())
-    # Mutable seqs have a number of disadvantages. I'm going to try making them immutable and see if that helps
-    # my_dat = my_dat.tomutable()
+@functools.lru_cache(maxsize=None)
+def get_bgzf_reader(ref_path) -> BgzfReader:
+    """
+    One BgzfReader per bgzipped reference, so the block index is only loaded once
 
-    # find N regions
-    # data explanation: my_dat[n_atlas[0][0]:n_atlas[0][1]] = solid block of Ns
-    prev_ni = 0
-    n_count = 0
-    n_atlas = []
-    for i in range(len(my_dat)):
-        if my_dat[i] == 'N' or (n_unknowns and my_dat[i] not in OK_CHR_ORD):
-            if n_count == 0:
-                prev_ni = i
-            n_count += 1
-            if i == len(my_dat) - 1:
-                n_atlas.append((prev_ni, prev_ni + n_count))
-        else:
-            if n_count > 0:
-                n_atlas.append((prev_ni, prev_ni + n_count))
-            n_count = 0
+    :param ref_path: string path to the reference
+    :return: BgzfReader for the reference
+    """
+    return BgzfReader(ref_path)
+
+
+def map_contigs(func, ref_path, ref_inds, args=(), threads=None):
+    """
+    Run func(ref_path, ref_inds_i, *args) for every contig of a reference, in a process pool with one task per
+    contig if there is more than one contig and cpu to go around. Results are yielded in contig order as they
+    become available, so callers can write them out without holding on to all of them.
 
-    # handle N base-calls as desired
-    # TODO this seems to randomly replace an N with a base. Is this necessary? How to do this in an immutable seq?
+    :param func: function to run, must be picklable
+    :param ref_path: string path to the reference
+    :param ref_inds: reference index, as returned by index_ref
+    :param args: further arguments for func, the same for every contig
+    :param threads: number of worker processes, defaults to the number of cpus
+    :return: generator of the results of func
+    """
+    if threads is None:
+        threads = os.cpu_count() or 1
+    threads = min(threads, len(ref_inds))
+    if threads > 1:
+        # lots of small contigs (e.g. scaffolds) are handed out in batches to cut down on inter-process traffic
+        chunk_size = max(1, len(ref_inds) // (4 * threads))
+        # forked workers must not reuse the parent's bgzip readers (their file handles and threads are shared)
+        with ProcessPoolExecutor(max_workers=threads, initializer=get_bgzf_reader.cache_clear) as executor:
+            yield from executor.map(func, [ref_path] * len(ref_inds), ref_inds,
+                                    *[[n] * len(ref_inds) for n in args], chunksize=chunk_size)
+    else:
+        for ref_inds_i in ref_inds:
+            yield func(ref_path, ref_inds_i, *args)
+
+
+def handle_n_regions(n_atlas, seq_len, n_handling):
+    """
+    Sort blocks of Ns into those we will fill in with real bases and those we will simulate around
+
+    :param n_atlas: list of (start, end) tuples giving solid blocks of Ns
+    :param seq_len: length of the contig
+    :param n_handling: tuple of (mode, max length of N region to fill, fill character)
+    :return: n_info dict ('all', 'big' and 'non_N' regions), and the list of (start, end) regions to be filled
+    """
     n_info = {'all': [], 'big': [], 'non_N': []}
-    if n_handling[0] == 'random':
+    fill_regions = []
+    if n_handling[0] == 'random' or (n_handling[0] == 'allChr' and n_handling[2] in OK_CHR_ORD):
         for region in n_atlas:
             n_info['all'].extend(region)
             if region[1] - region[0] <= n_handling[1]:
-                for i in range(region[0], region[1]):
-                    temp = my_dat.tomutable()
-                    temp[i] = random.choice(ALLOWED_NUCL)
-                    my_dat = temp.toseq()
-            else:
-                n_info['big'].extend(region)
-    elif n_handling[0] == 'allChr' and n_handling[2] in OK_CHR_ORD:
-        for region in n_atlas:
-            n_info['all'].extend(region)
-            if region[1] - region[0] <= n_handling[1]:
-                for i in range(region[0], region[1]):
-                    temp = my_dat.tomutable()
-                    temp[i] = n_handling[2]
-                    my_dat = temp.toseq()
+                fill_regions.append(region)
             else:
                 n_info['big'].extend(region)
     elif n_handling[0] == 'ignore':
@@ -158,94 +379,124 @@ def read_ref(ref_path, ref_inds_i, n_handling, n_unknowns=True, quiet=False):
 
     habitable_regions = []
     if not n_info['big']:
-        n_info['non_N'] = [(0, len(my_dat))]
+        n_info['non_N'] = [(0, seq_len)]
     else:
         for i in range(0, len(n_info['big']), 2):
             if i == 0:
                 habitable_regions.append((0, n_info['big'][0]))
             else:
                 habitable_regions.append((n_info['big'][i - 1], n_info['big'][i]))
-        habitable_regions.append((n_info['big'][-1], len(my_dat)))
+        habitable_regions.append((n_info['big'][-1], seq_len))
     for n in habitable_regions:
         if n[0] != n[1]:
             n_info['non_N'].append(n)
 
-    ref_file.close()
+    return n_info, fill_regions
 
-    if not quiet:
-        print('{0:.3f} (sec)'.format(time.time() - tt))
 
-    return my_dat, n_info
+def find_runs(mask: np.ndarray) -> list:
+    """
+    Find the solid blocks of True values in a boolean array
+
+    :param mask: boolean numpy array
+    :return: list of (start, end) tuples
+    """
+    if not mask.any():
+        return []
+    edges = np.diff(np.concatenate(([0], mask.view(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    return list(zip(starts.tolist(), ends.tolist()))
+
 
+def find_n_regions(my_dat, n_unknowns=True) -> list:
+    """
+    Find the solid blocks of Ns in a sequence
+
+    :param my_dat: upper case sequence, as bytes or a uint8 numpy array
+    :param n_unknowns: also treat any non-ACGTU character as an N
+    :return: n_atlas, list of (start, end) tuples
+    """
+    my_dat = np.frombuffer(my_dat, dtype=np.uint8) if isinstance(my_dat, bytes) else my_dat
+    if n_unknowns:
+        return find_runs(~OK_CHR_TABLE[my_dat])
+    return find_runs(my_dat == ord('N'))
+
+
+def n_fill_bases(fill_regions, n_handling) -> list:
+    """
+    Choose the replacement bases for the N regions we are filling in
 
-def get_all_ref_regions(ref_path, ref_inds, n_handling, save_output=False):
-    """
-    Find all non-N regions in reference sequence ahead of time, for computing jobs in parallel
-
-    :param ref_path:
-    :param ref_inds:
-    :param n_handling:
-    :param save_output:
-    :return:
-    """
-    out_regions = {}
-    fn = ref_path + '.nnr'
-    if os.path.isfile(fn) and not (save_output):
-        print('found list of preidentified non-N regions...')
-        f = open(fn, 'r')
-        for line in f:
-            splt = line.strip().split('\t')
-            if splt[0] not in out_regions:
-                out_regions[splt[0]] = []
-            out_regions[splt[0]].append((int(splt[1]), int(splt[2])))
-        f.close()
-        return out_regions
+    :param fill_regions: list of (start, end) regions to fill
+    :param n_handling: tuple of (mode, max length of N region to fill, fill character)
+    :return: list of (start, replacement string) tuples
+    """
+    if not fill_regions:
+        return []
+    total_len = sum([n[1] - n[0] for n in fill_regions])
+    if n_handling[0] == 'random':
+        # one random.choice per base, in the same order as always, so runs with the same --rng seed reproduce
+        all_fill = ''.join([random.choice(ALLOWED_NUCL) for _ in range(total_len)])
     else:
-        print('enumerating all non-N regions in reference sequence...')
-        for RI in range(len(ref_inds)):
-            (ref_sequence, N_regions) = read_ref(ref_path, ref_inds[RI], n_handling, quiet=True)
-            ref_name = ref_inds[RI][0]
-            out_regions[ref_name] = [n for n in N_regions['non_N']]
-        if save_output:
-            f = open(fn, 'w')
-            for k in out_regions.keys():
-                for n in out_regions[k]:
-                    f.write(k + '\t' + str(n[0]) + '\t' + str(n[1]) + '\n')
-            f.close()
-        return out_regions
-
-
-def partition_ref_regions(in_regions, ref_inds, my_job, n_jobs):
-    """
-    Find which of the non-N regions are going to be used for this job
-
-    :param in_regions:
-    :param ref_inds:
-    :param my_job:
-    :param n_jobs:
-    :return:
-    """
-    tot_size = 0
-    for RI in range(len(ref_inds)):
-        ref_name = ref_inds[RI][0]
-        for region in in_regions[ref_name]:
-            tot_size += region[1] - region[0]
-    size_per_job = int(tot_size / float(n_jobs) - 0.5)
-
-    regions_per_job = [[] for n in range(n_jobs)]
-    refs_per_job = [{} for n in range(n_jobs)]
-    current_ind = 0
-    current_count = 0
-    for RI in range(len(ref_inds)):
-        ref_name = ref_inds[RI][0]
-        for region in in_regions[ref_name]:
-            regions_per_job[current_ind].append((ref_name, region[0], region[1]))
-            refs_per_job[current_ind][ref_name] = True
-            current_count += region[1] - region[0]
-            if current_count >= size_per_job:
-                current_count = 0
-                current_ind = min([current_ind + 1, n_jobs - 1])
-
-    relevant_refs = refs_per_job[my_job - 1].keys()
-    relevant_regs = regions_per_job[my_job - 1]
-    return relevant_refs, relevant_regs
+        all_fill = n_handling[2] * total_len
+    fills = []
+    fill_pos = 0
+    for region in fill_regions:
+        fills.append((region[0], all_fill[fill_pos:fill_pos + region[1] - region[0]]))
+        fill_pos += region[1] - region[0]
+    return fills
+
+
+def apply_fills(bases, start, fill_starts, fill_seqs):
+    """
+    Write filled-in N regions over a decoded stretch of sequence, in place
+
+    :param bases: uint8 numpy array holding the sequence from start onwards
+    :param start: 0-based contig coordinate of bases[0]
+    :param fill_starts: sorted start coordinates of the filled regions
+    :param fill_seqs: replacement bytes for each filled region
+    """
+    end = start + len(bases)
+    i = max(0, bisect.bisect(fill_starts, start) - 1)
+    while i < len(fill_starts) and fill_starts[i] < end:
+        fill_start = fill_starts[i]
+        fill_seq = fill_seqs[i]
+        lo = max(fill_start, start)
+        hi = min(fill_start + len(fill_seq), end)
+        if lo < hi:
+            bases[lo - start:hi - start] = np.frombuffer(fill_seq[lo - fill_start:hi - fill_start], dtype=np.uint8)
+        i += 1
+
+
+def read_ref(ref_path, ref_inds_i, n_handling, n_unknowns=True, quiet=False, n_atlas=None):
+    tt = time.time()
+    if not quiet:
+        print('reading ' + ref_inds_i[0] + '... ')
+
+    # TODO convert to SeqIO containers
+    # for seq_record in SeqIO.parse(ref_file, "fasta"):
+    #     pass
+
+    my_dat = np.frombuffer(read_ref_bytes(ref_path, ref_inds_i), dtype=np.uint8).copy()
+
+    # find N regions, unless we were handed them (e.g. from the reference cache)
+    # data explanation: my_dat[n_atlas[0][0]:n_atlas[0][1]] = solid block of Ns
+    if n_atlas is None:
+        n_atlas = find_n_regions(my_dat, n_unknowns)
+
+    # handle N base-calls as desired, filling in all of the short N regions in a single write
+    (n_info, fill_regions) = handle_n_regions(n_atlas, len(my_dat), n_handling)
+    if fill_regions:
+        fill_starts = np.array([n[0] for n in fill_regions], dtype=np.int64)
+        fill_lens = np.array([n[1] - n[0] for n in fill_regions], dtype=np.int64)
+        fill_pos = np.repeat(fill_starts - (np.cumsum(fill_lens) - fill_lens), fill_lens) + \
+            np.arange(fill_lens.sum())
+        all_fill = ''.join([n[1] for n in n_fill_bases(fill_regions, n_handling)])
+        my_dat[fill_pos] = np.frombuffer(all_fill.encode(), dtype=np.uint8)
+
+    my_dat = Seq(my_dat.tobytes().decode())
+
+    if not quiet:
+        print('{0:.3f} (sec)'.format(time.time() - tt))
+
+    return my_dat, n_info
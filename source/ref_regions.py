@@ -0,0 +1,278 @@
+"""
+Enumerating the non-N regions of a reference ahead of time and splitting them into jobs, so that a large simulation
+can be spread over many independent runs.
+"""
+
+import time
+
+import numpy as np
+
+from source.ref_func import handle_n_regions, map_contigs
+from source.ref_cache import compute_contig_regions, open_regions_cache, save_regions_cache
+
+# cost of simulating mutations and setting up a window, per base, relative to the cost of sampling one read
+PER_BASE_COST = 0.05
+# bisection steps when searching for the best shard size (plenty to get within a read of the optimum)
+PARTITION_SEARCH_STEPS = 64
+
+
+def get_all_ref_regions(ref_path, ref_inds, n_handling, save_output=False, threads=None):
+    """
+    Find all non-N regions in reference sequence ahead of time, for computing jobs in parallel. Contigs are
+    scanned in a process pool, one task per contig, and the N regions are reused from [reference filename].nnr
+    when it was built from the same reference.
+
+    :param ref_path: string path to the reference
+    :param ref_inds: reference index, as returned by index_ref
+    :param n_handling: tuple of (mode, max length of N region to fill, fill character)
+    :param save_output: write the N regions to [reference filename].nnr for later runs
+    :param threads: number of worker processes, defaults to the number of cpus
+    :return: dict of contig name: list of (start, end) non-N regions
+    """
+    regions_cache = open_regions_cache(ref_path, ref_inds)
+    if regions_cache is not None and all([n[0] in regions_cache for n in ref_inds]):
+        print('found list of preidentified non-N regions...')
+        return {n[0]: regions_cache.contig(n[0]).non_n_list(n[3], n_handling) for n in ref_inds}
+
+    tt = time.time()
+    print('enumerating all non-N regions in reference sequence...')
+    contig_data = list(zip([n[0] for n in ref_inds], map_contigs(compute_contig_regions, ref_path, ref_inds,
+                                                                 threads=threads)))
+
+    if save_output:
+        save_regions_cache(ref_path, ref_inds, contig_data)
+
+    non_n_regions = {}
+    for (ref_inds_i, (_, arrays)) in zip(ref_inds, contig_data):
+        (n_info, _) = handle_n_regions([tuple(n) for n in arrays['n_atlas'].tolist()], ref_inds_i[3], n_handling)
+        non_n_regions[ref_inds_i[0]] = n_info['non_N']
+    print('{0:.3f} (sec)'.format(time.time() - tt))
+    return non_n_regions
+
+
+def region_windows(start, end, window_size, overlap):
+    """
+    The sampling windows gen_reads walks over a non-N region: windows of about window_size bases that overlap by
+    overlap bases, with the last one stretched to the end of the region
+
+    :param start: start of the region
+    :param end: end of the region
+    :param window_size: target window size
+    :param overlap: overlap between neighbouring windows
+    :return: numpy arrays of window starts and window ends
+    """
+    number_target_windows = max([1, (end - start) // window_size])
+    base_pair_distance = int((end - start) / float(number_target_windows))
+    stride = base_pair_distance - overlap
+    if stride <= 0 or base_pair_distance >= end - start:
+        return np.array([start], dtype=np.int64), np.array([end], dtype=np.int64)
+    last_window = (end - start - base_pair_distance) // stride
+    starts = start + stride * np.arange(last_window + 1, dtype=np.int64)
+    ends = starts + base_pair_distance
+    ends[-1] = end
+    return starts, ends
+
+
+def on_target_bases(target_bounds, starts, ends) -> np.ndarray:
+    """
+    :param target_bounds: targeted regions of a contig, in gen_reads' [-1, start, end, start, end, ...] form
+    :param starts: window starts
+    :param ends: window ends
+    :return: number of on-target bases in each window
+    """
+    bounds = np.array(target_bounds[1:], dtype=np.int64).reshape(-1, 2)
+    if not len(bounds):
+        return np.zeros(len(starts), dtype=np.int64)
+    # cumulative number of on-target bases before every region boundary
+    covered = np.concatenate(([0], np.cumsum(bounds[:, 1] - bounds[:, 0])))
+
+    def covered_before(pos):
+        i = np.searchsorted(bounds[:, 0], pos, side='right')
+        overhang = np.where(i > 0, np.maximum(bounds[np.maximum(i - 1, 0), 1] - pos, 0), 0)
+        return covered[i] - overhang
+
+    return covered_before(ends) - covered_before(starts)
+
+
+def on_target_mask(target_bounds, start, end) -> np.ndarray:
+    """
+    Which bases of a window are on target. Same as asking not bisect.bisect(target_bounds, j) % 2 for every base j,
+    but only the region boundaries inside the window are looked at.
+
+    :param target_bounds: sorted numpy array of the targeted regions of a contig, in gen_reads' [-1, start, end,
+                          start, end, ...] form
+    :param start: window start
+    :param end: window end
+    :return: bool array of length end - start
+    """
+    n_bases = max(end - start, 0)
+    # number of region boundaries <= start, and the boundaries that fall on a base inside the window
+    first = int(np.searchsorted(target_bounds, start, side='right'))
+    last = int(np.searchsorted(target_bounds, end - 1, side='right'))
+    crossings = np.cumsum(np.bincount(target_bounds[first:last] - start, minlength=n_bases)[:n_bases])
+    return (first + crossings) % 2 == 0
+
+
+class RegionCostModel:
+    """
+    Estimates how much work simulating a window is: the number of reads we expect to sample in it (coverage scaled
+    by the targeted / off-target scalars and, when reference cache gc counts are available, the gc model), plus a
+    small per-base cost for simulating mutations and setting the window up
+    """
+
+    def __init__(self, coverage, read_len, paired_end=False, target_regions=None, off_target_scalar=0.0,
+                 off_target_discard=False, gc_window_size=None, gc_scale_val=None, ref_cache=None):
+        """
+        :param coverage: average coverage
+        :param read_len: read length
+        :param paired_end: True if we are sampling read pairs
+        :param target_regions: dict of contig name: targeted regions, as gen_reads' input_regions (None if no bed)
+        :param off_target_scalar: coverage scalar for off-target bases
+        :param off_target_discard: True if off-target windows are skipped
+        :param gc_window_size: size of the gc window of the gc model
+        :param gc_scale_val: coverage scalar for every gc count of the gc model
+        :param ref_cache: ReferenceCache to read the gc counts of the contigs from, if available
+        """
+        self.coverage = coverage
+        self.read_len = read_len
+        self.paired_end = paired_end
+        self.target_regions = target_regions
+        self.off_target_scalar = off_target_scalar
+        self.off_target_discard = off_target_discard
+        self.gc_window_size = gc_window_size
+        self.gc_scale_val = None if gc_scale_val is None else np.asarray(gc_scale_val, dtype=np.float64)
+        self.ref_cache = ref_cache
+
+    def window_costs(self, ref_name, starts, ends) -> np.ndarray:
+        """
+        :param ref_name: contig name
+        :param starts: window starts
+        :param ends: window ends
+        :return: estimated cost of each window
+        """
+        spans = (ends - starts).astype(np.float64)
+        scalars = np.ones(len(starts))
+
+        if self.target_regions is not None:
+            if ref_name in self.target_regions:
+                on_target = on_target_bases(self.target_regions[ref_name], starts, ends)
+            else:
+                on_target = np.zeros(len(starts), dtype=np.int64)
+            scalars = (on_target + self.off_target_scalar * (spans - on_target)) / np.maximum(spans, 1)
+            if self.off_target_discard:
+                scalars[on_target <= self.read_len] = 0.0
+
+        contig_cache = None
+        if self.ref_cache is not None and self.gc_scale_val is not None:
+            contig_cache = self.ref_cache.contig(ref_name)
+        if contig_cache is not None:
+            # one gc count per gc window, as init_coverage uses them
+            gc_scalars = self.gc_scale_val[contig_cache.gc_window_counts(self.gc_window_size)]
+            gc_cumulative = np.concatenate(([0.0], np.cumsum(gc_scalars)))
+            first_window = starts // self.gc_window_size
+            last_window = np.maximum(-(-ends // self.gc_window_size), first_window + 1)
+            scalars = scalars * (gc_cumulative[last_window] - gc_cumulative[first_window]) / \
+                (last_window - first_window)
+
+        reads_per_base = self.coverage / float(self.read_len * (2 if self.paired_end else 1))
+        return spans * scalars * reads_per_base + spans * PER_BASE_COST
+
+
+def partition_all_ref_regions(in_regions, ref_inds, n_jobs, window_size=None, overlap=0, cost_model=None) -> list:
+    """
+    Split the non-N regions into n_jobs shards of about equal cost. Regions are cut into the same windows gen_reads
+    would use, and shards are runs of consecutive windows, so a region split across two jobs is cut at a window
+    boundary and the second piece starts overlap bases early, just like the next window would.
+
+    :param in_regions: dict of contig name: list of (start, end) non-N regions
+    :param ref_inds: reference index, as returned by index_ref
+    :param n_jobs: number of jobs
+    :param window_size: target window size (None to never split a region)
+    :param overlap: overlap between neighbouring windows
+    :param cost_model: RegionCostModel (None to use the number of bases as the cost)
+    :return: list of n_jobs lists of (contig name, start, end)
+    """
+    window_refs = []
+    window_regions = []
+    window_starts = []
+    window_ends = []
+    window_costs = []
+    region_count = 0
+    for ref_inds_i in ref_inds:
+        ref_name = ref_inds_i[0]
+        if ref_name not in in_regions or not in_regions[ref_name]:
+            continue
+        contig_starts = []
+        contig_ends = []
+        for region in in_regions[ref_name]:
+            if window_size is None:
+                (starts, ends) = (np.array([region[0]], dtype=np.int64), np.array([region[1]], dtype=np.int64))
+            else:
+                (starts, ends) = region_windows(region[0], region[1], window_size, overlap)
+            contig_starts.append(starts)
+            contig_ends.append(ends)
+            window_regions.append(np.full(len(starts), region_count, dtype=np.int64))
+            region_count += 1
+        (starts, ends) = (np.concatenate(contig_starts), np.concatenate(contig_ends))
+        window_refs.extend([ref_name] * len(starts))
+        window_starts.append(starts)
+        window_ends.append(ends)
+        if cost_model is None:
+            window_costs.append((ends - starts).astype(np.float64))
+        else:
+            window_costs.append(cost_model.window_costs(ref_name, starts, ends))
+    if not window_refs:
+        return [[] for _ in range(n_jobs)]
+    (window_regions, window_starts, window_ends, window_costs) = \
+        [np.concatenate(n) for n in (window_regions, window_starts, window_ends, window_costs)]
+
+    # binary search for the smallest maximum shard cost we can achieve with contiguous shards
+    cumulative_cost = np.concatenate(([0.0], np.cumsum(window_costs)))
+
+    def shard_cuts(max_cost):
+        cuts = [0]
+        while cuts[-1] < len(window_costs):
+            next_cut = int(np.searchsorted(cumulative_cost, cumulative_cost[cuts[-1]] + max_cost, side='right')) - 1
+            cuts.append(max(next_cut, cuts[-1] + 1))
+        return cuts
+
+    (lo, hi) = (float(window_costs.max()), float(cumulative_cost[-1]))
+    for _ in range(PARTITION_SEARCH_STEPS):
+        mid = (lo + hi) / 2.
+        if len(shard_cuts(mid)) - 1 <= n_jobs:
+            hi = mid
+        else:
+            lo = mid
+    cuts = shard_cuts(hi)
+
+    window_jobs = np.zeros(len(window_costs), dtype=np.int64)
+    for job in range(len(cuts) - 1):
+        window_jobs[cuts[job]:cuts[job + 1]] = job
+    # a new piece starts wherever the region or the job changes
+    piece_starts = np.flatnonzero(np.concatenate(([True], (np.diff(window_regions) != 0) |
+                                                  (np.diff(window_jobs) != 0))))
+    piece_ends = np.concatenate((piece_starts[1:], [len(window_costs)])) - 1
+
+    shards = [[] for _ in range(n_jobs)]
+    for (first, last) in zip(piece_starts.tolist(), piece_ends.tolist()):
+        shards[window_jobs[first]].append((window_refs[first], int(window_starts[first]), int(window_ends[last])))
+    return shards
+
+
+def partition_ref_regions(in_regions, ref_inds, my_job, n_jobs, window_size=None, overlap=0, cost_model=None):
+    """
+    Find which of the non-N regions are going to be used for this job
+
+    :param in_regions: dict of contig name: list of (start, end) non-N regions
+    :param ref_inds: reference index, as returned by index_ref
+    :param my_job: this job's number, from 1 to n_jobs
+    :param n_jobs: number of jobs
+    :param window_size: target window size (None to never split a region)
+    :param overlap: overlap between neighbouring windows
+    :param cost_model: RegionCostModel (None to use the number of bases as the cost)
+    :return: the contig names and the list of (contig name, start, end) regions for this job
+    """
+    relevant_regs = partition_all_ref_regions(in_regions, ref_inds, n_jobs, window_size, overlap,
+                                              cost_model)[my_job - 1]
+    relevant_refs = {n[0]: True for n in relevant_regs}.keys()
+    return relevant_refs, relevant_regs
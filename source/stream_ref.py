@@ -0,0 +1,175 @@
+"""
+Streaming reference reader. Instead of loading a whole chromosome, a StreamingContig reads the bases of each
+sampling window straight out of the fasta (using the line layout from the .fai) the first time they are asked for,
+plus a small read-ahead, so memory use is bounded by the window size rather than the largest contig.
+"""
+
+import sys
+import time
+import gzip
+import pathlib
+
+import numpy as np
+from Bio.Seq import Seq
+
+from source.ref_func import get_bgzf_reader, is_bgzf, find_n_regions, handle_n_regions, n_fill_bases, apply_fills
+
+# how many bases to read past the end of each request, so consecutive windows mostly come out of the buffer
+STREAM_READ_AHEAD = 2 ** 18
+# how many bases to look at at once when scanning a contig for N regions
+STREAM_SCAN_CHUNK = 2 ** 22
+
+
+class StreamingContig:
+    """
+    A single contig of the reference, read on demand. Slicing it returns a Bio.Seq of just the requested region.
+    """
+
+    def __init__(self, ref_path, ref_inds_i, read_ahead=STREAM_READ_AHEAD):
+        self.ref_path = pathlib.Path(ref_path)
+        self.name = ref_inds_i[0]
+        self.offset = ref_inds_i[1]
+        self.seq_len = ref_inds_i[3]
+        (self.line_bases, self.line_width) = ref_inds_i[4:6]
+        if self.seq_len and self.line_bases <= 0:
+            print('\nProblem reading the reference index: ' + self.name + ' has lines of uneven length, so it '
+                  'can not be streamed. Use --ref-store packed or memory instead.\n')
+            sys.exit(1)
+        self.read_ahead = read_ahead
+
+        self.bgzf_reader = None
+        self.file = None
+        if self.ref_path.suffix == '.gz' and is_bgzf(self.ref_path):
+            self.bgzf_reader = get_bgzf_reader(str(self.ref_path))
+        elif self.ref_path.suffix == '.gz':
+            # plain gzip can only seek by decompressing, which is fine as long as we mostly move forward
+            self.file = gzip.open(self.ref_path, 'rb')
+        else:
+            self.file = open(self.ref_path, 'rb')
+
+        # the buffered stretch of sequence: buffer holds [buffer_start, buffer_start + len(buffer))
+        self.buffer_start = 0
+        self.buffer = np.zeros(0, dtype=np.uint8)
+        # (start, replacement string) for N regions that are filled in with real bases, sorted by start
+        self.fill_starts = []
+        self.fill_seqs = []
+
+    def __len__(self):
+        return self.seq_len
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError('StreamingContig only supports contiguous slices')
+        (start, end, _) = key.indices(self.seq_len)
+        return Seq(self.fetch(start, max(start, end)).decode())
+
+    def byte_offset(self, pos) -> int:
+        """
+        :param pos: 0-based contig coordinate
+        :return: byte offset of that base in the (uncompressed) fasta
+        """
+        return self.offset + (pos // self.line_bases) * self.line_width + pos % self.line_bases
+
+    def read_bases(self, start, end) -> bytes:
+        """
+        Read the region [start, end) from the file, without any N handling
+
+        :param start: 0-based start coordinate
+        :param end: 0-based end coordinate (exclusive)
+        :return: sequence as upper case ascii bytes
+        """
+        if end <= start:
+            return b''
+        byte_start = self.byte_offset(start)
+        byte_len = self.byte_offset(end - 1) + 1 - byte_start
+        if self.bgzf_reader is not None:
+            my_dat = self.bgzf_reader.read(byte_start, byte_len)
+        else:
+            self.file.seek(byte_start)
+            my_dat = self.file.read(byte_len)
+        return my_dat.translate(None, b'\r\n').upper()
+
+    def n_regions(self, n_unknowns=True) -> list:
+        """
+        Scan the contig for solid blocks of Ns, a chunk at a time
+
+        :param n_unknowns: also treat any non-ACGTU character as an N
+        :return: list of (start, end) tuples
+        """
+        n_atlas = []
+        for chunk_start in range(0, self.seq_len, STREAM_SCAN_CHUNK):
+            chunk_end = min(chunk_start + STREAM_SCAN_CHUNK, self.seq_len)
+            for (start, end) in find_n_regions(self.read_bases(chunk_start, chunk_end), n_unknowns):
+                # stitch together N regions that run across a chunk boundary
+                if n_atlas and n_atlas[-1][1] == chunk_start + start:
+                    n_atlas[-1] = (n_atlas[-1][0], chunk_start + end)
+                else:
+                    n_atlas.append((chunk_start + start, chunk_start + end))
+        return n_atlas
+
+    def set_fills(self, fills):
+        """
+        :param fills: list of (start, replacement string) tuples for N regions that should read as real bases
+        """
+        fills = sorted(fills)
+        self.fill_starts = [n[0] for n in fills]
+        self.fill_seqs = [n[1].encode() for n in fills]
+        self.buffer = np.zeros(0, dtype=np.uint8)
+
+    def fetch(self, start, end) -> bytes:
+        """
+        Get the region [start, end) of the contig, refilling the read-ahead buffer if it isn't already there
+
+        :param start: 0-based start coordinate
+        :param end: 0-based end coordinate (exclusive)
+        :return: sequence as upper case ascii bytes
+        """
+        buffer_end = self.buffer_start + len(self.buffer)
+        if start < self.buffer_start or end > buffer_end:
+            new_end = min(max(end, start + self.read_ahead), self.seq_len)
+            # windows overlap, so hang on to the part of the buffer we already have
+            if self.buffer_start <= start < buffer_end:
+                kept = self.buffer[start - self.buffer_start:]
+                new_bases = np.frombuffer(self.read_bases(buffer_end, new_end), dtype=np.uint8).copy()
+                apply_fills(new_bases, buffer_end, self.fill_starts, self.fill_seqs)
+                self.buffer = np.concatenate((kept, new_bases))
+            else:
+                self.buffer = np.frombuffer(self.read_bases(start, new_end), dtype=np.uint8).copy()
+                apply_fills(self.buffer, start, self.fill_starts, self.fill_seqs)
+            self.buffer_start = start
+        return self.buffer[start - self.buffer_start:end - self.buffer_start].tobytes()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        self.buffer = np.zeros(0, dtype=np.uint8)
+
+
+def read_streaming_ref(ref_path, ref_inds_i, n_handling, n_unknowns=True, quiet=False, n_atlas=None):
+    """
+    Streaming counterpart of read_ref. The contig is scanned once for N regions, in chunks, and after that bases
+    are only read as windows ask for them. Filled in N regions are recorded on the contig and applied as bases
+    are read.
+
+    :param ref_path: string path to the reference
+    :param ref_inds_i: reference index entry for the contig, as returned by index_ref
+    :param n_handling: tuple of (mode, max length of N region to fill, fill character)
+    :param n_unknowns: also treat any non-ACGTU character as an N
+    :param quiet: suppress progress output
+    :param n_atlas: N regions of the contig, if already known (e.g. from the reference cache)
+    :return: StreamingContig and n_info dict, as read_ref
+    """
+    tt = time.time()
+    if not quiet:
+        print('reading ' + ref_inds_i[0] + '... ')
+
+    my_dat = StreamingContig(ref_path, ref_inds_i)
+    if n_atlas is None:
+        n_atlas = my_dat.n_regions(n_unknowns)
+    (n_info, fill_regions) = handle_n_regions(n_atlas, len(my_dat), n_handling)
+    my_dat.set_fills(n_fill_bases(fill_regions, n_handling))
+
+    if not quiet:
+        print('{0:.3f} (sec)'.format(time.time() - tt))
+
+    return my_dat, n_info
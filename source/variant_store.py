@@ -0,0 +1,303 @@
+"""
+Column-wise storage for the input variants of one contig. Instead of a list of tuples of lists of strings, every
+field lives in a numpy array (or one shared byte buffer for the alleles), so that checking thousands of variants
+against the reference is a handful of array operations, and tuples are only built for the variants of the window
+being simulated.
+"""
+
+import numpy as np
+
+# ALT_OK_TABLE[ascii code] = True for the bases an inserted alt allele may contain
+ALT_OK_TABLE = np.zeros(256, dtype=bool)
+ALT_OK_TABLE[[ord(n) for n in 'ACGT']] = True
+N_CHAR = ord('N')
+# roughly how much reference sequence to fetch at once when validating variants
+VALIDATE_CHUNK_SIZE = 2 ** 22
+
+
+def ragged_index(starts, lens) -> np.ndarray:
+    """
+    :param starts: start of each span
+    :param lens: length of each span
+    :return: the indices covered by all of the spans, one span after the other
+    """
+    lens = np.asarray(lens, dtype=np.int64)
+    return np.repeat(np.asarray(starts, dtype=np.int64) - (np.cumsum(lens) - lens), lens) + np.arange(lens.sum())
+
+
+def span_any(values, lens) -> np.ndarray:
+    """
+    :param values: boolean array of all the spans, one after the other
+    :param lens: length of each span
+    :return: for every span, whether any of its values is True (False for empty spans)
+    """
+    counts = np.concatenate(([0], np.cumsum(values, dtype=np.int64)))
+    ends = np.cumsum(lens)
+    return counts[ends] - counts[ends - lens] > 0
+
+
+class VariantStore:
+    """
+    Input variants of one contig, sorted by position:
+        positions:              1-based VCF position, int64
+        alleles:                every ref and alt allele back to back, as ascii bytes (uint8)
+        ref_offsets, ref_lens:  where each variant's ref allele is in alleles
+        alt_starts, alt_counts: which entries of alt_offsets / alt_lens hold each variant's alt alleles
+        af_starts, af_counts:   which entries of afs hold each variant's allele frequencies (nan for unknown)
+        gt_known:               whether each sample has a genotype, bool (variants, samples)
+        gt_fields:              number of alleles in each genotype (0 if it has no / or | separator)
+        gt_masks:               bitmask of the alleles that are '1', np.packbits over the allele index
+                                (variants, samples, bytes)
+    """
+
+    def __init__(self, variants=()):
+        """
+        :param variants: list of (pos, ref, alt alleles, alt freqs, genotypes) tuples, as parse_vcf produces them
+        """
+        variants = list(variants)
+        n_samples = max([len(n[4]) for n in variants], default=1)
+
+        allele_strs = []
+        ref_lens = []
+        alt_lens = []
+        alt_counts = []
+        afs = []
+        af_counts = []
+        # (variant, sample) of every known genotype, its number of fields, and (variant, sample, field) of every '1'
+        gt_known_at = ([], [])
+        gt_n_fields = []
+        gt_ones_at = ([], [], [])
+        # genotype string: (number of fields, which fields are '1'). There are only a handful of distinct genotypes,
+        # so each is only split once.
+        gt_parsed = {}
+        for (i, n) in enumerate(variants):
+            allele_strs.append(n[1])
+            ref_lens.append(len(n[1]))
+            allele_strs.extend(n[2])
+            alt_lens.extend([len(alt) for alt in n[2]])
+            alt_counts.append(len(n[2]))
+            afs.extend([np.nan if af is None else af for af in n[3]])
+            af_counts.append(len(n[3]))
+            for (j, gt) in enumerate(n[4]):
+                if gt is not None:
+                    if gt not in gt_parsed:
+                        fields = gt.replace('|', '/').split('/') if ('/' in gt or '|' in gt) else []
+                        gt_parsed[gt] = (len(fields), [k for (k, allele) in enumerate(fields) if allele == '1'])
+                    (n_fields, ones) = gt_parsed[gt]
+                    gt_known_at[0].append(i)
+                    gt_known_at[1].append(j)
+                    gt_n_fields.append(n_fields)
+                    for k in ones:
+                        gt_ones_at[0].append(i)
+                        gt_ones_at[1].append(j)
+                        gt_ones_at[2].append(k)
+        max_fields = max([n[0] for n in gt_parsed.values()], default=0)
+        gt_known = np.zeros((len(variants), n_samples), dtype=bool)
+        gt_known[gt_known_at] = True
+        gt_fields = np.zeros((len(variants), n_samples), dtype=np.uint16)
+        gt_fields[gt_known_at] = gt_n_fields
+        gt_bits = np.zeros((len(variants), n_samples, max(max_fields, 1)), dtype=bool)
+        gt_bits[gt_ones_at] = True
+
+        self.positions = np.array([n[0] for n in variants], dtype=np.int64)
+        self.alleles = np.frombuffer(''.join(allele_strs).encode(), dtype=np.uint8)
+        # ref allele, then its alt alleles, for every variant
+        all_lens = np.array([len(n) for n in allele_strs], dtype=np.int64)
+        all_offsets = np.cumsum(all_lens) - all_lens
+        alt_counts = np.array(alt_counts, dtype=np.int64)
+        is_ref = np.zeros(len(all_lens), dtype=bool)
+        is_ref[(np.cumsum(alt_counts + 1) - alt_counts - 1)[:len(variants)]] = True
+        self.ref_offsets = all_offsets[is_ref]
+        self.ref_lens = np.array(ref_lens, dtype=np.int64)
+        self.alt_offsets = all_offsets[~is_ref]
+        self.alt_lens = np.array(alt_lens, dtype=np.int64)
+        self.alt_starts = np.cumsum(alt_counts) - alt_counts
+        self.alt_counts = alt_counts
+        self.afs = np.array(afs, dtype=np.float64)
+        self.af_counts = np.array(af_counts, dtype=np.int64)
+        self.af_starts = np.cumsum(self.af_counts) - self.af_counts
+        self.gt_known = gt_known
+        self.gt_fields = gt_fields
+        self.gt_masks = np.packbits(gt_bits, axis=2)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def take(self, indices):
+        """
+        :param indices: integer or boolean array selecting variants
+        :return: VariantStore holding just those variants (the allele and frequency buffers are shared)
+        """
+        subset = VariantStore()
+        for name in ('positions', 'ref_offsets', 'ref_lens', 'alt_starts', 'alt_counts', 'af_starts', 'af_counts',
+                     'gt_known', 'gt_fields', 'gt_masks'):
+            setattr(subset, name, getattr(self, name)[indices])
+        for name in ('alleles', 'alt_offsets', 'alt_lens', 'afs'):
+            setattr(subset, name, getattr(self, name))
+        return subset
+
+    def allele(self, offset, length) -> str:
+        return self.alleles[offset:offset + length].tobytes().decode()
+
+    def genotype(self, i, j):
+        """
+        :param i: variant index
+        :param j: sample index
+        :return: genotype string, which allele of each ploid is '1' (None if the variant had no genotype)
+        """
+        if not self.gt_known[i, j]:
+            return None
+        n_fields = int(self.gt_fields[i, j])
+        if not n_fields:
+            return '1'
+        bits = np.unpackbits(self.gt_masks[i, j])[:n_fields]
+        return '/'.join(['1' if n else '0' for n in bits])
+
+    def variant(self, i, pos_offset=0) -> tuple:
+        """
+        :param i: variant index
+        :param pos_offset: added to the position (e.g. -1 to go from VCF coords to array coords)
+        :return: (pos, ref, alt alleles, alt freqs, genotypes) tuple, as parse_vcf used to produce them
+        """
+        alt_range = range(self.alt_starts[i], self.alt_starts[i] + self.alt_counts[i])
+        af_range = range(self.af_starts[i], self.af_starts[i] + self.af_counts[i])
+        return (int(self.positions[i]) + pos_offset,
+                self.allele(self.ref_offsets[i], self.ref_lens[i]),
+                [self.allele(self.alt_offsets[k], self.alt_lens[k]) for k in alt_range],
+                [None if np.isnan(self.afs[k]) else float(self.afs[k]) for k in af_range],
+                [self.genotype(i, j) for j in range(self.gt_known.shape[1])])
+
+    def indel_spans(self) -> np.ndarray:
+        """
+        :return: for every variant, the largest length difference between its ref and any alt allele (at least 1)
+        """
+        if not len(self):
+            return np.zeros(0, dtype=np.int64)
+        alt_index = ragged_index(self.alt_starts, self.alt_counts)
+        spans = np.maximum(np.abs(np.repeat(self.ref_lens, self.alt_counts) - self.alt_lens[alt_index]), 1)
+        return np.maximum.reduceat(spans, np.cumsum(self.alt_counts) - self.alt_counts)
+
+    def check_against_reference(self, ref_sequence):
+        """
+        Prune invalid input variants, e.g variants that:
+            - don't match the reference base at their specified position
+            - try to delete or alter any N characters
+            - any alt allele contains anything other than allowed characters
+
+        :param ref_sequence: the contig, anything that returns a Bio.Seq when sliced
+        :return: VariantStore of the valid variants, and the number of variants skipped for each reason
+        """
+        n_variants = len(self)
+        ref_mismatch = np.zeros(n_variants, dtype=bool)
+        ref_has_n = np.zeros(n_variants, dtype=bool)
+        seq_len = len(ref_sequence)
+
+        # compare ref alleles to the reference a chunk at a time, so we never need more than a chunk of sequence
+        chunk_start = 0
+        while chunk_start < n_variants:
+            chunk_end = max(chunk_start + 1, int(np.searchsorted(
+                self.positions, self.positions[chunk_start] + VALIDATE_CHUNK_SIZE, side='left')))
+            chunk = slice(chunk_start, chunk_end)
+            # -1 because going from VCF coords to array coords
+            (starts, lens) = (self.positions[chunk] - 1, self.ref_lens[chunk])
+            ref_start = min(max(int(starts[0]), 0), seq_len)
+            ref_end = min(max(int((starts + lens).max()), ref_start), seq_len)
+            ref_dat = np.frombuffer(str(ref_sequence[ref_start:ref_end]).encode(), dtype=np.uint8)
+
+            # alleles that run off either end of the contig can't match
+            in_bounds = (starts >= 0) & (starts + lens <= seq_len)
+            ref_index = ragged_index(starts[in_bounds] - ref_start, lens[in_bounds])
+            allele_index = ragged_index(self.ref_offsets[chunk][in_bounds], lens[in_bounds])
+            chunk_mismatch = ~in_bounds
+            chunk_mismatch[in_bounds] = span_any(ref_dat[ref_index] != self.alleles[allele_index],
+                                                 lens[in_bounds])
+            ref_mismatch[chunk] = chunk_mismatch
+            ref_has_n[chunk] = span_any(self.alleles[ragged_index(self.ref_offsets[chunk], lens)] == N_CHAR, lens)
+            chunk_start = chunk_end
+
+        # alt alleles with anything but ACGT in them
+        alt_bad = span_any(~ALT_OK_TABLE[self.alleles[ragged_index(self.alt_offsets, self.alt_lens)]],
+                           self.alt_lens)
+        any_bad_nucl = span_any(alt_bad[ragged_index(self.alt_starts, self.alt_counts)], self.alt_counts)
+
+        # each variant is only counted under the first check it fails
+        n_skipped = [int(ref_mismatch.sum()),
+                     int((ref_has_n & ~ref_mismatch).sum()),
+                     int((any_bad_nucl & ~ref_has_n & ~ref_mismatch).sum())]
+        return self.take(~(ref_mismatch | ref_has_n | any_bad_nucl)), n_skipped
+
+
+def concatenate_stores(stores) -> VariantStore:
+    """
+    :param stores: list of VariantStores
+    :return: VariantStore holding the variants of all of them, one store after the other
+    """
+    merged = VariantStore()
+    if not stores:
+        return merged
+    # stores built from different records may have room for a different number of samples / genotype fields
+    n_samples = max([n.gt_known.shape[1] for n in stores])
+    n_mask_bytes = max([n.gt_masks.shape[2] for n in stores])
+    allele_shifts = np.cumsum([0] + [len(n.alleles) for n in stores])
+    alt_shifts = np.cumsum([0] + [len(n.alt_offsets) for n in stores])
+    af_shifts = np.cumsum([0] + [len(n.afs) for n in stores])
+
+    merged.positions = np.concatenate([n.positions for n in stores])
+    merged.alleles = np.concatenate([n.alleles for n in stores])
+    merged.ref_offsets = np.concatenate([n.ref_offsets + allele_shifts[i] for (i, n) in enumerate(stores)])
+    merged.ref_lens = np.concatenate([n.ref_lens for n in stores])
+    merged.alt_offsets = np.concatenate([n.alt_offsets + allele_shifts[i] for (i, n) in enumerate(stores)])
+    merged.alt_lens = np.concatenate([n.alt_lens for n in stores])
+    merged.alt_starts = np.concatenate([n.alt_starts + alt_shifts[i] for (i, n) in enumerate(stores)])
+    merged.alt_counts = np.concatenate([n.alt_counts for n in stores])
+    merged.afs = np.concatenate([n.afs for n in stores])
+    merged.af_starts = np.concatenate([n.af_starts + af_shifts[i] for (i, n) in enumerate(stores)])
+    merged.af_counts = np.concatenate([n.af_counts for n in stores])
+    merged.gt_known = np.concatenate([np.pad(n.gt_known, ((0, 0), (0, n_samples - n.gt_known.shape[1])))
+                                      for n in stores])
+    merged.gt_fields = np.concatenate([np.pad(n.gt_fields, ((0, 0), (0, n_samples - n.gt_fields.shape[1])))
+                                       for n in stores])
+    merged.gt_masks = np.concatenate([np.pad(n.gt_masks, ((0, 0), (0, n_samples - n.gt_masks.shape[1]),
+                                                          (0, n_mask_bytes - n.gt_masks.shape[2])))
+                                      for n in stores])
+    return merged
+
+
+class VariantIndex:
+    """
+    Position index over the variants of one contig, built once per contig, for finding the variants in a window
+    and how far past its end they reach with binary searches instead of scanning. The reach of each variant is
+    position + indel span, and range maxima of it are answered from a sparse table (level k holds the maximum of
+    every run of 2 ** k consecutive variants).
+    """
+
+    def __init__(self, positions, spans):
+        """
+        :param positions: sorted variant positions
+        :param spans: how far past its position each variant reaches (e.g. VariantStore.indel_spans())
+        """
+        self.positions = np.asarray(positions, dtype=np.int64)
+        self.reach_table = [self.positions + np.asarray(spans, dtype=np.int64)]
+        level = 1
+        while 2 * level <= len(self.positions):
+            prev = self.reach_table[-1]
+            self.reach_table.append(np.maximum(prev[:-level], prev[level:]))
+            level *= 2
+
+    def window(self, start, end):
+        """
+        :param start: window start
+        :param end: window end
+        :return: index range [first, last) of the variants with start < position < end
+        """
+        return (int(np.searchsorted(self.positions, start, side='right')),
+                int(np.searchsorted(self.positions, end, side='left')))
+
+    def max_reach(self, first, last) -> int:
+        """
+        :param first: first variant index
+        :param last: last variant index (exclusive), must be > first
+        :return: largest position + span among the variants in [first, last)
+        """
+        k = (last - first).bit_length() - 1
+        return int(max(self.reach_table[k][first], self.reach_table[k][last - (1 << k)]))
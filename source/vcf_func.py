@@ -1,198 +1,629 @@
 import sys
 import time
 import os
-import re
 import random
+import copy
 import gzip
+import functools
+import itertools
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 
-def parse_line(vcf_line, col_dict, col_samp):
+from source.variant_store import VariantStore, concatenate_stores
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+TABIX_INDEX_SUFFIXES = ('.tbi', '.csi')
+# how many VCF lines to read in before parsing them
+VCF_BATCH_SIZE = 2 ** 16
+# uncompressed VCFs are parsed in byte ranges of about this size, in a process pool if there is more than one (a fixed
+# size rather than one range per process, so the made up genotypes come out the same no matter how many cpus there are)
+VCF_RANGE_SIZE = 2 ** 24
+
+
+def info_value(info, key):
+    """
+    :param info: INFO column of a VCF record
+    :param key: INFO key to look up, e.g. AF
+    :return: the value of that key, or None if it isn't there (or is a flag without a value)
+    """
+    start = (';' + info).find(';' + key + '=')
+    if start < 0:
+        return None
+    start += len(key) + 1
+    end = info.find(';', start)
+    return info[start:] if end < 0 else info[start:end]
+
+
+@functools.lru_cache(maxsize=None)
+def format_gt_index(fmt):
+    """
+    :param fmt: FORMAT column of a VCF record (there are usually only a handful of distinct ones per file)
+    :return: index of the GT field, or None if there isn't one
+    """
+    fmt = fmt.split(':')
+    return fmt.index('GT') if 'GT' in fmt else None
+
+
+def parse_line(vcf_line, col_dict, col_samp, n_samples=None):
+    """
+    Parse the alleles, allele frequencies and genotypes out of a VCF record. INFO and FORMAT are only looked
+    at for the keys we need, and only the sample columns we need are split.
+
+    :param vcf_line: VCF record, already split on tabs
+    :param col_dict: dict of column name: index, from the header
+    :param col_samp: indices of the sample columns
+    :param n_samples: how many sample columns to read genotypes from (None for all of them)
+    :return: alt alleles, alt freqs and genotypes, or None if the record should be skipped
+    """
     # these were in the original. Not sure the point other than debugging.
     include_homs = False
     include_fail = False
 
-    # check if we want to proceed...
-    reference_allele = vcf_line[col_dict['REF']]
-    alternate_allele = vcf_line[col_dict['ALT']]
     # enough columns?
     if len(vcf_line) != len(col_dict):
         return None
+    # check if we want to proceed...
+    reference_allele = vcf_line[col_dict['REF']]
+    alternate_allele = vcf_line[col_dict['ALT']]
     # exclude homs / filtered?
     if not include_homs and alternate_allele == '.' or alternate_allele == '' or alternate_allele == reference_allele:
         return None
-    if not include_fail and vcf_line[col_dict['FILTER']] != 'PASS' and vcf_line[col_dict['FILTER']] != '.':
+    filter_val = vcf_line[col_dict['FILTER']]
+    if not include_fail and filter_val != 'PASS' and filter_val != '.':
         return None
 
-    #	default vals
-    alt_alleles = [alternate_allele]
-    alt_freqs = []
-
-    gt_per_samp = []
-
-    #	any alt alleles?
-    alt_split = alternate_allele.split(',')
-    if len(alt_split) > 1:
-        alt_alleles = alt_split
+    alt_alleles = alternate_allele.split(',')
+    info = vcf_line[col_dict['INFO']] if 'INFO' in col_dict else ''
 
     #	check INFO for AF
-    af = None
-    if 'INFO' in col_dict and ';AF=' in ';' + vcf_line[col_dict['INFO']]:
-        info = vcf_line[col_dict['INFO']] + ';'
-        af = re.findall(r"AF=.*?(?=;)", info)[0][3:]
-    if af is not None:
-        af_splt = af.split(',')
-        while (len(af_splt) < len(alt_alleles)):  # are we lacking enough AF values for some reason?
-            af_splt.append(af_splt[-1])  # phone it in.
-        if len(af_splt) != 0 and af_splt[0] != '.' and af_splt[0] != '':  # missing data, yay
-            alt_freqs = [float(n) for n in af_splt]
-    else:
-        alt_freqs = [None] * max([len(alt_alleles), 1])
+    af = info_value(info, 'AF') if info else None
+    alt_freqs = allele_freqs(None if af is None else af.split(','), len(alt_alleles))
 
     gt_per_samp = None
-    #	if available (i.e. we simulated it) look for WP in info
-    if len(col_samp) == 0 and 'INFO' in col_dict and 'WP=' in vcf_line[col_dict['INFO']]:
-        info = vcf_line[col_dict['INFO']] + ';'
-        gt_per_samp = [re.findall(r"WP=.*?(?=;)", info)[0][3:]]
+    if not col_samp:
+        #	if available (i.e. we simulated it) look for WP in info, otherwise check info for GT
+        if info:
+            gt = info_value(info, 'WP')
+            if gt is None:
+                gt = info_value(info, 'GT')
+            if gt is not None:
+                gt_per_samp = [gt]
     else:
-        #	if no sample columns, check info for GT
-        if len(col_samp) == 0 and 'INFO' in col_dict and 'GT=' in vcf_line[col_dict['INFO']]:
-            info = vcf_line[col_dict['INFO']] + ';'
-            gt_per_samp = [re.findall(r"GT=.*?(?=;)", info)[0][3:]]
-        elif len(col_samp):
-            fmt = ':' + vcf_line[col_dict['FORMAT']] + ':'
-            if ':GT:' in fmt:
-                gt_ind = fmt.split(':').index('GT')
-                gt_per_samp = [vcf_line[col_samp[iii]].split(':')[gt_ind - 1] for iii in range(len(col_samp))]
-                for i in range(len(gt_per_samp)):
-                    gt_per_samp[i] = gt_per_samp[i].replace('.', '0')
-        if gt_per_samp is None:
-            gt_per_samp = [None] * max([len(col_samp), 1])
+        gt_ind = format_gt_index(vcf_line[col_dict['FORMAT']])
+        if gt_ind is not None:
+            gt_per_samp = [vcf_line[n].split(':', gt_ind + 1)[gt_ind].replace('.', '0')
+                           for n in col_samp[:n_samples]]
+    if gt_per_samp is None:
+        gt_per_samp = [None] * max(len(col_samp[:n_samples]), 1)
 
     return alt_alleles, alt_freqs, gt_per_samp
 
 
-def parse_vcf(vcf_path, tumor_normal=False, ploidy=2):
-    # this var was in the orig. May have just been a debugging thing.
-    # I think this is trying to implement a check on GT
-    choose_random_ploid_if_no_gt_found = True
+def allele_freqs(af_splt, n_alts) -> list:
+    """
+    :param af_splt: the AF values of a record as strings, or None if it has no AF
+    :param n_alts: number of alt alleles
+    :return: list of alt freqs (None for each alt allele if there is no AF, empty if AF is missing data)
+    """
+    if af_splt is None:
+        return [None] * n_alts
+    while len(af_splt) < n_alts:  # are we lacking enough AF values for some reason?
+        af_splt.append(af_splt[-1])  # phone it in.
+    if af_splt[0] != '.' and af_splt[0] != '':  # missing data, yay
+        return [float(n) for n in af_splt]
+    return []
 
-    tt = time.time()
-    print('--------------------------------')
-    print('reading input VCF...\n', flush=True)
 
-    col_dict = {}
-    col_samp = []
-    n_skipped = 0
-    n_skipped_because_hash = 0
-    all_vars = {}  # [ref][pos]
-    samp_names = []
-    printed_warning = False
-
-    f = None
-    if vcf_path.endswith('.gz'):
-        f = gzip.open(vcf_path)
+def info_strings(value) -> list:
+    """
+    :param value: an INFO value as pysam returns it: a scalar, a tuple, or a comma separated string
+    :return: list of the values as they would read in the VCF text
+    """
+    if isinstance(value, str):
+        return value.split(',')
+    if not isinstance(value, tuple):
+        value = (value,)
+    # floats are decoded to single precision, which is where the shortest repr comes from
+    return ['.' if n is None else str(np.float32(n)) if isinstance(n, float) else str(n) for n in value]
+
+
+def parse_pysam_record(record, n_samples=None):
+    """
+    pysam counterpart of parse_line
+
+    :param record: pysam.VariantRecord
+    :param n_samples: how many samples to read genotypes from (None for all of them)
+    :return: alt alleles, alt freqs and genotypes, or None if the record should be skipped
+    """
+    # exclude homs / filtered? (every pysam property access decodes something, so each is only read once)
+    alts = record.alts
+    if not alts or ','.join(alts) == record.ref:
+        return None
+    filters = record.filter.keys()
+    if filters and filters != ['PASS']:
+        return None
+
+    alt_alleles = list(alts)
+    info = record.info
+    af = info.get('AF')
+    alt_freqs = allele_freqs(None if af is None else info_strings(af), len(alt_alleles))
+
+    gt_per_samp = None
+    samples = record.samples
+    n_found = len(samples) if n_samples is None else min(len(samples), n_samples)
+    if not n_found:
+        #	if available (i.e. we simulated it) look for WP in info, otherwise check info for GT
+        gt = info.get('WP')
+        if gt is None:
+            gt = info.get('GT')
+        if gt is not None:
+            gt_per_samp = [','.join(info_strings(gt))]
     else:
-        f = open(vcf_path, 'r')
+        gt_per_samp = []
+        for i in range(n_found):
+            sample = samples[i]
+            alleles = sample.get('GT')
+            if alleles is None:
+                # no GT in FORMAT
+                gt_per_samp = None
+                break
+            gt_per_samp.append(('|' if sample.phased else '/').join(['0' if n is None else str(n) for n in alleles]))
+    if gt_per_samp is None:
+        gt_per_samp = [None] * max(n_found, 1)
+
+    return alt_alleles, alt_freqs, gt_per_samp
+
+
+def trim_alleles(ref, alt_alleles):
+    """
+    Prune the bases shared by the end of the ref allele and the end of every alt allele
+
+    :param ref: ref allele
+    :param alt_alleles: list of alt alleles
+    :return: trimmed ref allele and list of trimmed alt alleles
+    """
+    if len(ref) == 1:
+        return ref, alt_alleles
+    n_trim = 0
+    shortest = min(len(ref), min([len(n) for n in alt_alleles]))
+    while n_trim < shortest - 1 and all([n[-1 - n_trim] == ref[-1 - n_trim] for n in alt_alleles]):
+        n_trim += 1
+    if n_trim:
+        return ref[:-n_trim], [n[:-n_trim] for n in alt_alleles]
+    return ref, alt_alleles
+
+
+class VcfRecordParser:
+    """
+    Turns VCF lines into NEAT's variants: keeps track of the header columns, skips variants we can't use and
+    counts what was skipped
+    """
 
-    for line in f:
+    def __init__(self, tumor_normal=False, ploidy=2, rng_seed=None):
+        """
+        :param tumor_normal: expect TUMOR and NORMAL sample columns
+        :param ploidy: ploidy, for making up genotypes of variants that don't have one
+        :param rng_seed: seed for the made up genotypes (None for a random one)
+        """
+        self.tumor_normal = tumor_normal
+        self.ploidy = ploidy
+        # the made up genotypes get their own generator, so reading the VCF doesn't change the rest of the simulation
+        self.rng = random.Random(rng_seed)
+        # this var was in the orig. May have just been a debugging thing.
+        # I think this is trying to implement a check on GT
+        self.choose_random_ploid_if_no_gt_found = True
 
-        if line[0] != '#':
-            if len(col_dict) == 0:
+        self.col_dict = {}
+        self.col_samp = []
+        self.samp_names = []
+        self.n_skipped = 0
+        self.n_skipped_because_hash = 0
+        self.found_missing_gt = False
+        self.printed_warning = False
+
+    def parse_header(self, line):
+        """
+        :param line: a header line (starting with #), with or without the line break
+        """
+        if line[1] != '#':
+            cols = line[1:].rstrip('\r\n').split('\t')
+            for i in range(len(cols)):
+                if 'FORMAT' in self.col_dict:
+                    self.col_samp.append(i)
+                self.col_dict[cols[i]] = i
+            if len(self.col_samp):
+                self.samp_names = cols[-len(self.col_samp):]
+                if len(self.col_samp) == 1:
+                    pass
+                elif len(self.col_samp) == 2 and self.tumor_normal:
+                    print('Detected 2 sample columns in input VCF, assuming tumor/normal.')
+                else:
+                    print(
+                        'Warning: Multiple sample columns present in input VCF. By default genReads uses '
+                        'only the first column.')
+            else:
+                self.samp_names = ['Unknown']
+            if self.tumor_normal:
+                # tumorInd  = samp_names.index('TUMOR')
+                # normalInd = samp_names.index('NORMAL')
+                if 'NORMAL' not in self.samp_names or 'TUMOR' not in self.samp_names:
+                    print('\n\nERROR: Input VCF must have a "NORMAL" and "TUMOR" column.\n')
+
+    def add_records(self, lines, all_vars, vcf_path=''):
+        """
+        Parse VCF lines (header lines are passed on to parse_header) into all_vars, VCF_BATCH_SIZE lines at a time
+
+        :param lines: iterable of VCF lines
+        :param all_vars: dict of [chrom][pos]: (pos, ref, alt alleles, alt freqs, genotypes), added to in place
+        :param vcf_path: path to the VCF, for error messages
+        """
+        lines = iter(lines)
+        batch = list(itertools.islice(lines, VCF_BATCH_SIZE))
+        while batch:
+            self.add_batch(batch, all_vars, vcf_path)
+            batch = list(itertools.islice(lines, VCF_BATCH_SIZE))
+
+    def add_batch(self, lines, all_vars, vcf_path=''):
+        """
+        :param lines: list of VCF lines
+        :param all_vars: dict of [chrom][pos]: (pos, ref, alt alleles, alt freqs, genotypes), added to in place
+        :param vcf_path: path to the VCF, for error messages
+        """
+        # make sure at least one allele somewhere contains the variant
+        n_samples = 2 if self.tumor_normal else 1
+        for line in lines:
+            if line[:1] == '#':
+                self.parse_header(line)
+                continue
+            line = line.strip()
+            if not line:
+                continue
+            if not self.col_dict:
                 print('\n\nERROR: VCF has no header?\n' + vcf_path + '\n\n')
-                f.close()
                 exit(1)
-            splt = line.strip().split('\t')
-            pl_out = parse_line(splt, col_dict, col_samp)
+
+            splt = line.split('\t')
+            pl_out = parse_line(splt, self.col_dict, self.col_samp, n_samples)
+            if pl_out is None:
+                self.n_skipped += 1
+                continue
+            (aa, af, gt_eval) = pl_out
+            self.add_variant(splt[0], int(splt[1]), splt[3], aa, af, gt_eval, all_vars)
+
+    def add_pysam_records(self, records, all_vars):
+        """
+        Parse records read through pysam into all_vars, the same way add_records parses VCF lines
+
+        :param records: iterable of pysam.VariantRecord
+        :param all_vars: dict of [chrom][pos]: (pos, ref, alt alleles, alt freqs, genotypes), added to in place
+        """
+        n_samples = 2 if self.tumor_normal else 1
+        for record in records:
+            pl_out = parse_pysam_record(record, n_samples)
             if pl_out is None:
-                n_skipped += 1
+                self.n_skipped += 1
+                continue
+            (aa, af, gt_eval) = pl_out
+            self.add_variant(record.chrom, record.pos, record.ref, aa, af, gt_eval, all_vars)
+
+    def add_variant(self, chrom, pos, ref, aa, af, gt_eval, all_vars):
+        """
+        Make up genotypes if there are none, and add the variant to all_vars if it is usable
+
+        :param chrom: contig name
+        :param pos: 1-based position
+        :param ref: ref allele
+        :param aa: list of alt alleles
+        :param af: list of alt freqs
+        :param gt_eval: list of genotypes of the samples we use (None for unknown)
+        :param all_vars: dict of [chrom][pos]: (pos, ref, alt alleles, alt freqs, genotypes), added to in place
+        """
+        # For some reason this had an additional "if True" inserted. I guess it was supposed to be an
+        # option the user could set but was never implemented.
+        if None in gt_eval:
+            self.found_missing_gt = True
+            if self.choose_random_ploid_if_no_gt_found:
+                if not self.printed_warning:
+                    print('Warning: Found variants without a GT field, assuming heterozygous...')
+                    self.printed_warning = True
+                for i in range(len(gt_eval)):
+                    tmp = ['0'] * self.ploidy
+                    tmp[self.rng.randint(0, self.ploidy - 1)] = '1'
+                    gt_eval[i] = '/'.join(tmp)
             else:
-                (aa, af, gt) = pl_out
+                # skip because no GT field was found
+                self.n_skipped += 1
+                return
+        if not any(['1' in n for n in gt_eval if n is not None]):
+            # skip if no genotype actually contains this variant
+            self.n_skipped += 1
+            return
 
-                # make sure at least one allele somewhere contains the variant
-                if tumor_normal:
-                    gt_eval = gt[:2]
-                else:
-                    gt_eval = gt[:1]
-                # For some reason this had an additional "if True" inserted. I guess it was supposed to be an option
-                # the user could set but was never implemented.
-                if None in gt_eval:
-                    if choose_random_ploid_if_no_gt_found:
-                        if not printed_warning:
-                            print('Warning: Found variants without a GT field, assuming heterozygous...')
-                            printed_warning = True
-                        for i in range(len(gt_eval)):
-                            tmp = ['0'] * ploidy
-                            tmp[random.randint(0, ploidy - 1)] = '1'
-                            gt_eval[i] = '/'.join(tmp)
-                    else:
-                        # skip because no GT field was found
-                        n_skipped += 1
-                        continue
-                non_reference = False
-                for gtVal in gt_eval:
-                    if gtVal is not None:
-                        if '1' in gtVal:
-                            non_reference = True
-                if not non_reference:
-                    # skip if no genotype actually contains this variant
-                    n_skipped += 1
-                    continue
-
-                chrom = splt[0]
-                pos = int(splt[1])
-                ref = splt[3]
-                # skip if position is <= 0
-                if pos <= 0:
-                    n_skipped += 1
-                    continue
-
-                # hash variants to avoid inserting duplicates (there are some messy VCFs out there...)
-                if chrom not in all_vars:
-                    all_vars[chrom] = {}
-                if pos not in all_vars[chrom]:
-                    all_vars[chrom][pos] = (pos, ref, aa, af, gt_eval)
-                else:
-                    n_skipped_because_hash += 1
+        # skip if position is <= 0
+        if pos <= 0:
+            self.n_skipped += 1
+            return
 
+        # hash variants to avoid inserting duplicates (there are some messy VCFs out there...)
+        chrom_vars = all_vars.setdefault(chrom, {})
+        if pos not in chrom_vars:
+            (ref, aa) = trim_alleles(ref, aa)
+            chrom_vars[pos] = (pos, ref, aa, af, gt_eval)
         else:
-            if line[1] != '#':
-                cols = line[1:-1].split('\t')
-                for i in range(len(cols)):
-                    if 'FORMAT' in col_dict:
-                        col_samp.append(i)
-                    col_dict[cols[i]] = i
-                if len(col_samp):
-                    samp_names = cols[-len(col_samp):]
-                    if len(col_samp) == 1:
-                        pass
-                    elif len(col_samp) == 2 and tumor_normal:
-                        print('Detected 2 sample columns in input VCF, assuming tumor/normal.')
-                    else:
-                        print(
-                            'Warning: Multiple sample columns present in input VCF. By default genReads uses '
-                            'only the first column.')
-                else:
-                    samp_names = ['Unknown']
-                if tumor_normal:
-                    # tumorInd  = samp_names.index('TUMOR')
-                    # normalInd = samp_names.index('NORMAL')
-                    if 'NORMAL' not in samp_names or 'TUMOR' not in samp_names:
-                        print('\n\nERROR: Input VCF must have a "NORMAL" and "TUMOR" column.\n')
-    f.close()
+            self.n_skipped_because_hash += 1
+
+    def print_summary(self, n_found, where='input vcf'):
+        """
+        :param n_found: number of variants we kept
+        :param where: what we parsed, for the message
+        """
+        print('found', n_found, 'valid variants in ' + where + '.')
+        print(' *', self.n_skipped, 'variants skipped: (qual filtered / ref genotypes / invalid syntax)')
+        print(' *', self.n_skipped_because_hash, 'variants skipped due to multiple variants found per position')
+
+
+def sort_variants(all_vars) -> dict:
+    """
+    Sort the variants of each contig by position (their alleles were already trimmed as they were parsed)
+
+    :param all_vars: dict of [chrom][pos]: variant tuple, as filled in by VcfRecordParser.add_records
+    :return: dict of chrom: VariantStore
+    """
+    return {r: VariantStore([all_vars[r][k] for k in sorted(all_vars[r].keys())]) for r in all_vars.keys()}
+
+
+def tabix_index_path(vcf_path):
+    """
+    :param vcf_path: path to the VCF (or BCF)
+    :return: path to its tabix (.tbi) or CSI (.csi) index, or None if it has neither
+    """
+    if not vcf_path.endswith(('.gz', '.bcf')):
+        return None
+    for suffix in TABIX_INDEX_SUFFIXES:
+        if os.path.isfile(vcf_path + suffix):
+            return vcf_path + suffix
+    return None
+
+
+class TabixVariants:
+    """
+    Variants from a bgzipped, tabix-indexed VCF (or an indexed BCF), read one contig at a time as they are asked
+    for. Behaves like the dict of chrom: VariantStore that parse_vcf returns for unindexed files, but only the most
+    recently requested contig is kept in memory.
+    """
+
+    def __init__(self, vcf_path, parser, engine='python'):
+        """
+        :param vcf_path: path to the VCF
+        :param parser: VcfRecordParser
+        :param engine: python: fetch lines through tabix and parse them here, pysam: let htslib decode the records
+        """
+        self.vcf_path = vcf_path
+        self.parser = parser
+        self.engine = engine
+        self.tabix_file = None
+        self.variant_file = None
+        if engine == 'pysam':
+            self.variant_file = pysam.VariantFile(vcf_path, index_filename=tabix_index_path(vcf_path))
+            self.parser.parse_header(str(self.variant_file.header).splitlines()[-1])
+            self.contigs = list(self.variant_file.index.keys())
+        else:
+            self.tabix_file = pysam.TabixFile(vcf_path, index=tabix_index_path(vcf_path))
+            for line in self.tabix_file.header:
+                self.parser.parse_header(line)
+            self.contigs = list(self.tabix_file.contigs)
+        self.current_chrom = None
+        self.current_vars = []
+
+    def __contains__(self, chrom):
+        return chrom in self.contigs
+
+    def __getitem__(self, chrom):
+        if chrom not in self:
+            raise KeyError(chrom)
+        if chrom != self.current_chrom:
+            (self.parser.n_skipped, self.parser.n_skipped_because_hash) = (0, 0)
+            self.current_vars = self.fetch(chrom)
+            self.current_chrom = chrom
+            self.parser.print_summary(len(self.current_vars), chrom + ' of the input vcf')
+        return self.current_vars
+
+    def keys(self):
+        return list(self.contigs)
+
+    def fetch(self, chrom, start=None, end=None) -> list:
+        """
+        Read the variants overlapping a region
+
+        :param chrom: contig name
+        :param start: 0-based start of the region (None for the start of the contig)
+        :param end: 0-based end of the region, exclusive (None for the end of the contig)
+        :return: VariantStore
+        """
+        if chrom not in self:
+            return VariantStore()
+        all_vars = {}
+        if self.variant_file is not None:
+            self.parser.add_pysam_records(self.variant_file.fetch(chrom, start, end), all_vars)
+        else:
+            self.parser.add_records(self.tabix_file.fetch(chrom, start, end), all_vars, self.vcf_path)
+        return sort_variants(all_vars).get(chrom, VariantStore())
+
+    def close(self):
+        if self.variant_file is not None:
+            self.variant_file.close()
+        else:
+            self.tabix_file.close()
+
+
+def vcf_byte_ranges(vcf_path, data_start, range_size=VCF_RANGE_SIZE) -> list:
+    """
+    Split the records of an uncompressed VCF into byte ranges that start and end on line boundaries
+
+    :param vcf_path: path to the VCF
+    :param data_start: byte offset of the first record (i.e. the end of the header)
+    :param range_size: approximate size of each range
+    :return: list of (start, end) byte offsets
+    """
+    file_size = os.path.getsize(vcf_path)
+    boundaries = [data_start]
+    with open(vcf_path, 'rb') as f:
+        for offset in range(data_start + range_size, file_size, range_size):
+            if offset <= boundaries[-1]:
+                continue
+            # move on to the start of the next line
+            f.seek(offset - 1)
+            f.readline()
+            if f.tell() >= file_size:
+                break
+            boundaries.append(f.tell())
+    boundaries.append(file_size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def parse_vcf_range(vcf_path, parser, rng_seed, byte_range):
+    """
+    Parse one byte range of an uncompressed VCF (possibly in a worker process). The made up genotypes of variants
+    without a GT field are seeded by the run's seed and where the range starts, so they don't depend on the number
+    of workers.
+
+    :param vcf_path: path to the VCF
+    :param parser: VcfRecordParser that has already seen the header
+    :param rng_seed: seed of the run
+    :param byte_range: (start, end) byte offsets, on line boundaries
+    :return: dict of chrom: VariantStore, and the parser (for its counts of skipped variants)
+    """
+    parser.rng.seed(rng_seed * 2 ** 64 + byte_range[0])
+    # the warning about missing GT fields is printed once, by the parent
+    parser.printed_warning = True
+    with open(vcf_path, 'rb') as f:
+        f.seek(byte_range[0])
+        lines = f.read(byte_range[1] - byte_range[0]).decode().split('\n')
+    all_vars = {}
+    parser.add_records(lines, all_vars, vcf_path)
+    return sort_variants(all_vars), parser
+
+
+def parse_vcf_ranges(vcf_path, parser, threads, rng_seed):
+    """
+    Parse an uncompressed VCF one byte range at a time, in a process pool if there are several ranges and threads.
+    Duplicate positions are resolved as they are when reading the file in one go: the first record in the file
+    wins, the rest are counted as skipped because of multiple variants per position.
+
+    :param vcf_path: path to the VCF
+    :param parser: VcfRecordParser, the header is read into it here
+    :param threads: number of worker processes
+    :param rng_seed: seed of the run, for the made up genotypes
+    :return: dict of chrom: VariantStore
+    """
+    with open(vcf_path, 'rb') as f:
+        data_start = 0
+        line = f.readline()
+        while line[:1] == b'#':
+            parser.parse_header(line.decode())
+            data_start = f.tell()
+            line = f.readline()
+    if len(parser.col_dict) == 0:
+        print('\n\nERROR: VCF has no header?\n' + vcf_path + '\n\n')
+        exit(1)
+
+    byte_ranges = vcf_byte_ranges(vcf_path, data_start)
+    n_ranges = len(byte_ranges)
+    if min(threads, n_ranges) > 1:
+        with ProcessPoolExecutor(max_workers=min(threads, n_ranges)) as executor:
+            results = list(executor.map(parse_vcf_range, [vcf_path] * n_ranges, [parser] * n_ranges,
+                                        [rng_seed] * n_ranges, byte_ranges))
+    else:
+        # each range gets a copy of the parser, as it would in a worker process
+        results = [parse_vcf_range(vcf_path, copy.deepcopy(parser), rng_seed, byte_range)
+                   for byte_range in byte_ranges]
+
+    # ranges come back in file order, so keeping the first occurrence of each position keeps the first record
+    range_vars = {}
+    for (vars_out, range_parser) in results:
+        parser.n_skipped += range_parser.n_skipped
+        parser.n_skipped_because_hash += range_parser.n_skipped_because_hash
+        parser.found_missing_gt |= range_parser.found_missing_gt
+        for chrom in vars_out:
+            range_vars.setdefault(chrom, []).append(vars_out[chrom])
+    if parser.found_missing_gt and parser.choose_random_ploid_if_no_gt_found:
+        print('Warning: Found variants without a GT field, assuming heterozygous...')
 
     vars_out = {}
-    for r in all_vars.keys():
-        vars_out[r] = [list(all_vars[r][k]) for k in sorted(all_vars[r].keys())]
-        # prune unnecessary sequence from ref/alt alleles
-        for i in range(len(vars_out[r])):
-            while len(vars_out[r][i][1]) > 1 and all([n[-1] == vars_out[r][i][1][-1] for n in vars_out[r][i][2]]) \
-                    and all([len(n) > 1 for n in vars_out[r][i][2]]):
-                vars_out[r][i][1] = vars_out[r][i][1][:-1]
-                vars_out[r][i][2] = [n[:-1] for n in vars_out[r][i][2]]
-            vars_out[r][i] = tuple(vars_out[r][i])
-
-    print('found', sum([len(n) for n in all_vars.values()]), 'valid variants in input vcf.')
-    print(' *', n_skipped, 'variants skipped: (qual filtered / ref genotypes / invalid syntax)')
-    print(' *', n_skipped_because_hash, 'variants skipped due to multiple variants found per position')
+    for chrom in range_vars:
+        merged = concatenate_stores(range_vars[chrom])
+        (_, first_index) = np.unique(merged.positions, return_index=True)
+        parser.n_skipped_because_hash += len(merged) - len(first_index)
+        vars_out[chrom] = merged.take(first_index)
+    return vars_out
+
+
+def parse_vcf(vcf_path, tumor_normal=False, ploidy=2, threads=None, engine='auto', rng_seed=None):
+    """
+    Read the input VCF. Bgzipped VCFs with a tabix index are not read here, but one contig at a time as the
+    simulation gets to it. Uncompressed VCFs are split into byte ranges, large ones are parsed in a process pool.
+    With the pysam engine, records are decoded by htslib instead (which is also the only way to read BCF).
+    The genotypes made up for variants without one only depend on rng_seed, not on threads or the number of cpus.
+
+    :param vcf_path: path to the VCF
+    :param tumor_normal: expect TUMOR and NORMAL sample columns
+    :param ploidy: ploidy, for making up genotypes of variants that don't have one
+    :param threads: number of worker processes for large uncompressed VCFs, defaults to the number of cpus
+    :param engine: python: parse the VCF text here, pysam: read it through pysam.VariantFile,
+                   auto: pysam for BCF, python for everything else
+    :param rng_seed: seed for the made up genotypes (None for a random one)
+    :return: sample names, and dict (or dict-like TabixVariants) of chrom: VariantStore
+    """
+    tt = time.time()
+    print('--------------------------------')
+    print('reading input VCF...\n', flush=True)
+
+    if rng_seed is None:
+        rng_seed = random.SystemRandom().getrandbits(32)
+    parser = VcfRecordParser(tumor_normal, ploidy, rng_seed)
+
+    if engine == 'auto':
+        engine = 'pysam' if vcf_path.endswith('.bcf') else 'python'
+    if engine == 'pysam' and pysam is None:
+        print('\n\nERROR: pysam is needed to read ' + vcf_path + ' with the pysam engine.\n\n')
+        exit(1)
+    if engine == 'python' and vcf_path.endswith('.bcf'):
+        print('\n\nERROR: BCF input can only be read with the pysam engine.\n\n')
+        exit(1)
+
+    if tabix_index_path(vcf_path) is not None:
+        if pysam is None:
+            print('Warning: pysam is not available, reading the whole indexed VCF.')
+        else:
+            print('found index ' + tabix_index_path(vcf_path) + ', variants will be read one contig at a time.')
+            vars_out = TabixVariants(vcf_path, parser, engine)
+            print('--------------------------------')
+            return parser.samp_names, vars_out
+
+    if threads is None:
+        threads = os.cpu_count() or 1
+    if engine == 'pysam':
+        all_vars = {}  # [ref][pos]
+        variant_file = pysam.VariantFile(vcf_path)
+        parser.parse_header(str(variant_file.header).splitlines()[-1])
+        parser.add_pysam_records(variant_file, all_vars)
+        variant_file.close()
+        vars_out = sort_variants(all_vars)
+    elif not vcf_path.endswith('.gz'):
+        vars_out = parse_vcf_ranges(vcf_path, parser, threads, rng_seed)
+    else:
+        all_vars = {}  # [ref][pos]
+        f = gzip.open(vcf_path, 'rt')
+        parser.add_records(f, all_vars, vcf_path)
+        f.close()
+
+        vars_out = sort_variants(all_vars)
+
+    parser.print_summary(sum([len(n) for n in vars_out.values()]))
     print('--------------------------------')
-    return samp_names, vars_out
+    return parser.samp_names, vars_out
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+#
+#
+#          benchmark_vcf_parse.py
+#          Measures how many VCF records per second the gen_reads VCF parser gets through
+#
+#
+#          Usage: python benchmark_vcf_parse.py [-n 10000000] [-i input.vcf] [-o synthetic.vcf] [-e python]
+#
+#
+
+import argparse
+import itertools
+import os
+import sys
+import time
+import pathlib
+import tempfile
+
+import numpy as np
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+
+from source.vcf_func import VcfRecordParser, VCF_BATCH_SIZE, pysam
+
+# (ref, alt) pairs to draw records from: SNPs, indels, multi-allelic sites and alleles with a shared suffix to trim
+ALLELES = [('A', 'C'), ('A', 'G'), ('C', 'T'), ('G', 'A'), ('T', 'C'), ('G', 'T'),
+           ('ACG', 'A'), ('A', 'ATT'), ('C', 'T,G'), ('ACGT', 'AGT,ACT')]
+INFOS = ['AF=0.25;DP=30', 'DP=12', 'AF=0.1,0.3;DP=7', 'DB;AF=0.5']
+FILTERS = ['PASS', 'PASS', 'PASS', '.', 'q10']
+GENOTYPES = ['0/1', '1/1', '1|0', '0|1', './1', '0/0']
+# how many records to generate at once
+GENERATE_CHUNK_SIZE = 10 ** 5
+
+
+def write_synthetic_vcf(out_path, n_records, n_contigs=24, seed=0):
+    """
+    Write a VCF of random records with a single sample column
+
+    :param out_path: where to write the VCF
+    :param n_records: how many records to write
+    :param n_contigs: how many contigs to spread them over
+    :param seed: seed for the random number generator
+    """
+    rng = np.random.default_rng(seed)
+    per_contig = -(-n_records // n_contigs)
+    with open(out_path, 'w') as f:
+        f.write('##fileformat=VCFv4.2\n')
+        f.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n')
+        for i in range(0, n_records, GENERATE_CHUNK_SIZE):
+            n = min(GENERATE_CHUNK_SIZE, n_records - i)
+            record_ids = np.arange(i, i + n)
+            chroms = ['chr' + str(k + 1) for k in (record_ids // per_contig).tolist()]
+            # ~1 variant every 100bp, always at least 5bp apart so no two records share a position
+            positions = ((record_ids % per_contig) * 100 + rng.integers(1, 95, n)).tolist()
+            alleles = [ALLELES[k] for k in rng.integers(0, len(ALLELES), n).tolist()]
+            infos = [INFOS[k] for k in rng.integers(0, len(INFOS), n).tolist()]
+            filters = [FILTERS[k] for k in rng.integers(0, len(FILTERS), n).tolist()]
+            genotypes = [GENOTYPES[k] for k in rng.integers(0, len(GENOTYPES), n).tolist()]
+            f.write(''.join([chrom + '\t' + str(pos) + '\t.\t' + ref + '\t' + alt + '\t50\t' + filt + '\t' + info +
+                             '\tGT:DP\t' + gt + ':20\n'
+                             for (chrom, pos, (ref, alt), filt, info, gt)
+                             in zip(chroms, positions, alleles, filters, infos, genotypes)]))
+
+
+def benchmark_pysam(vcf_path):
+    """
+    Same as benchmark, reading the records through pysam (the time includes htslib decoding them)
+
+    :param vcf_path: path to the VCF
+    :return: number of records, number of variants kept, seconds spent parsing
+    """
+    parser = VcfRecordParser()
+    n_records = 0
+    n_kept = 0
+    parse_time = 0.
+    variant_file = pysam.VariantFile(vcf_path)
+    parser.parse_header(str(variant_file.header).splitlines()[-1])
+    records = iter(variant_file)
+    while True:
+        all_vars = {}
+        tt = time.perf_counter()
+        batch = list(itertools.islice(records, VCF_BATCH_SIZE))
+        parser.add_pysam_records(batch, all_vars)
+        parse_time += time.perf_counter() - tt
+        if not batch:
+            break
+        n_records += len(batch)
+        n_kept += sum([len(n) for n in all_vars.values()])
+    variant_file.close()
+    return n_records, n_kept, parse_time
+
+
+def benchmark(vcf_path):
+    """
+    Parse a VCF a batch at a time, throwing away the variants of each batch so memory use stays flat
+
+    :param vcf_path: path to the VCF
+    :return: number of records, number of variants kept, seconds spent parsing
+    """
+    parser = VcfRecordParser()
+    n_records = 0
+    n_kept = 0
+    parse_time = 0.
+    with open(vcf_path, 'r') as f:
+        while True:
+            batch = f.readlines(VCF_BATCH_SIZE * 64)
+            if not batch:
+                break
+            n_records += sum([1 for line in batch if line[0] != '#'])
+            all_vars = {}
+            tt = time.perf_counter()
+            parser.add_batch(batch, all_vars, vcf_path)
+            parse_time += time.perf_counter() - tt
+            n_kept += sum([len(n) for n in all_vars.values()])
+    return n_records, n_kept, parse_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark_vcf_parse.py')
+    parser.add_argument('-n', type=int, required=False, metavar='<int>', default=10000000,
+                        help="Number of records in the synthetic VCF")
+    parser.add_argument('-i', type=str, required=False, metavar='<str>', default=None,
+                        help="Benchmark this VCF instead of a synthetic one (uncompressed, unless -e pysam)")
+    parser.add_argument('-o', type=str, required=False, metavar='<str>', default=None,
+                        help="Write the synthetic VCF here and keep it (default: temporary file)")
+    parser.add_argument('-e', type=str, required=False, choices=['python', 'pysam'], default='python',
+                        help="VCF engine to benchmark, as gen_reads.py --vcf-engine")
+    parser.add_argument('--seed', type=int, required=False, metavar='<int>', default=0,
+                        help="Seed for the synthetic VCF")
+    args = parser.parse_args()
+    if args.e == 'pysam' and pysam is None:
+        print('\nError: the pysam engine needs pysam to be installed.\n')
+        sys.exit(1)
+
+    vcf_path = args.i
+    temp_path = None
+    if vcf_path is None:
+        if args.o is None:
+            (handle, temp_path) = tempfile.mkstemp(suffix='.vcf')
+            os.close(handle)
+            vcf_path = temp_path
+        else:
+            vcf_path = args.o
+        tt = time.perf_counter()
+        print('writing ' + str(args.n) + ' records to ' + vcf_path + '... ', flush=True)
+        write_synthetic_vcf(vcf_path, args.n, seed=args.seed)
+        print('{0:.3f} (sec)'.format(time.perf_counter() - tt))
+
+    try:
+        print('parsing ' + vcf_path + '... ', flush=True)
+        if args.e == 'pysam':
+            (n_records, n_kept, parse_time) = benchmark_pysam(vcf_path)
+        else:
+            (n_records, n_kept, parse_time) = benchmark(vcf_path)
+    finally:
+        if temp_path is not None:
+            os.remove(temp_path)
+
+    print('records:', n_records, '(' + str(n_kept) + ' kept)')
+    print('parse time: {0:.3f} (sec)'.format(parse_time))
+    print('throughput: {0:.0f} records/sec'.format(n_records / max(parse_time, 1e-9)))
+
+
+if __name__ == '__main__':
+    main()